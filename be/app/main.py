@@ -1,12 +1,18 @@
 import os
 
+from app import stats
 from app.payment import freekassa, payment, trial
+from db.database import dbq
 from fastapi import Depends, FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
+from lib.catalog import catalog
 from prometheus_fastapi_instrumentator import Instrumentator
 
+from dbm.grpc_pool import close_pool
+from dbm.redis_db import redis_stright
 from libs.auth import get_current_username
+from libs.coupon_pool import coupon_pool
 from libs.exceptions import MyCustomException
 
 app = FastAPI()
@@ -16,6 +22,7 @@ app.include_router(payment.router)
 app.include_router(payment.router_lang)
 app.include_router(freekassa.router)
 app.include_router(freekassa.router_lang)
+app.include_router(stats.router)
 
 instrumentator = Instrumentator().instrument(app)
 
@@ -47,6 +54,23 @@ def startup_event():
     os.system("python3 /ws/be/misc/burning_emails.py > /dev/null &")
 
 
+@app.on_event("startup")
+async def _start_catalog():
+    catalog.start(dbq, redis_stright)
+
+
+@app.on_event("startup")
+async def _start_coupon_pool():
+    coupon_pool.start(dbq)
+
+
+@app.on_event("shutdown")
+async def _shutdown():
+    await catalog.stop()
+    await coupon_pool.stop()
+    await close_pool()
+
+
 @app.exception_handler(MyCustomException)
 async def MyCustomExceptionHandler(request: Request, exception: MyCustomException):
     """
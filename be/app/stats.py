@@ -0,0 +1,34 @@
+from typing import Annotated, List
+
+from fastapi import APIRouter, Depends, Query
+
+from dbm.schemas import SlowShape
+from dbm.slow_queries import slow_queries
+from libs.auth import get_current_username
+
+router = APIRouter(prefix="/stats", dependencies=[Depends(get_current_username)])
+
+
+@router.get(
+    "/slow-queries",
+    summary="Slowest DB statement shapes of this process",
+    description=(
+        "Statement shapes with the slowest recent DB service calls, "
+        "from the slow-query journal of the process."
+    ),
+)
+async def slow_query_shapes(
+    limit: Annotated[int, Query(ge=1, le=500)] = 20,
+) -> List[SlowShape]:
+    """
+    Dump the top slowest statement shapes of the slow-query journal,
+    each with its slow call count, maximum and mean duration and the
+    mean duration of its calls sampled as baseline.
+
+    Args:
+        limit: Number of shapes returned, 20 by default.
+
+    Returns:
+        List[SlowShape]: Shapes by decreasing maximum duration.
+    """
+    return slow_queries.top(limit)
@@ -20,6 +20,20 @@ class SettingsBE(Settings):
     URL_SUCCESS: str = FRONTEND_BASE_URL + "/vpn/payment/success"
     TEST_MODE: bool = True
 
+    # --- reference data catalog (tariffs, plans, partners)
+    # Redis key bumped when reference data changes; it is checked every
+    # CATALOG_REFRESH_INTERVAL seconds and the catalog is reloaded when
+    # it changed or when the catalog is older than CATALOG_MAX_AGE
+    CATALOG_VERSION_KEY: str = "catalog:version"
+    CATALOG_REFRESH_INTERVAL: float = 10.0
+    CATALOG_MAX_AGE: float = 3600.0
+
+    # --- compiled coupon rules
+    # seconds a compiled coupon stays in the in-process rule cache (0
+    # disables it), and most coupons kept
+    COUPON_RULES_TTL: float = 30.0
+    COUPON_RULES_MAX_SIZE: int = 10000
+
     # freekassa
     FREEK_PAYMENT_SYSTEM_ID: int = 44
     FREEK_API_URI: str = "https://pay.fk.money/?"
@@ -0,0 +1,144 @@
+"""
+Compiled coupon rules, cached in-process.
+
+Validating a coupon and pricing a payment with it used to read the
+coupon twice and reparse its plans string on every call. A coupon is
+now compiled once into a CouponRule (frozenset of plans, expiry
+timestamp, price multiplier, use limit state) kept for
+settings.COUPON_RULES_TTL seconds by the process, so that the checks and
+the pricing of a request cost one dict lookup. The rule of a coupon is
+dropped when this process counts or gives back one of its uses; uses
+counted by other processes are seen once the rule expires, the
+guarded increment of update_coupon_times_used() being the final check.
+"""
+
+import time
+from datetime import datetime
+from typing import Any, Dict, FrozenSet, Optional
+
+from config_be import settings
+from db.schemas import CouponCheck
+
+from dbm.schemas import CouponsPd
+
+
+class CouponRule:
+    """
+    Coupon compiled for validation and pricing. Shared by all requests,
+    it must not be modified.
+
+    Args:
+        coupon (CouponsPd): Coupon record.
+    """
+
+    __slots__ = (
+        "code",
+        "percent",
+        "prolong",
+        "plans",
+        "expires_at",
+        "multiplier",
+        "max_uses",
+        "times_used",
+        "loaded_at",
+    )
+
+    def __init__(self, coupon: CouponsPd) -> None:
+        self.code = coupon.coupon
+        self.percent = coupon.percent
+        self.prolong = coupon.prolong
+        # None when the coupon applies to any plan
+        self.plans: Optional[FrozenSet[int]] = (
+            frozenset(int(p) for p in coupon.plans.split(",") if p.strip())
+            if coupon.plans
+            else None
+        )
+        expiration = coupon.expiration
+        if isinstance(expiration, str):
+            expiration = datetime.fromisoformat(expiration)
+        self.expires_at = expiration.timestamp()
+        self.multiplier = (100 - coupon.percent) / 100
+        self.max_uses = coupon.max_use_limit or 0
+        self.times_used = coupon.times_used or 0
+        self.loaded_at = time.monotonic()
+
+    def applies_to(self, tariff: Optional[int | str]) -> bool:
+        """Whether the coupon applies to a plan, any plan if None."""
+        return tariff is None or self.plans is None or int(tariff) in self.plans
+
+    @property
+    def used_up(self) -> bool:
+        return self.max_uses != 0 and self.times_used >= self.max_uses
+
+    @property
+    def expired(self) -> bool:
+        return self.expires_at < time.time()
+
+    def valid(self, tariff: Optional[int | str] = None) -> bool:
+        """
+        Whether the coupon can be used, for a plan if one is given.
+
+        Args:
+            tariff (Optional[int | str]): Plan (number of days).
+
+        Returns:
+            bool: It applies to the plan, is not used up nor expired.
+        """
+        return self.applies_to(tariff) and not self.used_up and not self.expired
+
+    def price(self, amount: float) -> float:
+        """Amount with the discount of the coupon, not rounded."""
+        return amount * self.multiplier
+
+    def as_check(self) -> Dict[str, Any]:
+        """Answer of the coupon check endpoint for a valid coupon."""
+        return CouponCheck(percent=self.percent, prolong=self.prolong).model_dump()
+
+
+class CouponRules:
+    """
+    In-process cache of compiled coupon rules by normalized code, with
+    a TTL and a bounded size (the oldest rule is dropped when full).
+    """
+
+    def __init__(self) -> None:
+        self._rules: Dict[str, CouponRule] = {}
+
+    @staticmethod
+    def normalize(code: str) -> str:
+        """Coupon codes are compared case-insensitively by the database."""
+        return code.strip().lower()
+
+    @property
+    def enabled(self) -> bool:
+        return settings.COUPON_RULES_TTL > 0
+
+    def get(self, code: str) -> Optional[CouponRule]:
+        """Cached rule of a code, None on a miss or if it expired."""
+        if not self.enabled:
+            return None
+        rule = self._rules.get(self.normalize(code))
+        if rule is None:
+            return None
+        if time.monotonic() - rule.loaded_at >= settings.COUPON_RULES_TTL:
+            self._rules.pop(self.normalize(code), None)
+            return None
+        return rule
+
+    def put(self, coupon: CouponsPd) -> CouponRule:
+        """Compile a coupon read from the database and cache its rule."""
+        rule = CouponRule(coupon)
+        if self.enabled:
+            key = self.normalize(coupon.coupon)
+            self._rules.pop(key, None)
+            if len(self._rules) >= settings.COUPON_RULES_MAX_SIZE:
+                self._rules.pop(next(iter(self._rules)))
+            self._rules[key] = rule
+        return rule
+
+    async def forget(self, code: str) -> None:
+        """Drop the rule of a code after a write of its coupon."""
+        self._rules.pop(self.normalize(code), None)
+
+    def clear(self) -> None:
+        self._rules.clear()
@@ -1,21 +1,41 @@
+from functools import partial
+from typing import List, Optional
+
+from dbm.coupon_filter import CouponFilter
 from dbm.database import DbQueryMixin
 from dbm.db_main import DbMain
 from dbm.models import Coupons, Transactions, Users
+from dbm.redis_db import redis_stright
 from dbm.schemas import UserId
+from dbm.user_cache import UserCache
 
-from db.models import TariffsWh
+from db.coupon_rules import CouponRule, CouponRules
+from db.models import Partners, TariffsWh
 from db.schemas import Count, Partner, TariffsWhPd
-from sqlalchemy import delete, func, select, update
+from sqlalchemy import delete, func, or_, select, update
+from sqlalchemy.sql import ColumnElement
 
 from libs.logs import log
 
 
+def coupon_has_uses() -> ColumnElement:
+    """Condition of a coupon having uses left, a limit of 0 or NULL is none."""
+    return or_(
+        func.coalesce(Coupons.max_use_limit, 0) == 0,
+        func.coalesce(Coupons.times_used, 0) < Coupons.max_use_limit,
+    )
+
+
 class DbQuery(DbMain, DbQueryMixin):
     """
     Database query class combining main DB engine and query mixin
     to perform specific data retrieval and update operations.
     """
 
+    user_cache = UserCache(redis_stright)
+    coupon_filter = CouponFilter(redis_stright)
+    coupon_rules = CouponRules()
+
     # gets
 
     async def get_partner(self, partner_id: int) -> Partner:
@@ -29,10 +49,19 @@ class DbQuery(DbMain, DbQueryMixin):
             Partner | None: Partner data object or None if not found.
         """
         statement = select(Partners).where(Partners.id == partner_id)
-        self.data_class = Partner
-        result_ = await self.result_one(statement)
+        result_ = await self.result_one(statement, Partner)
         return result_
 
+    async def get_partners(self) -> List[Partner]:
+        """
+        Get all partners, for the reference data catalog.
+
+        Returns:
+            List[Partner]: Partner data objects, or an empty list.
+        """
+        statement = select(Partners).order_by(Partners.id)
+        result_ = await self.result(statement, Partner, trusted=True)
+        return result_
 
     async def get_tariff(self, plan: int) -> TariffsWhPd:
         """
@@ -45,27 +74,83 @@ class DbQuery(DbMain, DbQueryMixin):
             TariffsWhPd | None: Tariff data or None if not found.
         """
         statement = select(TariffsWh).where(TariffsWh.date == str(plan))
-        self.data_class = TariffsWhPd
-        result_ = await self.result_one(statement)
+        result_ = await self.result_one(statement, TariffsWhPd, coalesce=True)
         return result_
 
-    # updates
+    async def get_tariffs(self) -> List[TariffsWhPd]:
+        """
+        Get all tariffs for the frontend. Concurrent calls share one
+        query to the database service.
+
+        Returns:
+            List[TariffsWhPd]: Tariff data, or an empty list.
+        """
+        statement = select(TariffsWh).order_by(TariffsWh.id)
+        result_ = await self.result(statement, TariffsWhPd, coalesce=True)
+        return result_
 
-    async def update_coupon_times_used(self, coupon: str) -> None:
+    async def get_coupon_rule(self, coupon: str) -> Optional[CouponRule]:
         """
-        Increment the usage count of a coupon if it exists.
+        Compiled rule of a coupon, from the in-process rule cache except
+        for reads from the primary.
 
         Args:
             coupon (str): Coupon code string.
+
+        Returns:
+            Optional[CouponRule]: Rule of the coupon, None if not found.
         """
+        if self.cacheable_(select(Coupons)):
+            rule = self.coupon_rules.get(coupon)
+            if rule is not None:
+                return rule
         coupon_db = await self.get_coupon(coupon)
-        if coupon_db is not None:
-            statement = (
-                update(Coupons)
-                .where(Coupons.coupon == coupon)
-                .values(times_used=coupon_db.times_used + 1)
-            )
-            await self.result(statement)
+        if coupon_db is None:
+            return None
+        return self.coupon_rules.put(coupon_db)
+
+    async def forget_coupon_rule_(self, coupon: str) -> None:
+        """Drop a coupon rule from the rule cache once its write is done."""
+        await self.after_write_(partial(self.coupon_rules.forget, coupon))
+
+    # updates
+
+    async def update_coupon_times_used(self, coupon: str) -> Optional[int]:
+        """
+        Count one use of a coupon unless its use limit is reached. The
+        check and the increment are one statement on the database server,
+        so concurrent payments with the same coupon neither lose uses
+        nor go over the limit.
+
+        Args:
+            coupon (str): Coupon code string.
+
+        Returns:
+            Optional[int]: New number of uses, None if the coupon does not
+                exist or is used up.
+        """
+        used = await self.increment(
+            Coupons.times_used,
+            Coupons.coupon == coupon,
+            guard=coupon_has_uses(),
+        )
+        await self.forget_coupon_rule_(coupon)
+        return used
+
+    async def release_coupon_use(self, coupon: str) -> Optional[int]:
+        """
+        Give back a use of a coupon counted by update_coupon_times_used().
+
+        Args:
+            coupon (str): Coupon code string.
+
+        Returns:
+            Optional[int]: New number of uses, None if the coupon does not
+                exist or has no use counted.
+        """
+        used = await self.decrement(Coupons.times_used, Coupons.coupon == coupon)
+        await self.forget_coupon_rule_(coupon)
+        return used
 
     async def update_user_full_finish(self, user: UserId) -> None:
         """
@@ -86,11 +171,17 @@ class DbQuery(DbMain, DbQueryMixin):
             )
         )
         await self.result(statement)
+        await self.forget_user_(user.email)
 
 
 dbq = DbQuery()
 
 
-async def db():
-    db = DbQuery()
-    return db
+async def db() -> DbQuery:
+    """
+    Database dependency. DbQuery instances keep no per-call state, so
+    one process-wide instance serves all concurrent requests; each
+    request gets its own scoped view of it, whose identity map saves
+    repeated lookups of the same user or coupon.
+    """
+    return dbq.scoped()
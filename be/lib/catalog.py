@@ -0,0 +1,194 @@
+"""
+In-process catalog of reference data: tariffs_wh rows, the parsed PLANS
+setting and partners.
+
+The payment hot path looks tariffs, plans and partners up in an
+immutable snapshot held by the process instead of querying the
+database service (or Redis) on every request. A background task checks
+a version key in Redis and, when it changed (see bump_version()) or the
+snapshot got older than settings.CATALOG_MAX_AGE, loads a new snapshot
+and swaps it in with one assignment: a request sees either the old or
+the new catalog, never a mix of both. Until a first snapshot is loaded,
+and for ids missing from it, lookups fall back to the database.
+"""
+
+import asyncio
+import json
+import time
+from types import MappingProxyType
+from typing import Any, Dict, List, Mapping, Optional, Tuple
+
+from config_be import settings
+from db.database import DbQuery
+from db.schemas import Partner, TariffsWhPd
+from redis.asyncio.client import Redis
+
+from libs.logs import log
+
+
+class Catalog:
+    """
+    Immutable snapshot of the reference data, with O(1) lookups.
+    Its rows are shared by all requests and must not be modified.
+
+    Args:
+        version (Optional[str]): Version key value the snapshot was
+            loaded for, None if the key was not set.
+        tariffs (List[TariffsWhPd]): tariffs_wh rows, in frontend order.
+        partners (List[Partner]): Partners.
+        plans (Dict[str, Any]): Parsed PLANS setting.
+    """
+
+    def __init__(
+        self,
+        version: Optional[str],
+        tariffs: List[TariffsWhPd],
+        partners: List[Partner],
+        plans: Dict[str, Any],
+    ) -> None:
+        self.version = version
+        self.loaded_at = time.monotonic()
+        self.tariffs: Tuple[TariffsWhPd, ...] = tuple(tariffs)
+        self.tariffs_json = json.dumps([t.model_dump() for t in tariffs])
+        self._tariffs: Mapping[str, TariffsWhPd] = MappingProxyType(
+            {t.date: t for t in tariffs}
+        )
+        self._partners: Mapping[int, Partner] = MappingProxyType(
+            {p.id: p for p in partners}
+        )
+        self.plans: Mapping[str, Any] = MappingProxyType(plans)
+
+    def tariff(self, plan: int | str) -> Optional[TariffsWhPd]:
+        """Tariff of a plan (number of days), None if there is none."""
+        return self._tariffs.get(str(plan))
+
+    def partner(self, partner_id: int) -> Optional[Partner]:
+        """Partner by id, None if it is not in the snapshot."""
+        return self._partners.get(partner_id)
+
+    def plan(self, days: int | str) -> Optional[Dict[str, Any]]:
+        """Product ids of a plan by payment system, from PLANS."""
+        return self.plans["plans"].get(str(days))
+
+
+class CatalogService:
+    """
+    Holder of the current catalog and of its background refresh task.
+    """
+
+    def __init__(self) -> None:
+        self.current: Optional[Catalog] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def load(self, db: DbQuery, version: Optional[str] = None) -> Catalog:
+        """
+        Load a new snapshot from the database service and swap it in.
+
+        Args:
+            db (DbQuery): Database handler.
+            version (Optional[str]): Version key value read before loading.
+
+        Returns:
+            Catalog: The new current catalog.
+        """
+        tariffs, partners = await asyncio.gather(db.get_tariffs(), db.get_partners())
+        catalog = Catalog(version, tariffs, partners, json.loads(settings.PLANS))
+        self.current = catalog
+        log.info(
+            f"catalog {version} loaded: {len(tariffs)} tariffs, "
+            f"{len(partners)} partners"
+        )
+        return catalog
+
+    async def refresh(self, db: DbQuery, rdb: Redis) -> bool:
+        """
+        Reload the catalog if its version key changed or it is too old.
+
+        Args:
+            db (DbQuery): Database handler.
+            rdb (Redis): Redis client holding the version key.
+
+        Returns:
+            bool: True if a new snapshot was loaded.
+        """
+        version = await rdb.get(settings.CATALOG_VERSION_KEY)
+        current = self.current
+        if (
+            current is not None
+            and current.version == version
+            and time.monotonic() - current.loaded_at < settings.CATALOG_MAX_AGE
+        ):
+            return False
+        await self.load(db, version)
+        return True
+
+    async def _run(self, db: DbQuery, rdb: Redis) -> None:
+        while True:
+            try:
+                await self.refresh(db, rdb)
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                # keep serving the current snapshot
+                log.warning(f"catalog refresh failed {ex!r}")
+            await asyncio.sleep(settings.CATALOG_REFRESH_INTERVAL)
+
+    def start(self, db: DbQuery, rdb: Redis) -> None:
+        """Start the background refresh task, which also loads the catalog."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run(db, rdb))
+
+    async def stop(self) -> None:
+        """Stop the background refresh task."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def tariff(self, db: DbQuery, plan: int | str) -> Optional[TariffsWhPd]:
+        """
+        Tariff of a plan from the catalog, or from the database if the
+        catalog is not loaded yet or lacks it.
+        """
+        if self.current is not None:
+            tariff = self.current.tariff(plan)
+            if tariff is not None:
+                return tariff
+        return await db.get_tariff(plan)
+
+    async def partner(self, db: DbQuery, partner_id: int) -> Optional[Partner]:
+        """
+        Partner from the catalog, or from the database if the catalog is
+        not loaded yet or lacks it (a partner created since the last load).
+        """
+        if self.current is not None:
+            partner = self.current.partner(partner_id)
+            if partner is not None:
+                return partner
+        return await db.get_partner(partner_id)
+
+    def plan(self, days: int | str) -> Optional[Dict[str, Any]]:
+        """Product ids of a plan by payment system, from PLANS."""
+        if self.current is not None:
+            return self.current.plan(days)
+        return json.loads(settings.PLANS)["plans"].get(str(days))
+
+
+async def bump_version(rdb: Redis) -> int:
+    """
+    Tell all backend processes to reload their catalog, after a change
+    of tariffs or partners.
+
+    Args:
+        rdb (Redis): Redis client.
+
+    Returns:
+        int: New version.
+    """
+    return await rdb.incr(settings.CATALOG_VERSION_KEY)
+
+
+catalog = CatalogService()
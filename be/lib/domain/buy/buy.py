@@ -1,15 +1,15 @@
 import json
 import re
-from datetime import datetime
 from typing import Annotated, Optional
 
 from redis.asyncio.client import Redis
 from config_be import settings
 from db.database import DbQuery, db
 from dbm.redis_db import rdb
-from db.schemas import CouponCheck, TariffsWhPd
+from db.schemas import TariffsWhPd
 from fastapi import Depends
 from fastapi.responses import Response
+from lib.catalog import catalog
 from lib.domain.buy.utils import encrypt_cookie_email
 
 from libs.logs import log
@@ -20,7 +20,8 @@ async def tariffs(
     rdb: Annotated[Redis, Depends(rdb)],
 ) -> TariffsWhPd:
     """
-    Retrieve tariffs data from Redis cache or database if cache miss.
+    Retrieve tariffs data from the in-process catalog, or until it is
+    loaded from Redis cache or database if cache miss.
 
     Args:
         db: Database handler to fetch tariffs.
@@ -29,6 +30,9 @@ async def tariffs(
     Returns:
         str: JSON string of tariffs data.
     """
+    if catalog.current is not None:
+        return catalog.current.tariffs_json
+
     result = await rdb.get("tariffs_whox")
 
     if result is None:
@@ -46,7 +50,8 @@ async def check_coupon(
     tariff: Optional[str | None] = None,
 ):
     """
-    Verify if coupon is valid and applicable.
+    Verify if coupon is valid and applicable, with its compiled rule
+    (see db.coupon_rules).
 
     Args:
         db: Database handler for executing queries.
@@ -70,28 +75,8 @@ async def check_coupon(
         log.debug(f"coupon {coupon} has wrong format")
         return 0
 
-    coupon_db = await db.get_coupon(coupon)
-    if coupon_db is None:
-        return 0
-
-    if coupon_db.plans is not None and coupon_db.plans != "" and tariff is not None:
-        plans = [int(pl) for pl in coupon_db.plans.split(",")]
-        if int(tariff) not in plans:
-            return 0
-
-    if (
-        coupon_db.times_used >= coupon_db.max_use_limit
-        and coupon_db.max_use_limit != 0
-        and coupon_db.max_use_limit is not None
-    ):
+    rule = await db.get_coupon_rule(coupon)
+    if rule is None or not rule.valid(tariff):
         return 0
 
-    if coupon_db.expiration < datetime.now():
-        return 0
-
-    result = CouponCheck(
-        percent=coupon_db.percent,
-        prolong=coupon_db.prolong,
-    )
-
-    return result.model_dump()
+    return rule.as_check()
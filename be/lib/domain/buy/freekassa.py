@@ -1,6 +1,5 @@
 import hashlib
 import hmac
-import json
 import time
 from collections import OrderedDict
 from typing import Annotated
@@ -11,6 +10,7 @@ from config_be import settings
 from dbm.redis_db import rdb
 from fastapi import Depends
 from jinja2 import Environment, FileSystemLoader
+from lib.catalog import catalog
 from lib.domain.buy.payment import Payment
 
 from be.db.database import DbQuery, db
@@ -58,7 +58,7 @@ class Freekassa(Payment):
         if "location" not in res_invoice.keys():
             return f"Error: {res_invoice}"
 
-        plans = json.loads(settings.PLANS)["plans"][str(self.trans.days)]
+        plans = catalog.plan(self.trans.days)
         template = env.get_template("payment-freekassa.html")
         data = template.render(
             invoice_url=res_invoice["location"],
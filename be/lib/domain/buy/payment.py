@@ -6,25 +6,30 @@ from typing import Annotated, Optional
 
 from redis.asyncio.client import Redis
 from config_be import settings
+from dbm.db_main import TransactionRolledBack
 from dbm.redis_db import rdb
 from db.schemas import PaymentContext, TransactionFull, TransactionSave
-from dbm.schemas import UserId
+from dbm.schemas import CouponsPd, UserId
 from fastapi import Depends
 from langs.lang import langs
+from lib.catalog import catalog
 from lib.domain.buy.utils import decrypt_cookie_email
 
 from be.db.database import DbQuery, db
 from be.lib.domain.buy.payment_check import CheckMixin
+from libs.coupon_pool import CouponProfile, coupon_pool
 from libs.exceptions import error_404
 from libs.logs import  log
-from libs.send_mail import SendCode
+from libs.send_mail import SendCode, send_code
 from libs.users import insert_mail
 from libs.utils import (
-    generate_coupon_db,
     generate_coupon_or_code,
     get_country_iso,
 )
 
+# coupon given to a user with their first payment
+USER_COUPON = CouponProfile(10, 30)
+
 
 class Payment(ABC, CheckMixin):
     """
@@ -253,7 +258,7 @@ class Payment(ABC, CheckMixin):
             TransactionFull: Updated transaction data with partner amount.
         """
         if user.partner_id is not None:
-            partner = await self.db.get_partner(user.partner_id)
+            partner = await catalog.partner(self.db, user.partner_id)
             trans_data.partner_amount = round(
                 trans_data.amount * partner.commission / 100, 2
             )
@@ -269,15 +274,15 @@ class Payment(ABC, CheckMixin):
         Returns:
             float: Discounted amount rounded to 2 decimals.
         """
-        coupon_db = await self.db.get_coupon(ctx.coupon)
-        plan_db = await self.db.get_tariff(ctx.plan)
+        rule = await self.db.get_coupon_rule(ctx.coupon) if ctx.coupon else None
+        plan_db = await catalog.tariff(self.db, ctx.plan)
 
         print(f"************  Payment calc_amount_with_coupon ctx {ctx}")
 
         amount = float(plan_db.countTextSum)
 
-        if coupon_db is not None:
-            amount *= (100 - coupon_db.percent) / 100
+        if rule is not None:
+            amount = rule.price(amount)
         return round(amount, 2)
 
     async def apply_trans_data_to_user(self, trans: TransactionFull) -> UserId:
@@ -286,6 +291,8 @@ class Payment(ABC, CheckMixin):
 
         This includes setting coupon, extending expiration,
         adjusting trial status, and saving changes to the database.
+        The reads are sent to the primary in one batch, the update and
+        the read back of the user in one transaction.
 
         Args:
             trans: Transaction data to apply.
@@ -293,18 +300,70 @@ class Payment(ABC, CheckMixin):
         Returns:
             Updated user record in the database.
         """
-        user = await self.db.get_user_by_email(trans.email)
+        with self.db.primary():
+            async with self.db.batch() as b:
+                user_item = await b.get_user_by_email(trans.email)
+                coupon_item = await b.get_coupon(trans.coupon)
+        new_coupon = await self.take_user_coupon(user_item.value)
+        user = await self.merge_trans_into_user(
+            trans, user_item.value, coupon_item.value, new_coupon
+        )
+
+        try:
+            async with self.db.transaction() as tx:
+                await tx.update_user_full_finish(user)
+                user_item = await tx.get_user_by_email(user.email)
+        except TransactionRolledBack:
+            await self.give_back_user_coupon(new_coupon)
+            raise
+        return user_item.value
+
+    async def take_user_coupon(self, user: UserId) -> Optional[CouponsPd]:
+        """
+        Take a new coupon for a user who has none yet. It is given back
+        with give_back_user_coupon() if the user is not saved.
+
+        Args:
+            user: User record.
+
+        Returns:
+            Optional[CouponsPd]: The coupon, None if the user has one.
+        """
+        if user.coupon is not None:
+            return None
+        return await coupon_pool.take(self.db, *USER_COUPON)
+
+    async def give_back_user_coupon(self, coupon: Optional[CouponsPd]) -> None:
+        """Give back a coupon of take_user_coupon() the user was not saved with."""
+        if coupon is not None:
+            await coupon_pool.give_back(self.db, USER_COUPON, coupon)
 
+    async def merge_trans_into_user(
+        self,
+        trans: TransactionFull,
+        user: UserId,
+        trans_coupon: Optional[CouponsPd],
+        new_coupon: Optional[CouponsPd] = None,
+    ) -> UserId:
+        """
+        Apply transaction data to the user object without saving it:
+        set code and coupon if missing, extend expiration (with the
+        prolongation of the transaction coupon), adjust trial and plan.
+
+        Args:
+            trans: Transaction data to apply.
+            user: User record to update.
+            trans_coupon: Coupon used in the transaction, if any.
+            new_coupon: Coupon of take_user_coupon(), for a user without one.
+
+        Returns:
+            UserId: The updated user object.
+        """
         if user.code is None:
             user.code = generate_coupon_or_code("KEY")
 
-        if user.coupon is None:
-            coupon = await generate_coupon_db(
-                self.db,
-                10,
-                30,
-            )
-            user.coupon = coupon.coupon
+        if user.coupon is None and new_coupon is not None:
+            user.coupon = new_coupon.coupon
 
         elapsed_time = 0
         now_unix = int(time.time())
@@ -313,24 +372,25 @@ class Payment(ABC, CheckMixin):
         user.expires = now_unix + trans.days * 86400 + elapsed_time
 
         # add coupon with prolongation
-        trans_coupon = await self.db.get_coupon(trans.coupon)
         if trans_coupon is not None and trans_coupon.prolong > 0:
             user.expires += int(trans.days * 86400 * trans_coupon.prolong / 100)
 
         user.trial = user.trial and trans.trial
         user.plan = trans.days
-
-        await self.db.update_user_full_finish(user)
-        user_res = await self.db.get_user_by_email(user.email)
-        return user_res
+        return user
 
     async def full_finish_payment_by_id(self, payment_id) -> None:
         """
         Complete payment process by payment ID.
 
-        Marks the transaction as complete, updates coupon usage,
+        Marks the transaction as complete, counts a use of its coupon
+        (atomically, within the coupon use limit),
         applies transaction data to the user record, and updates
         transaction expiration date. Also triggers sending notification email.
+        The reads are sent to the primary in one batch and all the writes
+        in one transaction, guarded by the transaction still being incomplete:
+        a repeated webhook for a finished payment changes nothing and
+        sends no second email.
 
         Args:
             payment_id: ID of the payment transaction to finalize.
@@ -338,12 +398,42 @@ class Payment(ABC, CheckMixin):
         Returns:
             None
         """
-        trans = await self.db.get_trans_by_id(payment_id)
-        await self.db.update_trans_complete(payment_id)
-        await self.db.update_coupon_times_used(trans.coupon)
-        user = await self.apply_trans_data_to_user(trans)
+        with self.db.primary():
+            async with self.db.batch() as b:
+                trans_item = await b.get_trans_by_id(payment_id)
+                user_item = await b.get_user_by_trans_id(payment_id)
+                coupon_item = await b.get_coupon_by_trans_id(payment_id)
+
+        trans, trans_coupon = trans_item.value, coupon_item.value
+        if trans is None or trans.complete:
+            log.info(f"payment {payment_id} is missing or already finished")
+            return
+        new_coupon = await self.take_user_coupon(user_item.value)
+        user = await self.merge_trans_into_user(
+            trans, user_item.value, trans_coupon, new_coupon
+        )
         trans_expires = datetime.fromtimestamp(user.expires)
-        await self.db.update_trans_expires(trans_expires, payment_id)
+
+        try:
+            async with self.db.transaction() as tx:
+                with tx.expect_rows(1):
+                    await tx.update_trans_complete(payment_id, pending_only=True)
+                if trans_coupon is not None:
+                    coupon_item = await tx.update_coupon_times_used(trans.coupon)
+                await tx.update_user_full_finish(user)
+                await tx.update_trans_expires(trans_expires, payment_id)
+                user_item = await tx.get_user_by_email(user.email)
+        except TransactionRolledBack as ex:
+            # the user was not saved with the new coupon
+            await self.give_back_user_coupon(new_coupon)
+            if ex.index != 0:
+                raise
+            log.info(f"payment {payment_id} already finished concurrently")
+            return
+        if trans_coupon is not None and coupon_item.value is None:
+            log.warning(f"payment {payment_id}: coupon {trans.coupon} is used up")
+
+        user = user_item.value
         await send_code(user, self.db, langs(user.lang, "email.subjects.access"))
 
 
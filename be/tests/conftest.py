@@ -6,6 +6,7 @@ from pathlib import Path
 from typing import AsyncGenerator, List
 
 from redis import asyncio as aioredis
+import config
 import httpx
 import pytest
 import pytest_asyncio
@@ -15,8 +16,11 @@ from db.database import DbQuery
 from db.database import dbq as db
 from db.schemas import FreekassaConfirmData, PaymentContext
 from dbm.database import TransactionFull, User
+from dbm.grpc_pool import pool
+from dbm.local_server import LocalDbService, serve, server_port
 from fastapi import Request
 from lib.domain.buy.freekassa import Freekassa
+from libs.coupon_pool import RELEASE_LOCK
 from tests.test_cls import TsPayment
 
 sys.path.append(str(Path(__file__).parents[1]))
@@ -133,6 +137,29 @@ async def test_payment(request_emulated: Request, rd: Redis) -> TsPayment:
     return test_payment
 
 
+@pytest_asyncio.fixture()
+async def local_db(
+    monkeypatch: pytest.MonkeyPatch,
+) -> AsyncGenerator[LocalDbService, None]:
+    """
+    Start the local SQLite DB service and point the shared channel pool
+    to it for the duration of the test, without the Redis user cache,
+    coupon filter, coupon pool and coupon rule cache
+    """
+    monkeypatch.setattr(config.settings, "USER_CACHE_TTL", 0)
+    monkeypatch.setattr(config.settings, "COUPON_FILTER", False)
+    monkeypatch.setattr(config.settings, "COUPON_POOL_SIZE", 0)
+    monkeypatch.setattr(settings, "COUPON_RULES_TTL", 0)
+    server, service = await serve(port=0)
+    host, port, size = pool.host, pool.port, pool.size
+    pool.configure("127.0.0.1", server_port(server))
+    yield service
+    pool.configure(host, port, size)
+    server.close()
+    await server.wait_closed()
+    service.db.close()
+
+
 @pytest_asyncio.fixture()
 async def test_client() -> AsyncGenerator[httpx.AsyncClient, None]:
     """creates and yield client for http requests"""
@@ -241,3 +268,112 @@ def freekassa_confirm_trans_mock() -> TransactionFull:
         email=settings.TEST_EMAIL,
         amount=20,
     )
+
+
+class MemoryPipeline:
+    """Pipeline of MemoryRedis, running the queued commands on execute"""
+
+    def __init__(self, redis: "MemoryRedis") -> None:
+        self.redis = redis
+        self.commands: list = []
+
+    async def __aenter__(self) -> "MemoryPipeline":
+        return self
+
+    async def __aexit__(self, *exc: object) -> None:
+        pass
+
+    def __getattr__(self, name: str):
+        command = getattr(self.redis, name)
+        return lambda *args, **kwargs: self.commands.append(command(*args, **kwargs))
+
+    async def execute(self) -> list:
+        return [await command for command in self.commands]
+
+
+class MemoryRedis:
+    """The few Redis commands of the Redis caches and coupon pool, in memory"""
+
+    def __init__(self) -> None:
+        self.data: dict = {}
+
+    async def get(self, key: str) -> str | None:
+        return self.data.get(key)
+
+    async def set(
+        self, key: str, value: str, ex: int | None = None, nx: bool = False
+    ) -> bool | None:
+        if nx and key in self.data:
+            return None
+        self.data[key] = value
+        return True
+
+    async def delete(self, key: str) -> None:
+        self.data.pop(key, None)
+
+    async def exists(self, key: str) -> int:
+        return int(key in self.data)
+
+    async def incrby(self, key: str, amount: int) -> int:
+        self.data[key] = str(int(self.data.get(key, 0)) + amount)
+        return int(self.data[key])
+
+    async def incr(self, key: str) -> int:
+        return await self.incrby(key, 1)
+
+    async def expire(self, key: str, seconds: int) -> bool:
+        return key in self.data
+
+    async def eval(self, script: str, numkeys: int, *args: str) -> int:
+        # only the compare-and-delete of the coupon pool refill lock
+        assert script == RELEASE_LOCK and numkeys == 1
+        key, token = args
+        if self.data.get(key) != token:
+            return 0
+        del self.data[key]
+        return 1
+
+    async def rename(self, key: str, new: str) -> None:
+        self.data[new] = self.data.pop(key)
+
+    async def getbit(self, key: str, offset: int) -> int:
+        bitmap = self.data.get(key, b"")
+        if offset >> 3 >= len(bitmap):
+            return 0
+        return int(bool(bitmap[offset >> 3] & 0x80 >> (offset & 7)))
+
+    async def setbit(self, key: str, offset: int, value: int) -> int:
+        old = await self.getbit(key, offset)
+        bitmap = bytearray(self.data.get(key, b""))
+        bitmap.extend(bytes(max(0, (offset >> 3) + 1 - len(bitmap))))
+        if value:
+            bitmap[offset >> 3] |= 0x80 >> (offset & 7)
+        else:
+            bitmap[offset >> 3] &= ~(0x80 >> (offset & 7)) & 0xFF
+        self.data[key] = bytes(bitmap)
+        return old
+
+    async def lpop(self, key: str, count: int | None = None):
+        items = self.data.get(key, [])
+        popped, self.data[key] = items[: count or 1], items[count or 1 :]
+        if count is None:
+            return popped[0] if popped else None
+        return popped or None
+
+    async def lpush(self, key: str, *values: str) -> None:
+        self.data[key] = list(reversed(values)) + self.data.get(key, [])
+
+    async def rpush(self, key: str, *values: str) -> None:
+        self.data[key] = self.data.get(key, []) + list(values)
+
+    async def llen(self, key: str) -> int:
+        return len(self.data.get(key, []))
+
+    def pipeline(self, transaction: bool = True) -> MemoryPipeline:
+        return MemoryPipeline(self)
+
+
+@pytest.fixture()
+def memory_redis() -> MemoryRedis:
+    """In-memory stand-in of the Redis client of the DB layer caches"""
+    return MemoryRedis()
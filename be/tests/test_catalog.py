@@ -0,0 +1,63 @@
+import asyncio
+import json
+
+import pytest
+from config_be import settings
+from db.database import dbq as db
+from lib.catalog import CatalogService, bump_version
+
+from dbm.local_server import LocalDbService
+
+
+@pytest.mark.asyncio
+async def test_local_db_catalog_lookups(local_db: LocalDbService) -> None:
+    """Catalog lookups of a loaded snapshot cost no database call"""
+    local_db.db.execute(
+        "INSERT INTO tariffs_wh (id, month, count, economy, popular, countTextSum,"
+        " date, countText) VALUES ('3', '1', '1', '0', '1', '9.9', '30', '9.9')"
+    )
+    catalogs = CatalogService()
+    assert (await catalogs.tariff(db, 30)).countTextSum == "9.9"
+    loaded = await catalogs.load(db, "1")
+    calls = len(local_db.requests)
+    assert (await catalogs.tariff(db, "30")) is loaded.tariff(30)
+    assert catalogs.plan(180) is not None
+    assert json.loads(loaded.tariffs_json)[0]["date"] == "30"
+    assert len(local_db.requests) == calls
+    # a tariff missing from the snapshot is looked up in the database
+    assert await catalogs.tariff(db, 999) is None
+    assert len(local_db.requests) == calls + 1
+
+
+@pytest.mark.asyncio
+async def test_local_db_catalog_refresh(
+    local_db: LocalDbService, monkeypatch: pytest.MonkeyPatch, memory_redis
+) -> None:
+    """A version bump swaps in a new snapshot, readers keep the old one"""
+    local_db.db.execute(
+        "INSERT INTO tariffs_wh (id, month, count, economy, popular, countTextSum,"
+        " date, countText) VALUES ('3', '1', '1', '0', '1', '9.9', '30', '9.9')"
+    )
+    catalogs = CatalogService()
+    assert await catalogs.refresh(db, memory_redis)
+    calls = len(local_db.requests)
+    assert not await catalogs.refresh(db, memory_redis)
+    assert len(local_db.requests) == calls
+    old = catalogs.current
+
+    local_db.db.execute("UPDATE tariffs_wh SET countTextSum = '12.9'")
+    assert await bump_version(memory_redis) == 1
+    local_db.latency = 0.05
+    refresh = asyncio.create_task(catalogs.refresh(db, memory_redis))
+    await asyncio.sleep(0.01)
+    assert catalogs.current is old
+    assert await refresh
+    assert catalogs.current is not old
+    assert catalogs.current.version == "1"
+    assert (await catalogs.tariff(db, 30)).countTextSum == "12.9"
+    assert old.tariff(30).countTextSum == "9.9"
+
+    # a snapshot older than CATALOG_MAX_AGE is reloaded too
+    local_db.latency = 0.0
+    monkeypatch.setattr(settings, "CATALOG_MAX_AGE", 0)
+    assert await catalogs.refresh(db, memory_redis)
@@ -0,0 +1,196 @@
+import time
+from datetime import datetime, timedelta
+
+import pytest
+from config_be import settings
+from db.database import dbq as db
+from lib.domain.buy.payment import USER_COUPON, PaymentAll
+
+import config
+from dbm.local_server import LocalDbService
+from dbm.schemas import TransactionFull, User
+from libs.coupon_pool import MAX_STALE_POPS, CouponPool, CouponProfile
+
+
+@pytest.mark.asyncio
+async def test_local_db_coupon_pool(
+    local_db: LocalDbService,
+    monkeypatch: pytest.MonkeyPatch,
+    memory_redis,
+) -> None:
+    """Coupons are popped from pools refilled by demand, stale ones dropped"""
+    monkeypatch.setattr(config.settings, "COUPON_POOL_PROFILES", ["10:30"])
+    monkeypatch.setattr(config.settings, "COUPON_POOL_SIZE", 5)
+    pool = CouponPool(memory_redis)
+    profile = CouponProfile(10, 30)
+    assert CouponProfile.parse("35:1:180,360") == (35, 1, "180,360")
+
+    # no takes yet: nothing is stocked, takes insert their coupon
+    calls = len(local_db.requests)
+    assert await pool.refill(db, profile) == 0
+    for _ in range(3):
+        assert (await pool.take(db, 10, 30)).percent == 10
+    assert len(local_db.requests) == calls + 3
+
+    # the pool is refilled up to the takes of the window
+    calls = len(local_db.requests)
+    assert await pool.refill(db, profile) == 3
+    assert len(local_db.requests) == calls + 1
+    coupon = await pool.take(db, 10, 30)
+    assert len(local_db.requests) == calls + 1
+    assert (await db.get_coupon(coupon.coupon)).percent == 10
+    assert coupon.expiration - coupon.created == timedelta(days=30)
+    assert await pool.refill(db, profile) == 2
+    assert await pool.refill(db, profile) == 0
+    assert len(await pool.take_many(db, profile, 2)) == 2
+    assert await pool.refill(db, profile) == 3
+    assert await pool.refill(db, profile) == 0
+
+    # other profiles and empty pools insert their coupon
+    calls = len(local_db.requests)
+    assert (await pool.take(db, 35, 1, "180,360")).plans == "180,360"
+    assert len(await pool.take_many(db, profile, 7)) == 5
+    assert (await pool.take(db, 10, 30)).percent == 10
+    assert len(local_db.requests) == calls + 2
+
+    # the stale coupons of a pool are deleted before it is refilled
+    await pool.refill(db, profile)
+    monkeypatch.setattr(config.settings, "COUPON_POOL_MAX_AGE_SHARE", -1)
+    stale = memory_redis.data[pool.key(profile)][0].split(":")[0]
+    assert await pool.refill(db, profile) == 5
+    assert await db.get_coupon(stale) is None
+
+
+@pytest.mark.asyncio
+async def test_local_db_coupon_pool_stale_takes(
+    local_db: LocalDbService,
+    monkeypatch: pytest.MonkeyPatch,
+    memory_redis,
+) -> None:
+    """Stale coupons popped by takers are deleted, not left in the table"""
+    monkeypatch.setattr(config.settings, "COUPON_POOL_PROFILES", ["10:30"])
+    monkeypatch.setattr(config.settings, "COUPON_POOL_SIZE", 3)
+    pool = CouponPool(memory_redis)
+    profile = CouponProfile(10, 30)
+    await pool.take_many(db, profile, 3)
+
+    async def stale_codes() -> list:
+        monkeypatch.setattr(config.settings, "COUPON_POOL_MAX_AGE_SHARE", 0.1)
+        assert await pool.refill(db, profile) == 3
+        monkeypatch.setattr(config.settings, "COUPON_POOL_MAX_AGE_SHARE", -1)
+        return [e.split(":")[0] for e in memory_redis.data[pool.key(profile)]]
+
+    codes = await stale_codes()
+    assert (await pool.take(db, 10, 30)).coupon not in codes
+    assert memory_redis.data[pool.key(profile)] == []
+    for code in codes:
+        assert await db.get_coupon(code) is None
+
+    codes = await stale_codes()
+    assert await pool.take_many(db, profile, 3) == []
+    for code in codes:
+        assert await db.get_coupon(code) is None
+
+
+@pytest.mark.asyncio
+async def test_local_db_coupon_pool_give_back(
+    local_db: LocalDbService,
+    monkeypatch: pytest.MonkeyPatch,
+    memory_redis,
+) -> None:
+    """A payment rolled back gives back the coupon taken for its user"""
+    monkeypatch.setattr(config.settings, "COUPON_POOL_PROFILES", ["10:30"])
+    monkeypatch.setattr(config.settings, "COUPON_POOL_SIZE", 3)
+    pool = CouponPool(memory_redis)
+    monkeypatch.setattr("lib.domain.buy.payment.coupon_pool", pool)
+    await pool.take_many(db, USER_COUPON, 3)
+    assert await pool.refill(db, USER_COUPON) == 3
+    entries = list(memory_redis.data[pool.key(USER_COUPON)])
+
+    # the payment is finished concurrently between its reads and its writes
+    sent = []
+
+    async def send_code(user, *args):
+        sent.append(user)
+
+    monkeypatch.setattr("lib.domain.buy.payment.send_code", send_code)
+    await db.create_user(User(email=settings.TEST_EMAIL, code="KEY", plan=0))
+    trans = await db.insert_transaction(
+        TransactionFull(
+            email=settings.TEST_EMAIL,
+            system="freekassa",
+            days=30,
+            amount=9.9,
+            created=datetime.now(),
+            expires=datetime.now() + timedelta(days=3),
+            trial=False,
+            complete=False,
+        )
+    )
+    payment = PaymentAll(db)
+    merge = payment.merge_trans_into_user
+
+    async def merge_concurrently(*args):
+        await db.update_trans_complete(trans.id)
+        return await merge(*args)
+
+    monkeypatch.setattr(payment, "merge_trans_into_user", merge_concurrently)
+    await payment.full_finish_payment_by_id(trans.id)
+    assert sent == []
+    assert (await db.get_user_by_email(settings.TEST_EMAIL)).coupon is None
+    assert memory_redis.data[pool.key(USER_COUPON)] == entries
+
+    # without a pool, the coupon is deleted
+    coupon = await pool.take(db, 35, 1)
+    await pool.give_back(db, CouponProfile(35, 1), coupon)
+    assert await db.get_coupon(coupon.coupon) is None
+
+
+@pytest.mark.asyncio
+async def test_local_db_coupon_pool_many_stale(
+    local_db: LocalDbService,
+    monkeypatch: pytest.MonkeyPatch,
+    memory_redis,
+) -> None:
+    """A take gives up after MAX_STALE_POPS stale entries without losing one"""
+    monkeypatch.setattr(config.settings, "COUPON_POOL_PROFILES", ["10:30"])
+    monkeypatch.setattr(config.settings, "COUPON_POOL_SIZE", 3)
+    pool = CouponPool(memory_redis)
+    profile = CouponProfile(10, 30)
+    stale = [f"OLD{i}:0" for i in range(MAX_STALE_POPS + 2)]
+    fresh = f"FRESH:{int(time.time())}"
+    await memory_redis.rpush(pool.key(profile), *stale, fresh)
+
+    assert (await pool.take(db, 10, 30)).coupon != "FRESH"
+    assert memory_redis.data[pool.key(profile)] == stale[MAX_STALE_POPS:] + [fresh]
+    assert (await pool.take(db, 10, 30)).coupon == "FRESH"
+    assert memory_redis.data[pool.key(profile)] == []
+
+
+@pytest.mark.asyncio
+async def test_local_db_coupon_pool_refill_lock(
+    local_db: LocalDbService,
+    monkeypatch: pytest.MonkeyPatch,
+    memory_redis,
+) -> None:
+    """A refill releases its own lock only, not one taken after it expired"""
+    monkeypatch.setattr(config.settings, "COUPON_POOL_PROFILES", ["10:30"])
+    monkeypatch.setattr(config.settings, "COUPON_POOL_SIZE", 3)
+    pool = CouponPool(memory_redis)
+    profile = CouponProfile(10, 30)
+    lock = f"{pool.key(profile)}:refill"
+    await pool.take_many(db, profile, 3)
+    assert await pool.refill(db, profile) == 3
+    assert lock not in memory_redis.data
+
+    drop_stale = pool._drop_stale
+
+    async def slow_drop_stale(*args) -> None:
+        # the lock expired and another process took it meanwhile
+        memory_redis.data[lock] = "other"
+        await drop_stale(*args)
+
+    monkeypatch.setattr(pool, "_drop_stale", slow_drop_stale)
+    await pool.refill(db, profile)
+    assert memory_redis.data[lock] == "other"
+    assert await pool.refill(db, profile) == 0
@@ -0,0 +1,81 @@
+import time
+from datetime import datetime, timedelta
+
+import pytest
+from config_be import settings
+from db.coupon_rules import CouponRule, CouponRules
+from db.database import dbq as db
+from lib.domain.buy.buy import check_coupon
+
+from dbm.local_server import LocalDbService
+from dbm.models import Coupons
+from dbm.schemas import CouponsPd
+
+
+@pytest.mark.asyncio
+async def test_local_db_coupon_rules(
+    local_db: LocalDbService, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Coupons are checked and priced with one cached, compiled rule"""
+    monkeypatch.setattr(settings, "COUPON_RULES_TTL", 30)
+    db.coupon_rules.clear()
+    expiration = datetime.now().replace(microsecond=0) + timedelta(days=1)
+    row = dict(
+        coupon="RULE",
+        percent=20,
+        expiration=expiration,
+        plans="30,90",
+        max_use_limit=1,
+        prolong=0,
+    )
+    await db.insert_many(Coupons, [row])
+    calls = len(local_db.requests)
+    assert await check_coupon(db, "RULE", "30") == {"percent": 20, "prolong": 0}
+    assert await check_coupon(db, "rule", "7") == 0
+    rule = await db.get_coupon_rule("RULE")
+    assert rule.plans == frozenset({30, 90})
+    assert rule.price(100.0) == 80.0
+    assert len(local_db.requests) == calls + 1
+
+    # counting the last use drops the rule, the next check reloads it
+    assert await db.update_coupon_times_used("RULE") == 1
+    assert await check_coupon(db, "RULE", "30") == 0
+    assert len(local_db.requests) == calls + 3
+
+
+def test_coupon_rules_eviction(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Rules expire after the TTL, the oldest is dropped when the cache is full"""
+    monkeypatch.setattr(settings, "COUPON_RULES_TTL", 30)
+    monkeypatch.setattr(settings, "COUPON_RULES_MAX_SIZE", 2)
+    clock = [1000.0]
+    monkeypatch.setattr(time, "monotonic", lambda: clock[0])
+    expiration = datetime.now() + timedelta(days=1)
+    rules = CouponRules()
+
+    def put(code: str) -> CouponRule:
+        return rules.put(CouponsPd(coupon=code, percent=10, expiration=expiration))
+
+    first = put("FIRST")
+    assert rules.get(" first ") is first
+    put("SECOND")
+    clock[0] += 10
+    third = put("THIRD")
+    assert rules.get("FIRST") is None
+    assert rules.get("SECOND") is not None
+    assert rules.get("THIRD") is third
+
+    # a rule put again is renewed and becomes the newest
+    second = put("SECOND")
+    put("FOURTH")
+    assert rules.get("THIRD") is None
+    assert rules.get("SECOND") is second
+
+    clock[0] += 29
+    assert rules.get("SECOND") is second
+    clock[0] += 1
+    assert rules.get("SECOND") is None
+    assert rules.get("FOURTH") is None
+
+    monkeypatch.setattr(settings, "COUPON_RULES_TTL", 0)
+    put("OFF")
+    assert rules.get("OFF") is None
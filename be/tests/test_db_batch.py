@@ -0,0 +1,78 @@
+import json
+from datetime import datetime
+
+import pytest
+from config_be import settings
+from db.database import dbq as db
+from sqlalchemy import insert, select, update
+
+from dbm.db_main import request_batch
+from dbm.local_server import LocalDbService
+from dbm.models import Coupons, Users
+from dbm.schemas import CouponsPd, InsertResult, User, UserId
+
+
+@pytest.mark.asyncio
+async def test_local_db_batch_values(local_db: LocalDbService) -> None:
+    """Statements run in their order, each item gets its own value"""
+    user = await db.create_user(User(email=settings.TEST_EMAIL, plan=30))
+    now = datetime.now().replace(microsecond=0)
+    calls = len(local_db.requests)
+    async with db.batch() as b:
+        missing = await b.get_coupon("BATCH")
+        inserted = await b.result_insert(
+            insert(Coupons).values(coupon="BATCH", percent=5, expiration=now)
+        )
+        coupon = await b.get_coupon("BATCH")
+        used = await b.increment(Coupons.times_used, Coupons.coupon == "BATCH")
+        users = await b.result(select(Users).order_by(Users.id), UserId)
+        nobody = await b.get_user_by_email("none@example.com")
+        assert missing.value is None and users.value is None
+
+    assert len(local_db.requests) == calls + 1
+    request = local_db.requests[-1]
+    assert request["rpc"] == "batch"
+    assert len(request["sql"]) == 6
+    assert "INSERT" in request["sql"][1] and "UPDATE" in request["sql"][3]
+    assert missing.value is None
+    assert isinstance(inserted.value, InsertResult)
+    assert inserted.value.rows_affected == 1
+    assert isinstance(coupon.value, CouponsPd) and coupon.value.percent == 5
+    assert used.value == 1
+    assert [u.id for u in users.value] == [user.id]
+    assert nobody.value is None
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("atomic", [False, True])
+async def test_local_db_batch_raising_block(
+    local_db: LocalDbService, atomic: bool
+) -> None:
+    """A block raising sends none of the statements recorded in it"""
+    await db.create_user(User(email=settings.TEST_EMAIL, plan=30))
+    calls = len(local_db.requests)
+    with pytest.raises(ValueError):
+        async with db.transaction() if atomic else db.batch() as b:
+            await b.result(update(Users).values(plan=0))
+            await b.delete_user(settings.TEST_EMAIL)
+            raise ValueError("stop")
+    assert len(local_db.requests) == calls
+    assert (await db.get_user_by_email(settings.TEST_EMAIL)).plan == 30
+
+
+@pytest.mark.asyncio
+async def test_local_db_request_batch(local_db: LocalDbService) -> None:
+    """request_batch() answers every query in order"""
+    coupon = CouponsPd(coupon="RAW", percent=5, expiration=datetime(2038, 1, 1))
+    response = await request_batch(
+        [
+            db.sql_text_(insert(Coupons).values(db.coupon_values(coupon))),
+            "SELECT coupon, percent FROM coupons",
+            "UPDATE coupons SET percent = 7 WHERE percent = 5",
+            "SELECT count(*) AS n FROM coupons WHERE percent = 5",
+        ]
+    )
+    assert not response.rolled_back
+    assert response.rows_affected[0] == 1 and response.rows_affected[2] == 1
+    assert json.loads(response.test_res[1]) == [{"coupon": "RAW", "percent": 5}]
+    assert json.loads(response.test_res[3]) == [{"n": 0}]
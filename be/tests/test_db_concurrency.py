@@ -0,0 +1,73 @@
+import asyncio
+import json
+import random
+import re
+
+import pytest
+import pytest_asyncio
+from db.database import dbq
+from grpclib.server import Server
+
+import grpc_lib
+from dbm.grpc_pool import pool
+from dbm.schemas import CouponsPd, TransactionFull, UserId
+from grpc_lib import EndpointResponse
+
+
+class EchoService(grpc_lib.TestBase):
+    """
+    DB service answering every select with one row of the queried table
+    whose key column echoes the value of the WHERE clause, after a
+    random delay so that concurrent calls complete out of order.
+    """
+
+    async def test(self, test, encoding, parameterized, params):
+        await asyncio.sleep(random.uniform(0, 0.005))
+        value = re.search(r"= '?([^' ]+)'?", test).group(1)
+        if "FROM users" in test:
+            row = {"id": 1, "email": value}
+        elif "FROM coupons" in test:
+            row = {"coupon": value, "percent": 10}
+        else:
+            row = {"id": int(value), "email": "echo@example.com"}
+        return EndpointResponse(test_res=json.dumps([row]))
+
+
+@pytest_asyncio.fixture()
+async def echo_db():
+    """Point the shared channel pool to a local echo DB service"""
+    server = Server([EchoService()])
+    await server.start("127.0.0.1", 0)
+    port = server._server.sockets[0].getsockname()[1]
+    host, port_, size = pool.host, pool.port, pool.size
+    pool.configure("127.0.0.1", port)
+    yield dbq
+    pool.configure(host, port_, size)
+    server.close()
+    await server.wait_closed()
+
+
+@pytest.mark.asyncio
+async def test_shared_dbq_concurrent_mixed_queries(echo_db) -> None:
+    """
+    Concurrent mixed queries on the process-wide DbQuery are parsed
+    into the model of their own query.
+    """
+
+    async def user(i):
+        res = await echo_db.get_user_by_email(f"user{i}@example.com")
+        assert type(res) is UserId
+        assert res.email == f"user{i}@example.com"
+
+    async def coupon(i):
+        res = await echo_db.get_coupon(f"CPN{i}")
+        assert type(res) is CouponsPd
+        assert res.coupon == f"CPN{i}"
+
+    async def trans(i):
+        res = await echo_db.get_trans_by_id(i)
+        assert type(res) is TransactionFull
+        assert res.id == i
+
+    calls = [random.choice((user, coupon, trans))(i) for i in range(1, 501)]
+    await asyncio.gather(*calls)
@@ -0,0 +1,128 @@
+from datetime import datetime
+
+import pytest
+from db.database import dbq as db
+
+import config
+from dbm.coupon_filter import CouponFilter, bit_positions
+from dbm.local_server import LocalDbService
+from dbm.schemas import CouponsPd
+
+
+@pytest.mark.asyncio
+async def test_local_db_coupon_filter(
+    local_db: LocalDbService,
+    monkeypatch: pytest.MonkeyPatch,
+    memory_redis,
+) -> None:
+    """Missing coupons are answered by the filter or the negative cache"""
+    monkeypatch.setattr(config.settings, "COUPON_FILTER", True)
+    coupon_filter = CouponFilter(memory_redis, bits=4096, hashes=3)
+    monkeypatch.setattr(type(db), "coupon_filter", coupon_filter)
+    assert bit_positions("Code", 4096, 3) == bit_positions(" code", 4096, 3)
+    now = datetime.now().replace(microsecond=0)
+    await db.insert_coupon(CouponsPd(coupon="REAL", percent=5, expiration=now))
+
+    # no filter yet: a miss is queried once, then negative cached
+    calls = len(local_db.requests)
+    assert await db.get_coupon("LATER") is None
+    assert await db.get_coupon("LATER") is None
+    assert len(local_db.requests) == calls + 1
+
+    async def codes():
+        yield "REAL"
+
+    assert await coupon_filter.rebuild(codes()) == 1
+    calls = len(local_db.requests)
+    assert await db.get_coupon("GUESSED") is None
+    assert len(local_db.requests) == calls
+    with db.primary():
+        assert await db.get_coupon("GUESSED") is None
+    assert len(local_db.requests) == calls + 1
+    assert (await db.get_coupon("REAL")).percent == 5
+
+    # an insert adds the code and drops it from the negative cache
+    await db.insert_coupon(CouponsPd(coupon="LATER", percent=7, expiration=now))
+    assert (await db.get_coupon("LATER")).percent == 7
+
+
+@pytest.mark.asyncio
+async def test_local_db_coupon_filter_race(
+    local_db: LocalDbService,
+    monkeypatch: pytest.MonkeyPatch,
+    memory_redis,
+) -> None:
+    """A miss stored after an insert of the code does not hide the coupon"""
+    monkeypatch.setattr(config.settings, "COUPON_FILTER", True)
+    coupon_filter = CouponFilter(memory_redis, bits=4096, hashes=3)
+    monkeypatch.setattr(type(db), "coupon_filter", coupon_filter)
+
+    # a lookup misses the code, which is inserted before the miss is stored
+    assert await coupon_filter.may_exist("RACE")
+    assert await db.get_coupon("RACE") is None
+    now = datetime.now().replace(microsecond=0)
+    await db.insert_coupon(CouponsPd(coupon="RACE", percent=3, expiration=now))
+    await coupon_filter.checked("RACE", False)
+    assert (await db.get_coupon("RACE")).percent == 3
+
+
+@pytest.mark.asyncio
+async def test_local_db_coupon_filter_add_failure(
+    local_db: LocalDbService,
+    monkeypatch: pytest.MonkeyPatch,
+    memory_redis,
+) -> None:
+    """A failed add deletes the filter, or fails the insert if it cannot"""
+    monkeypatch.setattr(config.settings, "COUPON_FILTER", True)
+    coupon_filter = CouponFilter(memory_redis, bits=4096, hashes=3)
+    monkeypatch.setattr(type(db), "coupon_filter", coupon_filter)
+
+    async def codes():
+        yield "REAL"
+
+    await coupon_filter.rebuild(codes())
+    assert not await coupon_filter.may_exist("NEW")
+    failures = []
+    pipeline = memory_redis.pipeline
+
+    def failing_pipeline(transaction: bool = True):
+        pipe = pipeline(transaction)
+        if failures:
+            failures.pop()
+
+            async def execute() -> list:
+                for command in pipe.commands:
+                    command.close()
+                raise ConnectionError("redis down")
+
+            pipe.execute = execute
+        return pipe
+
+    monkeypatch.setattr(memory_redis, "pipeline", failing_pipeline)
+    now = datetime.now().replace(microsecond=0)
+
+    # the filter is deleted: every code goes to the database until a rebuild
+    failures.append(1)
+    await db.insert_coupon(CouponsPd(coupon="NEW", percent=4, expiration=now))
+    assert not await memory_redis.exists(coupon_filter.key)
+    assert (await db.get_coupon("NEW")).percent == 4
+
+    # the filter cannot be deleted either: the coupon is not inserted
+    await coupon_filter.rebuild(codes())
+    failures.extend([1, 1])
+    with pytest.raises(ConnectionError):
+        await db.insert_coupon(CouponsPd(coupon="LOST", percent=4, expiration=now))
+    assert await memory_redis.exists(coupon_filter.key)
+    with db.primary():
+        assert await db.get_coupon("LOST") is None
+
+
+@pytest.mark.asyncio
+async def test_memory_redis_setbit(memory_redis) -> None:
+    """The Redis fake sets and clears bits and returns the previous bit"""
+    assert await memory_redis.setbit("bits", 10, 1) == 0
+    assert await memory_redis.setbit("bits", 11, 1) == 0
+    assert await memory_redis.setbit("bits", 10, 0) == 1
+    assert await memory_redis.getbit("bits", 10) == 0
+    assert await memory_redis.getbit("bits", 11) == 1
+    assert memory_redis.data["bits"] == b"\x00\x10"
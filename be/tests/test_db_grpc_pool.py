@@ -0,0 +1,153 @@
+import asyncio
+import socket
+import time
+from typing import AsyncGenerator
+
+import pytest
+import pytest_asyncio
+
+import grpc_lib
+from dbm.grpc_pool import ChannelPool
+from dbm.local_server import serve, server_port
+from dbm.metrics import POOL_RECONNECTS
+
+
+def free_port() -> int:
+    """Port nothing listens on"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@pytest_asyncio.fixture()
+async def service_port() -> AsyncGenerator[int, None]:
+    """Port of a local DB service"""
+    server, service = await serve(port=0)
+    yield server_port(server)
+    server.close()
+    await server.wait_closed()
+    service.db.close()
+
+
+async def query(pool: ChannelPool) -> str:
+    async with pool.channel() as channel:
+        return (await grpc_lib.TestStub(channel).test(test="SELECT 1 AS one")).test_res
+
+
+@pytest.mark.asyncio
+async def test_channel_pool_least_loaded(service_port: int) -> None:
+    """Calls go to the channel with the fewest calls in flight"""
+    pool = ChannelPool("127.0.0.1", service_port, size=3, health_interval=0)
+    async with pool.channel() as first, pool.channel() as second:
+        assert first is not second
+        async with pool.channel() as third:
+            assert third not in (first, second)
+            assert pool.stats()["in_flight"] == 3
+        async with pool.channel() as again:
+            assert again is third
+    assert pool.stats() == {"channels": 3, "healthy": 3, "in_flight": 0}
+    assert await query(pool) == '[{"one": 1}]'
+    await pool.close()
+
+
+@pytest.mark.asyncio
+async def test_channel_pool_backoff() -> None:
+    """A broken channel is skipped for an exponential, capped backoff"""
+    pool = ChannelPool(
+        "127.0.0.1", free_port(), size=2, health_interval=0, backoff_max=3.0
+    )
+    with pytest.raises(OSError):
+        await query(pool)
+    broken = next(pc for pc in pool._channels if pc.failures)
+    assert pool.stats()["healthy"] == 1
+    for _ in range(3):
+        async with pool.channel() as channel:
+            assert channel is not broken.channel
+
+    pool.backoff_min = 1.0
+    for delay in (2.0, 3.0, 3.0):
+        pool._mark_failed(broken)
+        assert delay / 2 <= broken.retry_at - time.monotonic() <= delay
+        assert not broken.healthy
+    with pytest.raises(OSError):
+        await query(pool)
+    # all channels backing off: calls still go out
+    async with pool.channel() as channel:
+        assert channel in [pc.channel for pc in pool._channels]
+    await pool.close()
+
+
+@pytest.mark.asyncio
+async def test_channel_pool_health_loop(service_port: int) -> None:
+    """Broken channels are reconnected once their backoff expired"""
+    endpoint = f"127.0.0.1:{service_port}"
+    reconnects = POOL_RECONNECTS.labels(endpoint, "ok")._value.get()
+    pool = ChannelPool(
+        "127.0.0.1", service_port, size=2, health_interval=0.01, backoff_min=0.02
+    )
+    assert await query(pool) == '[{"one": 1}]'
+    broken = pool._channels[0]
+    pool._mark_failed(broken)
+    assert pool.stats()["healthy"] == 1
+    for _ in range(100):
+        await asyncio.sleep(0.01)
+        if not broken.failures:
+            break
+    assert pool.stats()["healthy"] == 2
+    assert POOL_RECONNECTS.labels(endpoint, "ok")._value.get() == reconnects + 1
+    await pool.close()
+
+    # an endpoint still down backs off again
+    pool = ChannelPool(
+        "127.0.0.1", free_port(), size=1, health_interval=0.01, backoff_min=0.01
+    )
+    with pytest.raises(OSError):
+        await query(pool)
+    await asyncio.sleep(0.1)
+    assert pool._channels[0].failures > 1
+    await pool.close()
+
+
+@pytest.mark.asyncio
+async def test_channel_pool_health_probe() -> None:
+    """Healthy channels whose connection stopped answering are marked broken"""
+    # accepts connections and never answers, like a half-open connection
+    server = await asyncio.start_server(lambda r, w: None, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    pool = ChannelPool(
+        "127.0.0.1", port, size=2, health_interval=0.01, probe_timeout=0.05
+    )
+    pool._ensure()
+    assert pool.stats()["healthy"] == 2
+    for _ in range(100):
+        await asyncio.sleep(0.01)
+        if not pool.stats()["healthy"]:
+            break
+    assert pool.stats()["healthy"] == 0
+    await pool.close()
+    server.close()
+    await server.wait_closed()
+
+
+def test_channel_pool_per_event_loop() -> None:
+    """Channels and the health checker are rebuilt in every event loop"""
+    port = free_port()
+    pool = ChannelPool("127.0.0.1", port, size=2, health_interval=60)
+
+    async def run() -> tuple:
+        server, service = await serve(port=port)
+        try:
+            assert await query(pool) == '[{"one": 1}]'
+        finally:
+            server.close()
+            await server.wait_closed()
+            service.db.close()
+        return asyncio.get_running_loop(), list(pool._channels), pool._health_task
+
+    first_loop, first_channels, first_task = asyncio.run(run())
+    second_loop, second_channels, second_task = asyncio.run(run())
+    assert first_loop is not second_loop
+    assert len(second_channels) == 2
+    assert not set(first_channels) & set(second_channels)
+    assert first_task is not second_task and first_task.done()
+    assert pool._loop is second_loop
@@ -0,0 +1,255 @@
+import asyncio
+import time
+from datetime import datetime, timedelta
+
+import pytest
+from config_be import settings
+from db.database import dbq as db
+from lib.domain.buy.payment import PaymentAll
+
+import config
+import grpc_lib
+from dbm.db_main import TransactionRolledBack
+from dbm.grpc_pool import ChannelPool, router
+from dbm.local_server import LocalDbService, serve, server_port
+from dbm.metrics import REPLICA_LAG
+from dbm.models import Coupons, Users
+from dbm.schemas import CouponsPd, TransactionFull, User, UserId
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("parameterized", [False, True])
+async def test_local_db_insert_and_read(
+    local_db: LocalDbService, parameterized: bool, monkeypatch
+) -> None:
+    """Insert ids and reads through the local DB service, in both SQL modes"""
+    monkeypatch.setattr(config.settings, "GRPC_PARAMETERIZED", parameterized)
+    user = await db.create_user(User(email=settings.TEST_EMAIL, code="50%'off"))
+    assert user.id == 1
+    user_db = await db.get_user_by_email(settings.TEST_EMAIL.upper())
+    assert user_db.id == user.id
+    assert user_db.code == "50%'off"
+
+    trans = await db.insert_transaction(
+        TransactionFull(
+            email=settings.TEST_EMAIL,
+            system="freekassa",
+            days=30,
+            amount=9.9,
+            created=datetime.now(),
+            expires=datetime.now() + timedelta(days=30),
+            trial=False,
+            complete=False,
+        )
+    )
+    await db.update_trans_complete(trans.id)
+    trans_db = await db.get_trans_by_id(trans.id)
+    assert trans_db.complete is True
+    assert trans_db.amount == trans.amount
+    assert local_db.requests[-1]["rpc"] == "test"
+    if parameterized:
+        assert local_db.db.stats()["prepared"] > 0
+
+
+@pytest.mark.asyncio
+async def test_local_db_transaction_rolls_back(local_db: LocalDbService) -> None:
+    """A failed row count guard rolls back the statements before it"""
+    user = await db.create_user(User(email=settings.TEST_EMAIL, plan=30))
+    with pytest.raises(TransactionRolledBack) as ex:
+        async with db.transaction() as tx:
+            await tx.delete_user(user.email)
+            with tx.expect_rows(1):
+                await tx.update_trans_complete(404, pending_only=True)
+    assert ex.value.index == 1
+    assert (await db.get_user_by_email(user.email)).id == user.id
+
+
+@pytest.mark.asyncio
+async def test_local_db_finish_payment_once(
+    local_db: LocalDbService, monkeypatch
+) -> None:
+    """Finishing a payment twice applies it and sends the email once"""
+    sent = []
+
+    async def send_code(user, *args):
+        sent.append(user)
+
+    monkeypatch.setattr("lib.domain.buy.payment.send_code", send_code)
+    user = await db.create_user(
+        User(email=settings.TEST_EMAIL, code="KEY", plan=0, trial=True)
+    )
+    user.coupon = "OWN10"
+    await db.update_user_full_finish(user)
+    trans = await db.insert_transaction(
+        TransactionFull(
+            email=settings.TEST_EMAIL,
+            system="freekassa",
+            days=30,
+            amount=9.9,
+            created=datetime.now(),
+            expires=datetime.now() + timedelta(days=3),
+            trial=False,
+            complete=False,
+        )
+    )
+    payment = PaymentAll(db)
+    await payment.full_finish_payment_by_id(trans.id)
+    await payment.full_finish_payment_by_id(trans.id)
+
+    assert len(sent) == 1
+    assert sent[0].plan == 30
+    assert (await db.get_trans_by_id(trans.id)).complete is True
+    assert len([r for r in local_db.requests if r.get("atomic")]) == 1
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("lag", [0.0, 60.0])
+async def test_local_db_replica_routing(local_db: LocalDbService, lag: float) -> None:
+    """Reads go to a replica in sync, writes and lagging reads to the primary"""
+    server, replica = await serve(port=0, replica_lag=lag)
+    router.configure(f"127.0.0.1:{server_port(server)}")
+    try:
+        await router.check_lag()
+        endpoint = router.replicas[0].pool.endpoint
+        assert REPLICA_LAG.labels(endpoint)._value.get() == lag
+
+        user = await db.create_user(User(email=settings.TEST_EMAIL, plan=30))
+        with db.primary():
+            assert (await db.get_user_by_email(user.email)).id == user.id
+        user_db = await db.get_user_by_email(user.email)
+        if lag > router.max_lag:
+            assert user_db.id == user.id
+            assert len(replica.requests) == 0
+        else:
+            # the stand-in replica does not replicate: the read missed
+            assert user_db is None
+            assert replica.requests[-1]["sql"][0].startswith("SELECT")
+    finally:
+        await router.close()
+        router.configure("")
+        server.close()
+        await server.wait_closed()
+        replica.db.close()
+
+
+@pytest.mark.asyncio
+async def test_local_db_coalesce_identical_reads(local_db: LocalDbService) -> None:
+    """Concurrent identical tariff reads share one call to the service"""
+    local_db.db.execute(
+        "INSERT INTO tariffs_wh (id, month, count, economy, popular, countTextSum,"
+        " date, countText) VALUES ('3', '1', '1', '0', '1', '9.9', '30', '9.9')"
+    )
+    local_db.latency = 0.02
+    calls = len(local_db.requests)
+    tariffs = await asyncio.gather(*[db.get_tariff(30) for _ in range(50)])
+    assert {t.countTextSum for t in tariffs} == {"9.9"}
+    assert len({id(t) for t in tariffs}) == 50
+    assert len(local_db.requests) == calls + 1
+    assert [t.date for t in await db.get_tariffs()] == ["30"]
+
+
+@pytest.mark.asyncio
+async def test_local_db_scoped_identity_map(local_db: LocalDbService) -> None:
+    """Repeated key lookups of a request cost one call, writes invalidate them"""
+    scoped = db.scoped()
+    user = await scoped.create_user(User(email=settings.TEST_EMAIL, plan=30))
+    calls = len(local_db.requests)
+    first = await scoped.get_user_by_email(settings.TEST_EMAIL)
+    second = await scoped.get_user_by_email(settings.TEST_EMAIL)
+    assert first == second and first is not second
+    assert await scoped.get_coupon("NONE") is None
+    assert await scoped.get_coupon("NONE") is None
+    assert len(local_db.requests) == calls + 2
+
+    user.plan = 90
+    async with scoped.transaction() as tx:
+        await tx.update_user_full_finish(user)
+    assert (await scoped.get_user_by_email(settings.TEST_EMAIL)).plan == 90
+    assert len(local_db.requests) == calls + 4
+    assert await db.scoped().get_coupon("NONE") is None
+    assert len(local_db.requests) == calls + 5
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("prefetch", [False, True])
+async def test_local_db_iterate_keyset_pages(
+    local_db: LocalDbService, prefetch: bool
+) -> None:
+    """iterate() walks matching rows in key order, one page per call"""
+    for i in range(25):
+        await db.create_user(User(email=f"user{i}@example.com", plan=i % 2))
+    calls = len(local_db.requests)
+    users = [
+        user
+        async for user in db.iterate(
+            Users, Users.plan == 1, page_size=4, data_class=UserId, prefetch=prefetch
+        )
+    ]
+    assert [u.id for u in users] == list(range(2, 26, 2))
+    # three full pages of 4 rows and a last empty one
+    assert len(local_db.requests) == calls + 4
+    assert "id > 24" in local_db.requests[-1]["sql"][0].replace("`", "")
+
+
+@pytest.mark.asyncio
+async def test_local_db_insert_coupons_many(local_db: LocalDbService) -> None:
+    """Coupons are inserted by multi-row statements in one round trip"""
+    now = datetime.now().replace(microsecond=0)
+    coupons = [
+        CouponsPd(coupon=f"BULK{i}", percent=25, created=now, expiration=now)
+        for i in range(7)
+    ]
+    rows = [db.coupon_values(c) for c in coupons]
+    calls = len(local_db.requests)
+    assert await db.insert_many(Coupons, rows, chunk_size=3) == 7
+    assert len(local_db.requests) == calls + 1
+    assert len(local_db.requests[-1]["sql"]) == 3
+    assert (await db.get_coupon("BULK6")).percent == 25
+    assert await db.insert_coupons_many([]) == 0
+    assert len(local_db.requests) == calls + 2
+
+
+@pytest.mark.asyncio
+async def test_local_db_coupon_uses_atomic(local_db: LocalDbService) -> None:
+    """Concurrent coupon uses are counted on the server within the limit"""
+    now = datetime.now().replace(microsecond=0)
+    row = dict(coupon="LIMITED", percent=10, expiration=now, max_use_limit=2)
+    await db.insert_many(Coupons, [row])
+    calls = len(local_db.requests)
+    used = await asyncio.gather(
+        *[db.update_coupon_times_used("LIMITED") for _ in range(4)]
+    )
+    assert sorted(used, key=str) == [1, 2, None, None]
+    assert len(local_db.requests) == calls + 4
+    assert await db.release_coupon_use("LIMITED") == 1
+    async with db.transaction() as tx:
+        item = await tx.update_coupon_times_used("LIMITED")
+    assert item.value == 2
+    assert (await db.get_coupon("LIMITED")).times_used == 2
+    assert await db.update_coupon_times_used("NONE") is None
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("concurrency", [0, 1])
+async def test_local_db_concurrency_slots(concurrency: int) -> None:
+    """Statements take query_time each while holding a concurrency slot"""
+    server, service = await serve(port=0, query_time=0.1, concurrency=concurrency)
+    channels = ChannelPool("127.0.0.1", server_port(server), health_interval=0)
+
+    async def query() -> None:
+        async with channels.channel() as channel:
+            await grpc_lib.TestStub(channel).test(test="SELECT 1")
+
+    try:
+        started = time.perf_counter()
+        await asyncio.gather(*(query() for _ in range(4)))
+        elapsed = time.perf_counter() - started
+    finally:
+        await channels.close()
+        server.close()
+        await server.wait_closed()
+        service.db.close()
+    if concurrency:
+        assert elapsed >= 4 * 0.1
+    else:
+        assert 0.1 <= elapsed < 3 * 0.1
@@ -0,0 +1,127 @@
+from datetime import datetime
+from decimal import Decimal
+from typing import List
+
+import pytest
+from db.schemas import Partner
+from pydantic import BaseModel, Field, PrivateAttr
+
+from dbm.materialize import construct_rows
+from dbm.schemas import CouponsPd, TransactionFull, UserId
+
+WHEN = datetime(2024, 11, 13, 10, 30, 15)
+TEXT = "2024-11-13 10:30:15"
+
+# rows as the DB service sends them: columnar (typed) and JSON (text)
+ROWS = [
+    (
+        UserId,
+        {
+            "id": 7,
+            "email": "user@example.com",
+            "code": "KEY",
+            "coupon": None,
+            "plan": 30,
+            "expires": 1731493815,
+            "trial": True,
+            "cn": "u7",
+            "partner_id": 0,
+            "subscribed": True,
+            "dubious": 0,
+            "note": "",
+        },
+    ),
+    (UserId, {"id": "7", "email": "user@example.com", "trial": 0, "plan": "0"}),
+    (
+        TransactionFull,
+        {
+            "id": 1,
+            "email": "user@example.com",
+            "days": 30,
+            "amount": Decimal("9.90"),
+            "created": WHEN,
+            "expires": WHEN,
+            "trial": False,
+            "complete": True,
+            "partner_amount": None,
+            "refund": 0,
+        },
+    ),
+    (
+        TransactionFull,
+        {"id": "2", "amount": "9.9", "created": TEXT, "complete": 1, "refund": "0"},
+    ),
+    (
+        CouponsPd,
+        {
+            "coupon": "OWN10",
+            "percent": 10,
+            "max_use_limit": 0,
+            "times_used": 3,
+            "manual": 1,
+            "created": WHEN,
+            "expiration": WHEN,
+            "plans": "30,180",
+        },
+    ),
+    (
+        CouponsPd,
+        {
+            "coupon": "ZERO",
+            "percent": "5",
+            "created": TEXT,
+            "expiration": "0000-00-00 00:00:00",
+        },
+    ),
+    (CouponsPd, {"coupon": "TEXT", "percent": 5, "expiration": TEXT}),
+    (
+        Partner,
+        {
+            "id": 3,
+            "created": WHEN,
+            "password": "secret",
+            "commission": 20,
+            "description": "partner",
+            "lang": "ru",
+        },
+    ),
+    (
+        Partner,
+        {
+            "id": "3",
+            "created": TEXT,
+            "password": "secret",
+            "commission": "20",
+            "description": "",
+            "lang": "ru",
+        },
+    ),
+]
+
+
+@pytest.mark.parametrize("data_class, row", ROWS)
+def test_construct_rows_matches_validation(data_class, row: dict) -> None:
+    """The trusted path builds the models model_validate() builds"""
+    (built,) = construct_rows(data_class, [dict(row, extra_column=1)])
+    validated = data_class.model_validate(row)
+    assert built.model_dump() == validated.model_dump()
+    assert {k: type(v) for k, v in built.model_dump().items()} == {
+        k: type(v) for k, v in validated.model_dump().items()
+    }
+    assert built.model_fields_set == validated.model_fields_set
+
+
+class Tagged(BaseModel):
+    """Model with a default factory and a private attribute"""
+
+    id: int
+    tags: List[str] = Field(default_factory=list)
+    _seen: int = PrivateAttr(default=0)
+
+
+def test_construct_rows_defaults_and_private() -> None:
+    """Missing fields get their defaults, private attributes are set up"""
+    (built,) = construct_rows(Tagged, [{"id": "5"}])
+    assert built.id == 5 and built.tags == [] and built._seen == 0
+    assert built.model_fields_set == {"id"}
+    assert built == Tagged.model_validate({"id": 5})
@@ -0,0 +1,61 @@
+import pytest
+from app.stats import slow_query_shapes
+from config_be import settings
+from db.database import dbq as db
+from prometheus_client import REGISTRY
+
+import config
+from dbm import db_main
+from dbm.local_server import LocalDbService
+from dbm.schemas import User
+from dbm.slow_queries import slow_queries
+from dbm.statement_metrics import StatementMetrics
+
+
+@pytest.mark.asyncio
+async def test_local_db_statement_metrics(
+    local_db: LocalDbService, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Calls are measured by statement fingerprint and calling method"""
+    monkeypatch.setattr(db_main, "statement_metrics", StatementMetrics(2))
+    await db.create_user(User(email=settings.TEST_EMAIL, plan=30))
+    for email in (settings.TEST_EMAIL, "none@example.com"):
+        await db.get_user_by_email(email)
+    await db.get_coupon("NONE")
+
+    def samples(name: str) -> dict:
+        return {
+            (s.labels["fingerprint"], s.labels["caller"]): s.value
+            for m in REGISTRY.collect()
+            for s in m.samples
+            if s.name == name
+        }
+
+    rows = samples("db_statement_rows_sum")
+    counts = samples("db_statement_rows_count")
+    key = next(k for k in rows if k[1] == "DbQueryMixin.get_user_by_email")
+    assert key[0].startswith("select:users:")
+    assert counts[key] >= 2 and rows[key] >= 1
+    # the third label pair is past the bound of 2
+    assert counts[("other", "other")] >= 1
+
+
+@pytest.mark.asyncio
+async def test_local_db_slow_query_journal(
+    local_db: LocalDbService, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Slow calls are journaled by shape, redacted, with their caller"""
+    monkeypatch.setattr(config.settings, "SLOW_QUERY_SECONDS", 0.01)
+    monkeypatch.setattr(config.settings, "SLOW_QUERY_SAMPLE_RATE", 1.0)
+    slow_queries.clear()
+    await db.get_coupon("FAST")
+    local_db.latency = 0.02
+    await db.get_coupon("SECRET1")
+    await db.get_coupon("SECRET2")
+
+    (shape,) = await slow_query_shapes(limit=5)
+    assert shape.fingerprint.startswith("select:coupons:")
+    assert shape.slow_calls == 2 and shape.max_seconds >= 0.02
+    assert shape.baseline_seconds < 0.01
+    assert shape.callers == ["DbQueryMixin.get_coupon"]
+    assert "SECRET" not in shape.sql and "?" in shape.sql
@@ -0,0 +1,90 @@
+import asyncio
+
+import grpclib
+import pytest
+import pytest_asyncio
+from db.database import dbq as db
+from grpclib.server import Server
+from sqlalchemy import select
+
+from config import settings
+from dbm.grpc_pool import pool
+from dbm.local_server import LocalDatabase, LocalDbService, server_port
+from dbm.metrics import BREAKER_REJECTIONS
+from dbm.models import Users
+from dbm.schemas import User, UserId
+from libs.exceptions import MyCustomException
+
+
+class FlakyService(LocalDbService):
+    """Local DB service failing every other call as unavailable"""
+
+    calls = 0
+
+    async def test(self, test, encoding, parameterized, params):
+        self.calls += 1
+        if self.calls % 2 == 1:
+            raise grpclib.GRPCError(grpclib.const.Status.UNAVAILABLE, "flaky")
+        return await super().test(test, encoding, parameterized, params)
+
+
+@pytest_asyncio.fixture()
+async def flaky_db():
+    """Point the shared channel pool to a flaky local DB service"""
+    service = FlakyService(LocalDatabase(), latency=0.0)
+    server = Server([service])
+    await server.start("127.0.0.1", 0)
+    host, port, size = pool.host, pool.port, pool.size
+    pool.configure("127.0.0.1", server_port(server))
+    yield service
+    pool.configure(host, port, size)
+    server.close()
+    await server.wait_closed()
+    service.db.close()
+
+
+@pytest.mark.asyncio
+async def test_reads_retried_writes_not(flaky_db: FlakyService, monkeypatch) -> None:
+    """A failed read is retried, a failed insert is not"""
+    monkeypatch.setattr(settings, "GRPC_RETRY_BACKOFF", 0.0)
+    assert await db.get_user_by_email(settings.TEST_EMAIL) is None
+    assert flaky_db.calls == 2
+    with pytest.raises(grpclib.GRPCError):
+        await db.create_user(User(email=settings.TEST_EMAIL))
+    assert flaky_db.calls == 3
+
+
+@pytest.mark.asyncio
+async def test_deadline_opens_breaker(local_db: LocalDbService, monkeypatch) -> None:
+    """Calls to a stalled service time out, then fail fast with a 503"""
+    monkeypatch.setattr(settings, "GRPC_TIMEOUT", 0.05)
+    monkeypatch.setattr(settings, "GRPC_READ_RETRIES", 0)
+    local_db.latency = 1.0
+    for _ in range(settings.GRPC_BREAKER_FAILURES):
+        with pytest.raises((TimeoutError, grpclib.GRPCError)):
+            await db.get_user_by_email(settings.TEST_EMAIL)
+    with pytest.raises(MyCustomException) as ex:
+        await db.get_user_by_email(settings.TEST_EMAIL)
+    assert ex.value.status_code == 503
+    assert BREAKER_REJECTIONS.labels(pool.endpoint)._value.get() == 1
+
+
+@pytest.mark.asyncio
+async def test_stream_deadline_per_message(
+    local_db: LocalDbService, monkeypatch
+) -> None:
+    """A slow consumer outlasts the stream timeout, a stalled service not"""
+    monkeypatch.setattr(settings, "GRPC_READ_RETRIES", 0)
+    for i in range(8):
+        await db.create_user(User(email=f"slow{i}@example.com"))
+    emails = []
+    async for user in db.stream(select(Users), UserId, chunk_size=1, timeout=0.1):
+        await asyncio.sleep(0.03)
+        emails.append(user.email)
+    assert len(emails) == 8
+
+    local_db.latency = 0.5
+    with pytest.raises(grpclib.GRPCError) as ex:
+        async for user in db.stream(select(Users), UserId, timeout=0.1):
+            pass
+    assert ex.value.status == grpclib.const.Status.DEADLINE_EXCEEDED
@@ -0,0 +1,45 @@
+from datetime import date, datetime, timedelta, timezone
+from decimal import Decimal
+
+import pytest
+
+from dbm.row_codec import decode_columns, encode_columns
+from grpc_lib import ColumnType
+
+NOW = datetime(2024, 11, 13, 10, 30, 15, 250)
+
+
+@pytest.mark.parametrize(
+    "values, type_, expected",
+    [
+        ([1, -2, 2**40, None], ColumnType.INT, None),
+        (["a", "50%'off", "юникод", "", None], ColumnType.STRING, None),
+        ([NOW, None, datetime(1969, 7, 20)], ColumnType.DATETIME, None),
+        ([date(2024, 1, 2)], ColumnType.DATETIME, [datetime(2024, 1, 2)]),
+        ([Decimal("9.90"), Decimal("-1"), 3, None], ColumnType.DECIMAL, None),
+        ([True, False, None], ColumnType.BOOL, None),
+        ([None, None], ColumnType.NULL, None),
+        ([1.5, -0.25, None], ColumnType.FLOAT, None),
+        ([1, 2.5], ColumnType.FLOAT, None),
+        ([True, 0, 7, None], ColumnType.INT, [1, 0, 7, None]),
+        ([1, "a"], ColumnType.STRING, ["1", "a"]),
+        ([b"xy", b"\x00\xff", b"", None], ColumnType.BYTES, None),
+        (["a", "é".encode()], ColumnType.STRING, ["a", "é"]),
+    ],
+)
+def test_row_codec_round_trip(values: list, type_: ColumnType, expected) -> None:
+    """Columns of each type decode to the values encoded"""
+    result = encode_columns([{"id": i, "value": v} for i, v in enumerate(values)])
+    assert result.columns[1].type == type_
+    rows = decode_columns(result)
+    assert [r["value"] for r in rows] == (values if expected is None else expected)
+    assert [r["id"] for r in rows] == list(range(len(values)))
+
+
+def test_row_codec_empty_and_aware() -> None:
+    """No rows give no columns, aware datetimes decode as naive UTC"""
+    assert decode_columns(encode_columns([])) == []
+    moscow = timezone(timedelta(hours=3))
+    rows = [{"created": NOW.replace(tzinfo=moscow)}]
+    created = decode_columns(encode_columns(rows))[0]["created"]
+    assert created == NOW - timedelta(hours=3)
@@ -0,0 +1,75 @@
+from datetime import datetime
+from decimal import Decimal
+
+import pytest
+from sqlalchemy import func, insert, select, update
+from sqlalchemy.dialects import mysql
+
+from dbm.models import Coupons, Transactions, Users
+from dbm.sql_cache import SqlTemplateCache
+
+WHEN = datetime(2024, 11, 13, 10, 30, 15)
+
+
+def literal_binds(statement) -> str:
+    """SQL text of the uncached path of DbMain.sql_text_()"""
+    compiled = statement.compile(
+        dialect=mysql.dialect(), compile_kwargs={"literal_binds": True}
+    )
+    return str(compiled) % compiled.params
+
+
+def statements(code: str) -> list:
+    """Statements of every shape, with code as their string value"""
+    active = select(Users.email).where(Users.plan > 0).scalar_subquery()
+    return [
+        select(Users).where(Users.email == code),
+        select(Coupons).where(Coupons.coupon.like(f"{code}%")),
+        select(Users.id).where(Users.email == code).limit(5).offset(10),
+        update(Users).where(Users.email == code).values(coupon=code, trial=True),
+        update(Coupons)
+        .where(Coupons.coupon == code)
+        .values(times_used=Coupons.times_used + 1),
+        select(Transactions).where(
+            Transactions.email == active,
+            Transactions.amount > Decimal("9.90"),
+            Transactions.created < WHEN,
+        ),
+        select(func.count()).select_from(Users).where(Users.code == code),
+        insert(Coupons).values(coupon=code, percent=10, expiration=WHEN),
+    ]
+
+
+@pytest.mark.parametrize(
+    "code",
+    ["plain", "50%'off", "back\\slash", "%%", 'quote"s', "юникод", "a_b"],
+)
+def test_sql_cache_matches_literal_binds(code: str) -> None:
+    """Cached renders are the SQL text of a literal_binds compile"""
+    cache = SqlTemplateCache(size=64)
+    for shape in ("first", code):
+        for statement in statements(shape):
+            assert cache.render(statement) == literal_binds(statement)
+    for statement in statements(code):
+        assert cache.render(statement) == literal_binds(statement)
+    count = len(statements(code))
+    assert cache.stats() == {
+        "size": count,
+        "hits": 2 * count,
+        "misses": count,
+        "bypasses": 0,
+    }
+
+
+def test_sql_cache_bypass() -> None:
+    """Expanded in_() lists and multi-row inserts are not cached"""
+    cache = SqlTemplateCache(size=64)
+    rows = [{"coupon": c, "percent": 10} for c in ("A", "B'")]
+    for statement in (
+        select(Users).where(Users.email.in_(["a@b.c", "d'e@f.g"])),
+        insert(Coupons).values(rows),
+    ):
+        assert cache.render(statement) is None
+        assert cache.render(statement) is None
+    assert cache.stats()["bypasses"] == 4
+    assert cache.stats()["hits"] == 0
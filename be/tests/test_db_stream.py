@@ -0,0 +1,94 @@
+import importlib
+import time
+from pathlib import Path
+from types import ModuleType
+
+import pytest
+from db.database import dbq as db
+from sqlalchemy import select
+
+from dbm.db_main import DbMain
+from dbm.local_server import LocalDbService
+from dbm.models import Users
+from dbm.schemas import User, UserId
+
+
+@pytest.fixture()
+def chunks(monkeypatch: pytest.MonkeyPatch) -> list:
+    """Sizes of the chunks parsed by DbMain.result_list()"""
+    sizes = []
+    result_list = DbMain.result_list
+
+    async def counted(self, chunk, *args, **kwargs):
+        rows = await result_list(self, chunk, *args, **kwargs)
+        sizes.append(len(rows))
+        return rows
+
+    monkeypatch.setattr(DbMain, "result_list", counted)
+    return sizes
+
+
+@pytest.fixture()
+def cron_utils(monkeypatch: pytest.MonkeyPatch) -> ModuleType:
+    """crontabs.lib.utils, which reads its texts from the crontabs directory"""
+    monkeypatch.chdir(Path(__file__).parents[2] / "crontabs")
+    return importlib.import_module("crontabs.lib.utils")
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("encoding", ["json", "columnar"])
+async def test_local_db_stream_chunks(
+    local_db: LocalDbService, chunks: list, encoding: str
+) -> None:
+    """Rows arrive in order, in chunks of at most chunk_size rows"""
+    for i in range(7):
+        await db.create_user(User(email=f"stream{i}@example.com"))
+    statement = select(Users).order_by(Users.id)
+    users = [
+        user async for user in db.stream(statement, UserId, 3, encoding, trusted=True)
+    ]
+    assert [u.email for u in users] == [f"stream{i}@example.com" for i in range(7)]
+    assert all(isinstance(u, UserId) for u in users)
+    assert chunks == [3, 3, 1]
+    assert local_db.requests[-1]["rpc"] == "stream"
+    assert local_db.requests[-1]["rows"] == 7
+
+
+@pytest.mark.asyncio
+async def test_local_db_stream_early_break(
+    local_db: LocalDbService, chunks: list
+) -> None:
+    """A consumer stopping early ends the call without reading the rest"""
+    for i in range(20):
+        await db.create_user(User(email=f"stream{i}@example.com"))
+    stream = db.stream(select(Users).order_by(Users.id), UserId, chunk_size=2)
+    async for user in stream:
+        break
+    await stream.aclose()
+    assert user.email == "stream0@example.com"
+    assert chunks == [2]
+    assert (await db.get_user_by_email("stream19@example.com")).id == 20
+
+
+@pytest.mark.asyncio
+async def test_local_db_stream_emails(
+    local_db: LocalDbService, cron_utils: ModuleType
+) -> None:
+    """Reminder users are streamed with their token, a missing one skipped"""
+    expires = int(time.time())
+    await db.create_user(User(email="due@example.com", expires=expires))
+    await db.create_user(User(email="later@example.com", expires=expires * 2))
+
+    async def reminded(email=None, no_unsubscribe=None) -> list:
+        emails = cron_utils.stream_emails(email)
+        return [u async for u in cron_utils.stream_users(emails, no_unsubscribe)]
+
+    users = await reminded()
+    assert [u.email for u in users] == ["due@example.com"]
+    token = cron_utils.get_unsubscribe_token("due@example.com")
+    assert users[0].unsubscribe_token == token
+    assert await reminded("none@example.com") == []
+    users = await reminded("later@example.com", no_unsubscribe=True)
+    assert [(u.email, u.unsubscribe_token) for u in users] == [
+        ("later@example.com", "")
+    ]
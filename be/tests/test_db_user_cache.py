@@ -0,0 +1,42 @@
+import pytest
+from config_be import settings
+from db.database import dbq as db
+from prometheus_client import REGISTRY
+
+import config
+from dbm.local_server import LocalDbService
+from dbm.schemas import User
+from dbm.user_cache import UserCache
+
+
+@pytest.mark.asyncio
+async def test_local_db_user_cache(
+    local_db: LocalDbService,
+    monkeypatch: pytest.MonkeyPatch,
+    memory_redis,
+) -> None:
+    """Users are read through the cache, writes drop their entry"""
+    monkeypatch.setattr(config.settings, "USER_CACHE_TTL", 60)
+    monkeypatch.setattr(type(db), "user_cache", UserCache(memory_redis))
+    hits = REGISTRY.get_sample_value("db_user_cache_requests_total", {"result": "hit"})
+    user = await db.create_user(User(email=settings.TEST_EMAIL, plan=30))
+    calls = len(local_db.requests)
+    cached = await db.get_user_by_email(settings.TEST_EMAIL.upper())
+    assert cached == user
+    assert len(local_db.requests) == calls
+    with db.primary():
+        await db.get_user_by_email(settings.TEST_EMAIL)
+    assert len(local_db.requests) == calls + 1
+
+    user.plan = 90
+    async with db.transaction() as tx:
+        await tx.update_user_full_finish(user)
+    assert (await db.get_user_by_email(settings.TEST_EMAIL)).plan == 90
+    assert (await db.get_user_by_email(settings.TEST_EMAIL)).plan == 90
+    assert len(local_db.requests) == calls + 3
+    await db.delete_user(settings.TEST_EMAIL)
+    assert await db.get_user_by_email(settings.TEST_EMAIL) is None
+    assert (
+        REGISTRY.get_sample_value("db_user_cache_requests_total", {"result": "hit"})
+        == (hits or 0) + 2
+    )
@@ -0,0 +1,61 @@
+"""
+Queries/sec of DbQuery lookups against the local SQLite DB service with
+a simulated network round trip, sequential and concurrent, with literal
+SQL text and with parameterized queries.
+
+Run from the repository root:
+    python bench/db_roundtrip.py [--latency 0.001] [--queries 2000]
+"""
+
+import argparse
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parents[1]))
+
+from config import settings  # noqa: E402
+from dbm.database import dbq  # noqa: E402
+from dbm.grpc_pool import pool  # noqa: E402
+from dbm.local_server import serve, server_port  # noqa: E402
+from dbm.schemas import User  # noqa: E402
+
+
+async def queries_per_sec(queries: int, concurrency: int) -> float:
+    async def worker(n: int) -> None:
+        for i in range(n):
+            await dbq.get_user_by_email(f"user{i % 100}@example.com")
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(queries // concurrency) for _ in range(concurrency)))
+    return queries / (time.perf_counter() - start)
+
+
+async def main(args: argparse.Namespace) -> None:
+    server, service = await serve(
+        port=0, latency=args.latency, concurrency=args.db_concurrency
+    )
+    pool.configure("127.0.0.1", server_port(server))
+    for i in range(100):
+        await dbq.create_user(User(email=f"user{i}@example.com"))
+
+    print(f"latency {args.latency * 1000:.1f} ms, {args.queries} queries")
+    print(f"{'mode':<16}{'concurrency':>12}{'queries/s':>12}")
+    for parameterized in (False, True):
+        settings.GRPC_PARAMETERIZED = parameterized
+        mode = "parameterized" if parameterized else "literal"
+        for concurrency in (1, 10, 100):
+            qps = await queries_per_sec(args.queries, concurrency)
+            print(f"{mode:<16}{concurrency:>12}{qps:>12,.0f}")
+    print(service.db.stats())
+    await pool.close()
+    server.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--latency", type=float, default=0.001)
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--db-concurrency", type=int, default=0)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,121 @@
+"""
+Rows/sec of DbMain.result_list() with full validation and with the
+trusted (model_construct) path, on rows shaped like the DB service
+JSON responses.
+
+Run from the repository root:
+    python bench/result_list.py [rows]
+"""
+
+import asyncio
+import json
+import sys
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Type
+
+from pydantic import BaseModel
+
+sys.path.insert(0, str(Path(__file__).parents[1]))
+
+from dbm.db_main import DbMain  # noqa: E402
+from dbm.schemas import CouponsPd, TransactionFull, UserId  # noqa: E402
+
+
+def user_row(i: int) -> Dict[str, Any]:
+    return {
+        "id": i,
+        "email": f"user{i}@example.com",
+        "lang": "en",
+        "code": f"CODE{i:09d}",
+        "expires": 1700000000 + i,
+        "trial": i % 2,
+        "plan": 30,
+        "created": "2023-11-14 22:13:20",
+        "coupon": None,
+        "subscription": 0,
+        "unsubscribe": 0,
+    }
+
+
+def trans_row(i: int) -> Dict[str, Any]:
+    return {
+        "id": i,
+        "system": "freekassa",
+        "data": "{}",
+        "days": 30,
+        "amount": 9.9,
+        "email": f"user{i}@example.com",
+        "created": "2023-11-14 22:13:20",
+        "expires": "2023-12-14 22:13:20",
+        "trial": 0,
+        "coupon": None,
+        "version_page": 1,
+        "country_iso": "US",
+        "complete": 1,
+        "partner_id": 0,
+        "partner_amount": 0.0,
+        "partner_referrer_id": 0,
+        "pushed_by": None,
+        "remote_amount": 9.9,
+        "check_order_id": 0,
+        "pay_time": 0,
+        "remote_status": "OK",
+        "credited": None,
+        "json_custom_fields": None,
+        "remote_invoice_id": f"inv{i}",
+        "refund": 0,
+        "status": "OK",
+    }
+
+
+def coupon_row(i: int) -> Dict[str, Any]:
+    return {
+        "coupon": f"CPN{i:08d}",
+        "max_use_limit": 1,
+        "percent": 20,
+        "prolong": 0,
+        "times_used": 0,
+        "manual": 0,
+        "created": "2023-11-14 22:13:20",
+        "expiration": "0000-00-00 00:00:00" if i % 10 == 0 else "2024-11-14 22:13:20",
+        "plans": "30,180",
+    }
+
+
+async def rows_per_sec(
+    db: DbMain,
+    res: str,
+    data_class: Type[BaseModel],
+    rows: int,
+    trusted: bool,
+    repeat: int = 5,
+) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await db.result_list(res, data_class, trusted)
+        best = min(best, time.perf_counter() - start)
+    return rows / best
+
+
+async def main(rows: int) -> None:
+    db = DbMain()
+    cases: List[tuple] = [
+        (UserId, user_row),
+        (TransactionFull, trans_row),
+        (CouponsPd, coupon_row),
+    ]
+    print(f"{'schema':<16}{'validated':>14}{'trusted':>14}{'speedup':>10}")
+    for data_class, make_row in cases:
+        res = json.dumps([make_row(i) for i in range(rows)])
+        validated = await rows_per_sec(db, res, data_class, rows, trusted=False)
+        trusted = await rows_per_sec(db, res, data_class, rows, trusted=True)
+        print(
+            f"{data_class.__name__:<16}{validated:>14,.0f}{trusted:>14,.0f}"
+            f"{trusted / validated:>9.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000))
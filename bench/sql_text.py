@@ -0,0 +1,78 @@
+"""
+Microseconds per DbMain.sql_text_() call with the SQL template cache
+and with a literal-binds compile on every call (the cache disabled),
+for a few query shapes of DbQueryMixin.
+
+Run from the repository root:
+    python bench/sql_text.py [calls]
+"""
+
+import sys
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Callable
+
+sys.path.insert(0, str(Path(__file__).parents[1]))
+
+from sqlalchemy import and_, select, update  # noqa: E402
+from sqlalchemy.sql import Executable  # noqa: E402
+
+from dbm.db_main import DbMain  # noqa: E402
+from dbm.models import Coupons, Transactions, Users  # noqa: E402
+from dbm.sql_cache import sql_cache  # noqa: E402
+
+
+def get_user_by_email(i: int) -> Executable:
+    return select(Users).where(Users.email == f"user{i}@example.com").limit(1)
+
+
+def get_trans_by_email(i: int) -> Executable:
+    return (
+        select(Transactions)
+        .where(Transactions.email == f"user{i}@example.com")
+        .order_by(Transactions.id.desc())
+        .limit(1)
+    )
+
+
+def update_trans_expires(i: int) -> Executable:
+    return (
+        update(Transactions)
+        .where(Transactions.id == i)
+        .values(expires=datetime(2024, 1, 1) + timedelta(seconds=i))
+    )
+
+
+def get_coupon(i: int) -> Executable:
+    return select(Coupons).where(
+        and_(Coupons.coupon == f"CPN{i:08d}", Coupons.times_used < 10)
+    )
+
+
+def us_per_call(db: DbMain, build: Callable[[int], Executable], calls: int) -> float:
+    statements = [build(i) for i in range(calls)]
+    start = time.perf_counter()
+    for statement in statements:
+        db.sql_text_(statement)
+    return (time.perf_counter() - start) / calls * 1e6
+
+
+def main(calls: int) -> None:
+    db = DbMain()
+    cases = [get_user_by_email, get_trans_by_email, update_trans_expires, get_coupon]
+    print(f"{'statement':<24}{'compile us':>12}{'cached us':>12}{'speedup':>10}")
+    for build in cases:
+        sql_cache.size = 0
+        uncached = us_per_call(db, build, calls)
+        sql_cache.size = 500
+        cached = us_per_call(db, build, calls)
+        print(
+            f"{build.__name__:<24}{uncached:>12.1f}{cached:>12.1f}"
+            f"{uncached / cached:>9.1f}x"
+        )
+    print(sql_cache.stats())
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
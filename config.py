@@ -16,11 +16,96 @@ class Settings(BaseSettings):
     DATABASE: str = "mobile"
     GRPC_HOST: str = "localost"
     GRPC_PORT: int = 9091
+    GRPC_POOL_SIZE: int = 4
+    # channels are probed with a cheap query every GRPC_POOL_HEALTH_INTERVAL
+    # seconds (0 disables the probes); a probe not answered within
+    # GRPC_POOL_PROBE_TIMEOUT seconds marks the channel broken
+    GRPC_POOL_HEALTH_INTERVAL: float = 10.0
+    GRPC_POOL_PROBE_TIMEOUT: float = 2.0
+    GRPC_RECONNECT_BACKOFF_MIN: float = 0.1
+    GRPC_RECONNECT_BACKOFF_MAX: float = 5.0
+    GRPC_STREAM_CHUNK_SIZE: int = 1000
+    # rows per page of DbQueryMixin.iterate() keyset scans
+    ITERATE_PAGE_SIZE: int = 1000
+    # rows per multi-row INSERT statement of DbMain.insert_many()
+    INSERT_CHUNK_SIZE: int = 500
+    # recipients per chunk of a mailing campaign; the coupons of a chunk
+    # are generated and inserted in one round trip
+    MAIL_CHUNK_SIZE: int = 5000
+    # result encoding asked from the DB service: "json" or "columnar"
+    GRPC_ENCODING: str = "json"
+    # send SQL templates with typed parameters instead of literal SQL text;
+    # needs a DB service supporting EndpointRequest.parameterized
+    GRPC_PARAMETERIZED: bool = False
+    # compiled SQL templates kept by statement shape, 0 disables the cache
+    SQL_CACHE_SIZE: int = 500
+    # read replicas of the DB service, "host[:port],host[:port]"; SELECTs
+    # are routed to them unless the replica lags more than
+    # GRPC_REPLICA_MAX_LAG seconds. GRPC_REPLICA_LAG_INTERVAL 0 disables
+    # the lag checks (replicas are then always considered in sync)
+    GRPC_REPLICA_HOSTS: str = ""
+    GRPC_REPLICA_MAX_LAG: float = 5.0
+    GRPC_REPLICA_LAG_INTERVAL: float = 5.0
+    GRPC_REPLICA_LAG_QUERY: str = "SHOW REPLICA STATUS"
+    # deadline of a DB service call in seconds, and of the wait for each
+    # message of a stream (a stream has no overall deadline), 0 for none
+    GRPC_TIMEOUT: float = 5.0
+    GRPC_STREAM_IDLE_TIMEOUT: float = 120.0
+    # retries of failed reads; all retries of the process may add at most
+    # GRPC_RETRY_BUDGET_RATIO of the calls plus GRPC_RETRY_MIN_PER_SEC
+    GRPC_READ_RETRIES: int = 2
+    GRPC_RETRY_BACKOFF: float = 0.05
+    GRPC_RETRY_BUDGET_RATIO: float = 0.1
+    GRPC_RETRY_MIN_PER_SEC: float = 5.0
+    # consecutive failed calls opening the circuit breaker of an endpoint,
+    # and seconds it stays open before letting a probe call through
+    GRPC_BREAKER_FAILURES: int = 5
+    GRPC_BREAKER_RESET: float = 10.0
+    # share one in-flight call between identical concurrent reads of the
+    # queries asking for it (coalesce=True), False disables it everywhere
+    GRPC_COALESCE: bool = True
+    # latency, row and byte metrics of every statement sent by DbMain,
+    # labelled by statement fingerprint and calling method; label pairs
+    # past DB_STATEMENT_METRICS_MAX_SERIES are counted as "other"
+    DB_STATEMENT_METRICS: bool = True
+    DB_STATEMENT_METRICS_MAX_SERIES: int = 300
+    # calls slower than SLOW_QUERY_SECONDS are kept in a ring buffer of
+    # the last SLOW_QUERY_JOURNAL_SIZE records (with DB_STATEMENT_METRICS),
+    # with SLOW_QUERY_SAMPLE_RATE of the other calls as baseline
+    SLOW_QUERY_SECONDS: float = 0.5
+    SLOW_QUERY_SAMPLE_RATE: float = 0.001
+    SLOW_QUERY_JOURNAL_SIZE: int = 1000
+    # directory of the node_exporter textfile collector where the cron
+    # scripts write their metrics on exit, "" disables it
+    METRICS_TEXTFILE_DIR: str = ""
 
     # --- redis
     REDIS_HOST: str = "localhost"
     REDIS_PORT: int = 6379
     REDIS: str = "redis://localhost/0"
+    # after a Redis error the Redis caches of the DB layer (users, coupon
+    # filter) are skipped for REDIS_CACHE_RETRY_AFTER seconds
+    REDIS_CACHE_RETRY_AFTER: float = 5.0
+    # seconds users stay in the Redis user cache, 0 disables it
+    USER_CACHE_TTL: int = 60
+    # Bloom filter of coupon codes answering lookups of missing coupons
+    # without a DB call (see dbm.coupon_filter); codes it lets through
+    # but the DB does not know are remembered COUPON_MISS_TTL seconds
+    COUPON_FILTER: bool = True
+    COUPON_FILTER_BITS: int = 2**24
+    COUPON_FILTER_HASHES: int = 7
+    COUPON_MISS_TTL: int = 60
+    # ready-made coupons kept in Redis lists (see libs.coupon_pool): the
+    # pools of COUPON_POOL_PROFILES ("percent:days[:plans]") are checked
+    # every COUPON_POOL_REFILL_INTERVAL seconds and refilled, once down to
+    # half of it, up to the takes of a COUPON_POOL_DEMAND_WINDOW seconds
+    # window, at most COUPON_POOL_SIZE (0 for no pools); coupons waiting
+    # longer than COUPON_POOL_MAX_AGE_SHARE of their validity are dropped
+    COUPON_POOL_PROFILES: list = ["10:30"]
+    COUPON_POOL_SIZE: int = 200
+    COUPON_POOL_DEMAND_WINDOW: int = 3600
+    COUPON_POOL_REFILL_INTERVAL: float = 5.0
+    COUPON_POOL_MAX_AGE_SHARE: float = 0.1
 
     PROMETEUS_LOGIN: bytes = b"stanleyjobson"
     PROMETEUS_PASSWORD: bytes = b"swordfisha"
@@ -0,0 +1,4 @@
+#!/bin/bash
+
+. crons/env.sh
+/usr/bin/python3 scripts/rebuild_coupon_filter.py >> /var/log/cron.log 2>&1
\ No newline at end of file
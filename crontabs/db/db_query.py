@@ -1,49 +1,73 @@
 from datetime import datetime, timedelta
-from typing import List
+from typing import AsyncIterator, List, Optional
 
-from sqlalchemy import delete, insert, select, update
+from sqlalchemy import Select, delete, select, update
 from sqlalchemy.sql import and_
 
 from crontabs.db.schemas import CustomerPromo
+from dbm.coupon_filter import CouponFilter
 from dbm.database import DbQuery as DBQ
 from dbm.database import DbQueryMixin
 from dbm.db_main import DbMain
 from dbm.models import Coupons, Transactions, Users
-from dbm.schemas import CouponsPd, UserId
+from dbm.redis_db import redis_stright
+from dbm.schemas import UserId
+from dbm.user_cache import UserCache
 
 
 class DbQuery(DBQ, DbMain, DbQueryMixin):
+    # the backend caches users: writes of the cron jobs must drop them
+    user_cache = UserCache(redis_stright)
+    # coupons created by the cron jobs must be in the coupon filter
+    coupon_filter = CouponFilter(redis_stright)
+
     async def get_user_db(self, email: str) -> UserId:
         """Select user by email (unique)"""
         statement = select(Users).where(Users.email == email)
-        self.data_class = UserId
-        result_ = await self.result_one(statement)
+        result_ = await self.result_one(statement, UserId)
         return result_
 
-    async def get_all_users_reminder(self) -> List[UserId]:
+    @staticmethod
+    def all_users_reminder_statement() -> Select:
         """
-        Select users whose tariff expired within the range
+        Users whose tariff expired within the range
         from 2 days ago up to 1 day from now.
         """
-        statement = select(Users).where(
+        return select(Users).where(
             Users.expires.between(
                 int(datetime.now().strftime("%s")) - 86400 * 2,
                 int(datetime.now().strftime("%s")) + 86400,
             )
         )
-        self.data_class = UserId
-        result_ = await self.result(statement)
+
+    async def get_all_users_reminder(self) -> List[UserId]:
+        """
+        Select users whose tariff expired within the range
+        from 2 days ago up to 1 day from now.
+        """
+        statement = self.all_users_reminder_statement()
+        result_ = await self.result(statement, UserId, trusted=True)
         return result_
 
-    async def get_customer_promo_db(self) -> List[CustomerPromo]:
+    def stream_all_users_reminder(self) -> AsyncIterator[UserId]:
+        """Stream users of get_all_users_reminder chunk by chunk."""
+        return self.stream(
+            self.all_users_reminder_statement(),
+            UserId,
+            encoding="columnar",
+            trusted=True,
+        )
+
+    @staticmethod
+    def customer_promo_statement() -> Select:
         """
-        Queries users emails from transactions that:
+        Users emails from transactions that:
         - expire within a one-hour window exactly 7 days forward from now,
         - have a duration of 30 days,
         - are non-trial subscriptions,
         - and are completed transactions.
         """
-        statement = select(
+        return select(
             Users.email.label("address"),
             Users.lang,
         ).where(
@@ -63,14 +87,33 @@ class DbQuery(DBQ, DbMain, DbQueryMixin):
                 )
             )
         )
-        self.data_class = CustomerPromo
-        result_ = await self.result(statement)
+
+    async def get_customer_promo_db(self) -> List[CustomerPromo]:
+        """
+        Queries users emails from transactions that:
+        - expire within a one-hour window exactly 7 days forward from now,
+        - have a duration of 30 days,
+        - are non-trial subscriptions,
+        - and are completed transactions.
+        """
+        statement = self.customer_promo_statement()
+        result_ = await self.result(statement, CustomerPromo, trusted=True)
         return result_
 
-    async def get_customer_coupon_db(self) -> List[CustomerPromo]:
-        """Selects users who completed a 30-day trial transaction
+    def stream_customer_promo_db(self) -> AsyncIterator[CustomerPromo]:
+        """Stream users of get_customer_promo_db chunk by chunk."""
+        return self.stream(
+            self.customer_promo_statement(),
+            CustomerPromo,
+            encoding="columnar",
+            trusted=True,
+        )
+
+    @staticmethod
+    def customer_coupon_statement() -> Select:
+        """Users who completed a 30-day trial transaction
         exactly one day ago within a one-hour window."""
-        statement = (
+        return (
             select(
                 Users.email.label("address"),
                 Users.lang,
@@ -88,22 +131,32 @@ class DbQuery(DBQ, DbMain, DbQueryMixin):
                 )
             )
         )
-        self.data_class = CustomerPromo
-        result_ = await self.result(statement)
-        return result_
 
-        # -------- create ---------
+    async def get_customer_coupon_db(self) -> List[CustomerPromo]:
+        """Selects users who completed a 30-day trial transaction
+        exactly one day ago within a one-hour window."""
+        statement = self.customer_coupon_statement()
+        result_ = await self.result(statement, CustomerPromo, trusted=True)
+        return result_
 
-    async def insert_coupon(self, data: CouponsPd) -> None:
-        """Insert new coupon in DB"""
-        statement = insert(Coupons).values(
-            coupon=data.coupon,
-            percent=data.percent,
-            created=data.created,
-            expiration=data.expiration,
-            plans=data.plans,
+    def stream_customer_coupon_db(self) -> AsyncIterator[CustomerPromo]:
+        """Stream users of get_customer_coupon_db chunk by chunk."""
+        return self.stream(
+            self.customer_coupon_statement(),
+            CustomerPromo,
+            encoding="columnar",
+            trusted=True,
         )
-        await self.result(statement)
+
+    async def stream_coupon_codes(
+        self, since: Optional[datetime] = None
+    ) -> AsyncIterator[str]:
+        """Codes of all coupons, or of those created since a moment."""
+        where = Coupons.created >= since if since is not None else None
+        async for row in self.iterate(Coupons, where):
+            yield row["coupon"]
+
+        # -------- create ---------
 
     # -------- update --------
 
@@ -113,11 +166,13 @@ class DbQuery(DBQ, DbMain, DbQueryMixin):
             update(Users).where(Users.email == user.email).values(cn=f"sec{user.id}")
         )
         await self.result(statement)
+        await self.forget_user_(user.email)
 
     async def delete_user(self, email: str) -> None:
         """Delete user by email"""
         statement = delete(Users).where(Users.email == email)
         await self.result(statement)
+        await self.forget_user_(email)
 
 
 dbq = DbQuery()
@@ -2,34 +2,169 @@
 # sources: tests.proto
 # plugin: python-betterproto
 from dataclasses import dataclass
-from typing import Dict
+from typing import AsyncIterator, Dict, List, Optional
 
 import betterproto
 from betterproto.grpc.grpclib_server import ServiceBase
 import grpclib
 
 
+class Encoding(betterproto.Enum):
+    JSON = 0
+    COLUMNAR = 1
+
+
+class ColumnType(betterproto.Enum):
+    NULL = 0
+    INT = 1
+    FLOAT = 2
+    STRING = 3
+    DATETIME = 4
+    DECIMAL = 5
+    BOOL = 6
+    BYTES = 7
+
+
+@dataclass(eq=False, repr=False)
+class Param(betterproto.Message):
+    null_value: bool = betterproto.bool_field(1, group="value")
+    int_value: int = betterproto.sint64_field(2, group="value")
+    double_value: float = betterproto.double_field(3, group="value")
+    string_value: str = betterproto.string_field(4, group="value")
+    bytes_value: bytes = betterproto.bytes_field(5, group="value")
+    bool_value: bool = betterproto.bool_field(6, group="value")
+    datetime_value: int = betterproto.int64_field(7, group="value")
+    decimal_value: str = betterproto.string_field(8, group="value")
+
+
 @dataclass(eq=False, repr=False)
 class EndpointRequest(betterproto.Message):
     test: str = betterproto.string_field(1)
+    encoding: "Encoding" = betterproto.enum_field(2)
+    parameterized: bool = betterproto.bool_field(3)
+    params: List["Param"] = betterproto.message_field(4)
+
+
+@dataclass(eq=False, repr=False)
+class Column(betterproto.Message):
+    name: str = betterproto.string_field(1)
+    type: "ColumnType" = betterproto.enum_field(2)
+    nulls: bytes = betterproto.bytes_field(3)
+    data: bytes = betterproto.bytes_field(4)
+    scale: int = betterproto.int32_field(5)
+
+
+@dataclass(eq=False, repr=False)
+class ColumnarResult(betterproto.Message):
+    row_count: int = betterproto.int32_field(1)
+    columns: List["Column"] = betterproto.message_field(2)
 
 
 @dataclass(eq=False, repr=False)
 class EndpointResponse(betterproto.Message):
     test_res: str = betterproto.string_field(1)
+    encoding: "Encoding" = betterproto.enum_field(2)
+    columns: "ColumnarResult" = betterproto.message_field(3)
+    last_insert_id: int = betterproto.uint64_field(4)
+    rows_affected: int = betterproto.int64_field(5)
+
+
+@dataclass(eq=False, repr=False)
+class StreamRequest(betterproto.Message):
+    test: str = betterproto.string_field(1)
+    chunk_size: int = betterproto.int32_field(2)
+    encoding: "Encoding" = betterproto.enum_field(3)
+    parameterized: bool = betterproto.bool_field(4)
+    params: List["Param"] = betterproto.message_field(5)
+
+
+@dataclass(eq=False, repr=False)
+class BatchRequest(betterproto.Message):
+    tests: List[str] = betterproto.string_field(1)
+    atomic: bool = betterproto.bool_field(2)
+    expected_rows: List[int] = betterproto.sint64_field(3)
+
+
+@dataclass(eq=False, repr=False)
+class BatchResponse(betterproto.Message):
+    test_res: List[str] = betterproto.string_field(1)
+    last_insert_ids: List[int] = betterproto.uint64_field(2)
+    rows_affected: List[int] = betterproto.int64_field(3)
+    rolled_back: bool = betterproto.bool_field(4)
+    failed_index: int = betterproto.int32_field(5)
+    error: str = betterproto.string_field(6)
 
 
 class TestStub(betterproto.ServiceStub):
-    async def test(self, *, test: str = "") -> "EndpointResponse":
+    async def test(
+        self,
+        *,
+        test: str = "",
+        encoding: "Encoding" = 0,
+        parameterized: bool = False,
+        params: Optional[List["Param"]] = None
+    ) -> "EndpointResponse":
+        params = params or []
 
         request = EndpointRequest()
         request.test = test
+        request.encoding = encoding
+        request.parameterized = parameterized
+        request.params = params
 
         return await self._unary_unary("/Test/test", request, EndpointResponse)
 
+    async def batch(
+        self,
+        *,
+        tests: Optional[List[str]] = None,
+        atomic: bool = False,
+        expected_rows: Optional[List[int]] = None
+    ) -> "BatchResponse":
+        tests = tests or []
+        expected_rows = expected_rows or []
+
+        request = BatchRequest()
+        request.tests = tests
+        request.atomic = atomic
+        request.expected_rows = expected_rows
+
+        return await self._unary_unary("/Test/batch", request, BatchResponse)
+
+    async def stream(
+        self,
+        *,
+        test: str = "",
+        chunk_size: int = 0,
+        encoding: "Encoding" = 0,
+        parameterized: bool = False,
+        params: Optional[List["Param"]] = None
+    ) -> AsyncIterator["EndpointResponse"]:
+        params = params or []
+
+        request = StreamRequest()
+        request.test = test
+        request.chunk_size = chunk_size
+        request.encoding = encoding
+        request.parameterized = parameterized
+        request.params = params
+
+        async for response in self._unary_stream(
+            "/Test/stream",
+            request,
+            EndpointResponse,
+        ):
+            yield response
+
 
 class TestBase(ServiceBase):
-    async def test(self, test: str) -> "EndpointResponse":
+    async def test(
+        self,
+        test: str,
+        encoding: "Encoding",
+        parameterized: bool,
+        params: Optional[List["Param"]],
+    ) -> "EndpointResponse":
         raise grpclib.GRPCError(grpclib.const.Status.UNIMPLEMENTED)
 
     async def __rpc_test(self, stream: grpclib.server.Stream) -> None:
@@ -37,11 +172,61 @@ class TestBase(ServiceBase):
 
         request_kwargs = {
             "test": request.test,
+            "encoding": request.encoding,
+            "parameterized": request.parameterized,
+            "params": request.params,
         }
 
         response = await self.test(**request_kwargs)
         await stream.send_message(response)
 
+    async def batch(
+        self,
+        tests: Optional[List[str]],
+        atomic: bool,
+        expected_rows: Optional[List[int]],
+    ) -> "BatchResponse":
+        raise grpclib.GRPCError(grpclib.const.Status.UNIMPLEMENTED)
+
+    async def __rpc_batch(self, stream: grpclib.server.Stream) -> None:
+        request = await stream.recv_message()
+
+        request_kwargs = {
+            "tests": request.tests,
+            "atomic": request.atomic,
+            "expected_rows": request.expected_rows,
+        }
+
+        response = await self.batch(**request_kwargs)
+        await stream.send_message(response)
+
+    async def stream(
+        self,
+        test: str,
+        chunk_size: int,
+        encoding: "Encoding",
+        parameterized: bool,
+        params: Optional[List["Param"]],
+    ) -> AsyncIterator["EndpointResponse"]:
+        raise grpclib.GRPCError(grpclib.const.Status.UNIMPLEMENTED)
+
+    async def __rpc_stream(self, stream: grpclib.server.Stream) -> None:
+        request = await stream.recv_message()
+
+        request_kwargs = {
+            "test": request.test,
+            "chunk_size": request.chunk_size,
+            "encoding": request.encoding,
+            "parameterized": request.parameterized,
+            "params": request.params,
+        }
+
+        await self._call_rpc_handler_server_stream(
+            self.stream,
+            stream,
+            request_kwargs,
+        )
+
     def __mapping__(self) -> Dict[str, grpclib.const.Handler]:
         return {
             "/Test/test": grpclib.const.Handler(
@@ -50,4 +235,16 @@ class TestBase(ServiceBase):
                 EndpointRequest,
                 EndpointResponse,
             ),
+            "/Test/batch": grpclib.const.Handler(
+                self.__rpc_batch,
+                grpclib.const.Cardinality.UNARY_UNARY,
+                BatchRequest,
+                BatchResponse,
+            ),
+            "/Test/stream": grpclib.const.Handler(
+                self.__rpc_stream,
+                grpclib.const.Cardinality.UNARY_STREAM,
+                StreamRequest,
+                EndpointResponse,
+            ),
         }
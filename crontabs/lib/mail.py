@@ -10,19 +10,76 @@ mentioned above and send them to users from the given lists.
 """
 
 from datetime import datetime
-from typing import List
+from typing import AsyncIterable, AsyncIterator, Iterable, List, Optional
 
 from config import settings
 from crontabs.db.db_query import dbq
-from libs.utils import generate_coupon_db, render_tmpl
+from libs.coupon_pool import CouponProfile, coupon_pool
+from libs.utils import generate_coupons_db, render_tmpl
 from crontabs.lib.utils import langs
-from dbm.schemas import UserId, MailData
+from dbm.schemas import CouponsPd, UserId, MailData
 from libs.send_mail import default_email_sender as EmailSender
 
 
+async def aiter_users(
+    users: Iterable[UserId] | AsyncIterable[UserId],
+) -> AsyncIterator[UserId]:
+    """Iterate asynchronously over a list or a stream of users."""
+    if isinstance(users, AsyncIterable):
+        async for user in users:
+            yield user
+    else:
+        for user in users:
+            yield user
+
+
+async def achunks(
+    users: AsyncIterator[UserId], size: int
+) -> AsyncIterator[List[UserId]]:
+    """Group an async iterator of users into lists of at most size users."""
+    chunk = []
+    async for user in users:
+        chunk.append(user)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class CouponStock:
+    """
+    Coupons of one kind taken in advance for a chunk of recipients, from
+    the coupon pool if the kind has one, the others generated with a few
+    multi-row inserts instead of one insert per letter.
+    """
+
+    def __init__(self, cents: int, expiration: int, plans: Optional[str] = None):
+        self.profile = CouponProfile(cents, expiration, plans)
+        self.coupons: List[CouponsPd] = []
+
+    async def fill(self, count: int) -> None:
+        """Make sure count coupons are in stock."""
+        missing = count - len(self.coupons)
+        if missing > 0:
+            self.coupons += await coupon_pool.take_many(dbq, self.profile, missing)
+            missing = count - len(self.coupons)
+        if missing > 0:
+            self.coupons += await generate_coupons_db(dbq, missing, *self.profile)
+
+    async def take(self) -> CouponsPd:
+        """Take a coupon from the stock, or from the pool if it is empty."""
+        if self.coupons:
+            return self.coupons.pop()
+        return await coupon_pool.take(dbq, *self.profile)
+
+
 class BaseRender:
     """Abstract base class for all email renderers."""
 
+    async def prepare(self, users: List[UserId]) -> None:
+        """Prepare the rendering of a chunk of users, e.g. their coupons."""
+
     async def render(self, user: UserId) -> str:
         raise NotImplementedError
 
@@ -30,6 +87,16 @@ class BaseRender:
 class RemindRender(BaseRender):
     """Render reminder email."""
 
+    def __init__(self):
+        self.coupons = CouponStock(10, 30)
+
+    @staticmethod
+    def expired(user: UserId) -> bool:
+        return int(datetime.now().timestamp()) - user.expires > 0
+
+    async def prepare(self, users: List[UserId]) -> None:
+        await self.coupons.fill(sum(1 for user in users if self.expired(user)))
+
     async def render(self, user: UserId) -> str:
         lang = user.lang
         email = user.email
@@ -73,9 +140,8 @@ class RemindRender(BaseRender):
             "localtime": datetime.now().strftime("%Y"),
         }
 
-        now_unix = int(datetime.now().timestamp())
-        if now_unix - user.expires > 0:
-            coupon = await generate_coupon_db(dbq, 10, 30)
+        if self.expired(user):
+            coupon = await self.coupons.take()
             data_tmpl["coupon"] = coupon.coupon
 
         return render_tmpl("template/reminder_new.html", data_tmpl)
@@ -84,8 +150,14 @@ class RemindRender(BaseRender):
 class PromoRender(BaseRender):
     """Render new customer promo email."""
 
+    def __init__(self):
+        self.coupons = CouponStock(35, 1, "180,360")
+
+    async def prepare(self, users: List[UserId]) -> None:
+        await self.coupons.fill(len(users))
+
     async def render(self, user: UserId) -> str:
-        coupon = await generate_coupon_db(dbq, 35, 1, "180,360")
+        coupon = await self.coupons.take()
         return render_tmpl(
             f"template/email/newcustomer_promo_{user.lang}.html",
             {"coupon": coupon.coupon, "localtime": datetime.now().strftime("%Y")},
@@ -95,8 +167,14 @@ class PromoRender(BaseRender):
 class CouponRender(BaseRender):
     """Render new customer coupon email."""
 
+    def __init__(self):
+        self.coupons = CouponStock(25, 1, "180,360")
+
+    async def prepare(self, users: List[UserId]) -> None:
+        await self.coupons.fill(len(users))
+
     async def render(self, user: UserId) -> str:
-        coupon = await generate_coupon_db(dbq, 25, 1, "180,360")
+        coupon = await self.coupons.take()
         return render_tmpl(
             f"template/email/newcustomer_coupon_{user.lang}.html",
             {"coupon": coupon.coupon, "localtime": datetime.now().strftime("%Y")},
@@ -112,14 +190,21 @@ class MailService:
             cls.__name__.lower(): cls() for cls in BaseRender.__subclasses__()
         }
 
-    async def send_all(self, renderer_name: str, users: List[UserId], subject: str):
+    async def send_all(
+        self,
+        renderer_name: str,
+        users: Iterable[UserId] | AsyncIterable[UserId],
+        subject: str,
+    ):
         renderer = self._get_renderer(renderer_name)
-        for user in users:
-            body = await renderer.render(user)
-            subj = langs[f"{subject}-{user.lang}"]
-            await self.sender.send_mail(
-                MailData(email=user.email, subject=subj, body=body)
-            )
+        async for chunk in achunks(aiter_users(users), settings.MAIL_CHUNK_SIZE):
+            await renderer.prepare(chunk)
+            for user in chunk:
+                body = await renderer.render(user)
+                subj = langs[f"{subject}-{user.lang}"]
+                await self.sender.send_mail(
+                    MailData(email=user.email, subject=subj, body=body)
+                )
 
     async def send_one(self, renderer_name: str, user: UserId, subject: str):
         renderer = self._get_renderer(renderer_name)
@@ -138,19 +223,25 @@ _sender = EmailSender
 _mail_service = MailService(_sender)
 
 
-async def send_all_reminder(users: List[UserId]) -> list | None:
+async def send_all_reminder(
+    users: Iterable[UserId] | AsyncIterable[UserId],
+) -> list | None:
     return await _mail_service.send_all(
         "remindrender", users, "email.subjects.reminder"
     )
 
 
-async def send_new_customer_promos(users: List[UserId]) -> list | None:
+async def send_new_customer_promos(
+    users: Iterable[UserId] | AsyncIterable[UserId],
+) -> list | None:
     return await _mail_service.send_all(
         "promorender", users, "email.subjects.newcustomer_promo"
     )
 
 
-async def send_new_customer_coupons(users: List[UserId]) -> list | None:
+async def send_new_customer_coupons(
+    users: Iterable[UserId] | AsyncIterable[UserId],
+) -> list | None:
     return await _mail_service.send_all(
         "couponrender", users, "email.subjects.newcustomer_coupon"
     )
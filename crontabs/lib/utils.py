@@ -1,6 +1,6 @@
 import hashlib
 import json
-from typing import Optional
+from typing import AsyncIterator, Optional
 
 from config import settings
 from crontabs.db.db_query import dbq
@@ -29,6 +29,26 @@ async def get_emails(mail_from_args: Optional[str | None] = None):
     return users
 
 
+async def aiter_one(coro) -> AsyncIterator:
+    """
+    Wrap a coroutine returning one item into an async iterator, empty
+    if it returns None (e.g. no user with the given email).
+    """
+    item = await coro
+    if item is not None:
+        yield item
+
+
+def stream_emails(mail_from_args: Optional[str | None] = None) -> AsyncIterator:
+    """
+    Same selection as get_emails, but streamed from the database
+    chunk by chunk, so mailing starts before the whole list arrives.
+    """
+    if mail_from_args:
+        return aiter_one(dbq.get_user_db(mail_from_args))
+    return dbq.stream_all_users_reminder()
+
+
 def get_unsubscribe_token(email: str) -> str:
     """Generate the token to unsubscribe from mailings"""
     token = hashlib.sha1(
@@ -49,3 +69,13 @@ async def get_users(users: list, no_unsubscribe=None) -> list:
         result.append(user_pd)
 
     return result
+
+
+async def stream_users(users: AsyncIterator, no_unsubscribe=None) -> AsyncIterator:
+    """Set unsubscribe token to users of the given stream"""
+    async for user in users:
+        user_pd = UserReminder(**user.__dict__)
+
+        if not no_unsubscribe:
+            user_pd.unsubscribe_token = get_unsubscribe_token(user_pd.email)
+        yield user_pd
@@ -2,7 +2,9 @@ import asyncio
 from typing import List
 
 from crontabs.db.db_query import dbq as db
-from crontabs.lib.mail import send_all_new_customer_coupon
+from crontabs.lib.mail import send_new_customer_coupons
+from dbm.grpc_pool import close_pool
+from dbm.metrics import write_textfile
 
 
 async def coupon() -> List[str | None]:
@@ -10,8 +12,12 @@ async def coupon() -> List[str | None]:
     Fetches a list of users who purchased yesterday
     to send them discount coupons.
     """
-    users = await db.get_customer_coupon_db()
-    res = await send_all_new_customer_coupon(users)
+    try:
+        users = db.stream_customer_coupon_db()
+        res = await send_new_customer_coupons(users)
+    finally:
+        await close_pool()
+        write_textfile("new_customer_coupon")
     return res
 
 
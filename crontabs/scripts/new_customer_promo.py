@@ -2,7 +2,9 @@ import asyncio
 from typing import List
 
 from crontabs.db.db_query import dbq as db
-from crontabs.lib.mail import send_all_new_customer_promo
+from crontabs.lib.mail import send_new_customer_promos
+from dbm.grpc_pool import close_pool
+from dbm.metrics import write_textfile
 
 
 async def promo() -> List[str | None]:
@@ -11,8 +13,12 @@ async def promo() -> List[str | None]:
     and whose subscription ends within 7 days,
     to offer a 35% discount on a 1-year tariff.
     """
-    users = await db.get_customer_promo_db()
-    res = await send_all_new_customer_promo(users)
+    try:
+        users = db.stream_customer_promo_db()
+        res = await send_new_customer_promos(users)
+    finally:
+        await close_pool()
+        write_textfile("new_customer_promo")
     return res
 
 
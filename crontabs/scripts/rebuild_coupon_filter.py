@@ -0,0 +1,27 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from crontabs.db.db_query import dbq as db
+from dbm.grpc_pool import close_pool
+from dbm.metrics import write_textfile
+
+
+async def rebuild() -> int:
+    """
+    Rebuilds the Bloom filter of coupon codes from the coupons table,
+    then adds again the coupons created while it was built, whose bits
+    were set in the replaced filter.
+    """
+    started = datetime.now() - timedelta(minutes=1)
+    try:
+        count = await db.coupon_filter.rebuild(db.stream_coupon_codes())
+        await db.coupon_filter.add(
+            [code async for code in db.stream_coupon_codes(since=started)]
+        )
+    finally:
+        await close_pool()
+        write_textfile("rebuild_coupon_filter")
+    return count
+
+
+asyncio.run(rebuild())
@@ -9,7 +9,9 @@ from parser_args import get_args_reminder
 from crontabs.config_cron import settings
 from crontabs.db.schemas import ReminderArgs
 from crontabs.lib.mail import send_all_reminder
-from crontabs.lib.utils import get_emails, get_users
+from crontabs.lib.utils import stream_emails, stream_users
+from dbm.grpc_pool import close_pool
+from dbm.metrics import write_textfile
 from libs.logs import log
 
 sys.path.append(str(Path(__file__).parents[0]))
@@ -30,17 +32,20 @@ def get_args() -> ReminderArgs:
 async def remind() -> List[str | None]:
     """Execute mailing to payment reminder users list."""
     args_data = get_args()
-    emails = await get_emails(args_data.try_one_email)
-    users = await get_users(emails, args_data.no_unsubscribe)
-    log.debug(f"emails {emails}")
-    res = await send_all_reminder(users)
+    try:
+        emails = stream_emails(args_data.try_one_email)
+        users = stream_users(emails, args_data.no_unsubscribe)
+        res = await send_all_reminder(users)
+    finally:
+        await close_pool()
+        write_textfile("send_payment_reminder")
     return res
 
 
 try:
     with pidfile.PIDFile(pid_file):
         res = asyncio.run(remind())
-        error = [r for r in res if r[0] != "" and r[0] is not None]
+        error = [r for r in res or [] if r[0] != "" and r[0] is not None]
 
         if error is not None and error != []:
             er = [str(e) for e in error]
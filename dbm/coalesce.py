@@ -0,0 +1,61 @@
+"""
+Coalescing of identical in-flight reads (singleflight).
+
+When many requests issue the same SELECT at the same moment (tariffs
+during a promo spike), only the first one is sent to the database
+service; the others wait for its result instead of each making its own
+round trip. Calls are keyed by the SQL sent (text or template and
+parameters), so only statements rendering to the exact same query are
+shared, and an entry only lives while its call is in flight: this is
+not a cache, a result is never served to a call started after it
+arrived.
+"""
+
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple, TypeVar
+
+from dbm.metrics import COALESCED_CALLS
+
+T = TypeVar("T")
+
+
+class Singleflight:
+    """
+    Shares one in-flight call between concurrent callers of the same key.
+
+    The call runs as its own task, so a cancelled caller (client gone)
+    does not cancel it for the callers still waiting on it.
+    """
+
+    def __init__(self) -> None:
+        self._calls: Dict[Tuple[Any, Hashable], asyncio.Task] = {}
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        """
+        Run fn, or wait for the running call of the same key.
+
+        Args:
+            key (Hashable): Identity of the call.
+            fn (Callable[[], Awaitable[T]]): Makes the call.
+
+        Returns:
+            T: Result of the call, shared by all its callers.
+        """
+        loop = asyncio.get_running_loop()
+        key = (loop, key)
+        task = self._calls.get(key)
+        if task is None:
+            COALESCED_CALLS.labels("sent").inc()
+            task = loop.create_task(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda _: self._calls.pop(key, None))
+        else:
+            COALESCED_CALLS.labels("shared").inc()
+        return await asyncio.shield(task)
+
+    def in_flight(self) -> int:
+        """Number of calls currently in flight."""
+        return len(self._calls)
+
+
+singleflight = Singleflight()
@@ -0,0 +1,216 @@
+"""
+Bloom filter of existing coupon codes, with a negative cache behind it.
+
+The public coupon check is hammered with guessed codes, nearly none of
+which exist. The codes of all coupons are kept in a Bloom filter, a
+bitmap in Redis shared by all processes: a code whose bits are not all
+set does not exist, and get_coupon() answers None without querying the
+database service. Codes the filter lets through but the database does
+not know (false positives) are remembered for settings.COUPON_MISS_TTL
+seconds in a negative cache.
+
+Coupons inserted through DbQueryMixin.insert_coupon() and
+insert_coupons_many() are added to the filter before they are written,
+and marked present in the negative cache for COUPON_MISS_TTL seconds:
+a lookup that missed the coupon just before its insert can then not
+store its miss (the miss is only stored if no entry exists). If Redis
+fails while adding, the filter is deleted, letting every code through
+until the next rebuild, and if that fails too the insert fails, rather
+than leaving other processes with a filter hiding the coupon.
+
+The filter is rebuilt from the coupons table by the cron job
+crontabs/scripts/rebuild_coupon_filter.py, which also picks up coupons
+created by other means; until a first rebuild the filter is not used.
+Redis errors never fail a lookup, the database answers instead.
+"""
+
+import hashlib
+import time
+from typing import AsyncIterable, Iterable, List
+
+from redis.asyncio.client import Redis
+
+from config import settings
+from dbm.metrics import COUPON_FILTER_CHECKS, COUPON_FILTER_EXPECTED_FPR
+from libs.logs import log
+
+# values of the negative cache entries
+MISSING = "1"
+PRESENT = "0"
+
+
+def normalize(code: str) -> str:
+    """Coupon codes are compared case-insensitively by the database."""
+    return code.strip().lower()
+
+
+def bit_positions(code: str, bits: int, hashes: int) -> List[int]:
+    """
+    Bits of a code in a filter of the given size, by double hashing of
+    a 128-bit BLAKE2b digest.
+
+    Args:
+        code (str): Coupon code.
+        bits (int): Size of the filter in bits.
+        hashes (int): Number of bits per code.
+
+    Returns:
+        List[int]: Bit offsets.
+    """
+    digest = hashlib.blake2b(normalize(code).encode(), digest_size=16).digest()
+    h1 = int.from_bytes(digest[:8], "little")
+    h2 = int.from_bytes(digest[8:], "little") | 1
+    return [(h1 + i * h2) % bits for i in range(hashes)]
+
+
+class CouponFilter:
+    """
+    Bloom filter of coupon codes in Redis, and negative cache.
+
+    Args:
+        redis (Redis): Redis client.
+        key (str): Key of the filter bitmap.
+        bits (int): Size of the filter in bits.
+        hashes (int): Number of bits per code.
+    """
+
+    def __init__(
+        self,
+        redis: Redis,
+        key: str = "coupon:bloom",
+        bits: int = settings.COUPON_FILTER_BITS,
+        hashes: int = settings.COUPON_FILTER_HASHES,
+    ) -> None:
+        self.redis = redis
+        self.key = key
+        self.bits = bits
+        self.hashes = hashes
+        self._skip_until = 0.0
+
+    def miss_key(self, code: str) -> str:
+        return f"coupon:miss:{normalize(code)}"
+
+    @property
+    def enabled(self) -> bool:
+        return settings.COUPON_FILTER and time.monotonic() >= self._skip_until
+
+    def _failed(self, ex: Exception) -> None:
+        COUPON_FILTER_CHECKS.labels("error").inc()
+        self._skip_until = time.monotonic() + settings.REDIS_CACHE_RETRY_AFTER
+        log.warning(f"coupon filter unavailable {ex!r}")
+
+    async def may_exist(self, code: str) -> bool:
+        """
+        False if a coupon surely does not exist: it is not in the filter,
+        or the database did not know it a moment ago. One Redis round trip.
+
+        Args:
+            code (str): Coupon code.
+
+        Returns:
+            bool: The coupon has to be looked up in the database.
+        """
+        if not self.enabled:
+            return True
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                pipe.exists(self.key)
+                pipe.get(self.miss_key(code))
+                for bit in bit_positions(code, self.bits, self.hashes):
+                    pipe.getbit(self.key, bit)
+                built, missing, *bits = await pipe.execute()
+        except Exception as ex:
+            self._failed(ex)
+            return True
+        if built and not all(bits):
+            COUPON_FILTER_CHECKS.labels("absent").inc()
+            return False
+        if missing == MISSING:
+            COUPON_FILTER_CHECKS.labels("negative_cached").inc()
+            return False
+        return True
+
+    async def checked(self, code: str, exists: bool) -> None:
+        """
+        Account the database answer for a code the filter let through,
+        and remember a missing code in the negative cache, unless it was
+        added since (see add()).
+        """
+        if not self.enabled:
+            return
+        if exists:
+            COUPON_FILTER_CHECKS.labels("present").inc()
+            return
+        COUPON_FILTER_CHECKS.labels("false_positive").inc()
+        try:
+            await self.redis.set(
+                self.miss_key(code), MISSING, ex=settings.COUPON_MISS_TTL, nx=True
+            )
+        except Exception as ex:
+            self._failed(ex)
+
+    async def add(self, codes: Iterable[str]) -> None:
+        """
+        Add codes to the filter and mark them present in the negative
+        cache. Called before the coupons are inserted, so that no reader
+        can see a written coupon missing from the filter.
+
+        Raises:
+            Exception: The Redis error, if the filter could not be deleted
+                either after failing to add the codes.
+        """
+        if not settings.COUPON_FILTER:
+            return
+        codes = list(codes)
+        try:
+            # bits set before a first rebuild would make a filter of only
+            # these codes, hiding all the others
+            built = await self.redis.exists(self.key)
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for code in codes:
+                    if built:
+                        for bit in bit_positions(code, self.bits, self.hashes):
+                            pipe.setbit(self.key, bit, 1)
+                    pipe.set(self.miss_key(code), PRESENT, ex=settings.COUPON_MISS_TTL)
+                await pipe.execute()
+        except Exception as ex:
+            self._failed(ex)
+            await self.invalidate(codes)
+
+    async def invalidate(self, codes: List[str]) -> None:
+        """
+        Delete the filter and the negative cache entries of codes, so that
+        all processes look them up in the database until the next rebuild.
+        """
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.delete(self.key)
+            for code in codes:
+                pipe.delete(self.miss_key(code))
+            await pipe.execute()
+        log.warning("coupon filter deleted, it is used again after a rebuild")
+
+    async def rebuild(self, codes: AsyncIterable[str]) -> int:
+        """
+        Build the filter of all coupon codes in the process and swap it
+        in atomically (SET of a temporary key, then RENAME).
+
+        Args:
+            codes (AsyncIterable[str]): All coupon codes.
+
+        Returns:
+            int: Number of codes in the filter.
+        """
+        bitmap = bytearray((self.bits + 7) // 8)
+        count = 0
+        async for code in codes:
+            for bit in bit_positions(code, self.bits, self.hashes):
+                # Redis bit offsets count from the most significant bit
+                bitmap[bit >> 3] |= 0x80 >> (bit & 7)
+            count += 1
+        building = f"{self.key}:building"
+        await self.redis.set(building, bytes(bitmap))
+        await self.redis.rename(building, self.key)
+        fill = int.from_bytes(bitmap, "big").bit_count() / self.bits
+        COUPON_FILTER_EXPECTED_FPR.set(fill**self.hashes)
+        log.info(f"coupon filter rebuilt: {count} codes, {fill:.2%} of the bits set")
+        return count
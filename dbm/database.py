@@ -1,14 +1,98 @@
-from sqlalchemy import delete, insert, select, update
+import asyncio
+from functools import partial
+from typing import Any, AsyncIterator, Dict, List, Optional, Type
 
+from pydantic import BaseModel
+from sqlalchemy import ColumnElement, Select, delete, insert, inspect, select, update
+
+from config import settings
+from dbm.coupon_filter import CouponFilter
 from dbm.db_main import DbMain
 from dbm.models import Coupons, Transactions, Users
 from dbm.schemas import CouponsPd, TransactionFull, User, UserId
+from dbm.user_cache import UserCache
 
 
 class DbQueryMixin:
+    # Redis cache of users by email, None for no cache (see dbm.user_cache)
+    user_cache: Optional[UserCache] = None
+    # Bloom filter of coupon codes, None for none (see dbm.coupon_filter)
+    coupon_filter: Optional[CouponFilter] = None
+
+    async def iterate(
+        self,
+        model: Any,
+        where: Optional[ColumnElement[bool]] = None,
+        order_key: Optional[Any] = None,
+        page_size: int = settings.ITERATE_PAGE_SIZE,
+        data_class: Optional[Type[BaseModel]] = None,
+        prefetch: bool = True,
+        trusted: bool = False,
+    ) -> AsyncIterator[Any]:
+        """
+        Walk the rows of a table matching where in order_key order, one
+        page at a time, with keyset pagination: each page starts after
+        the last key of the previous one (WHERE key > last ORDER BY key
+        LIMIT page_size), so every page costs an index range read
+        instead of the OFFSET scan of all previous rows.
+
+        Example:
+            async for user in db.iterate(
+                Users, Users.trial == 1, data_class=UserId, page_size=500
+            ):
+                ...
+
+        Args:
+            model (Any): Mapped model class, e.g. Users.
+            where (Optional[ColumnElement[bool]]): Criterion of the rows.
+            order_key (Optional[Any]): Unique, indexed column to page on,
+                defaults to the primary key of the model.
+            page_size (int): Rows per page.
+            data_class (Optional[Type[BaseModel]]): Class of the rows,
+                None for row dicts.
+            prefetch (bool): Request the next page while the caller
+                processes the current one.
+            trusted (bool): Build rows without validation, see
+                DbMain.result_list().
+
+        Yields:
+            Any: data_class instance or row dict.
+        """
+        if order_key is None:
+            (order_key,) = inspect(model).primary_key
+
+        def page(after: Any) -> Select:
+            statement = select(model)
+            if where is not None:
+                statement = statement.where(where)
+            if after is not None:
+                statement = statement.where(order_key > after)
+            return statement.order_by(order_key).limit(page_size)
+
+        next_page = self.result(page(None))
+        try:
+            while next_page is not None:
+                rows = await next_page
+                next_page = None
+                if len(rows) == page_size:
+                    following = self.result(page(rows[-1][order_key.name]))
+                    if prefetch:
+                        next_page = asyncio.ensure_future(following)
+                    else:
+                        next_page = following
+                for row in await self.result_list(rows, data_class, trusted):
+                    yield row
+        finally:
+            if isinstance(next_page, asyncio.Future):
+                next_page.cancel()
+            elif next_page is not None:
+                next_page.close()
+
     async def get_coupon(self, coupon: str) -> CouponsPd:
         """
-        Get a coupon record by its coupon code.
+        Get a coupon record by its coupon code. Codes the coupon filter
+        knows to be missing are answered without a query, except for
+        reads from the primary.
 
         Args:
             coupon (str): Coupon code.
@@ -17,8 +101,13 @@ class DbQueryMixin:
             CouponsPd: Parsed coupon data object, or None if not found.
         """
         statement = select(Coupons).where(Coupons.coupon == coupon)
-        self.data_class = CouponsPd
-        result_ = await self.result_one(statement)
+        coupon_filter = self.coupon_filter
+        if coupon_filter is None or not self.cacheable_(statement):
+            return await self.result_one(statement, CouponsPd)
+        if not await coupon_filter.may_exist(coupon):
+            return None
+        result_ = await self.result_one(statement, CouponsPd)
+        await coupon_filter.checked(coupon, result_ is not None)
         return result_
 
     async def get_trans_by_id(self, trans_id: int) -> TransactionFull:
@@ -32,8 +121,7 @@ class DbQueryMixin:
             TransactionFull: Parsed transaction data object, or None if not found.
         """
         statement = select(Transactions).where(Transactions.id == trans_id)
-        self.data_class = TransactionFull
-        result_ = await self.result_one(statement)
+        result_ = await self.result_one(statement, TransactionFull)
         return result_
 
     async def get_trans_by_email(self, email: str) -> TransactionFull:
@@ -52,13 +140,13 @@ class DbQueryMixin:
             .order_by(Transactions.id.desc())
             .limit(1)
         )
-        self.data_class = TransactionFull
-        result_ = await self.result_one(statement)
+        result_ = await self.result_one(statement, TransactionFull)
         return result_
 
     async def get_user_by_email(self, email: str) -> UserId:
         """
-        Get a user record by email (case-insensitive).
+        Get a user record by email (case-insensitive), from the user
+        cache if there is one, except for reads from the primary.
 
         Args:
             email (str): Email address.
@@ -68,24 +156,74 @@ class DbQueryMixin:
         """
         email = email.lower()
         statement = select(Users).where(Users.email == email)
-        self.data_class = UserId
-        result_ = await self.result_one(statement)
+        cache = self.user_cache
+        if cache is None or not self.cacheable_(statement):
+            return await self.result_one(statement, UserId)
+        result_ = await cache.get(email)
+        if result_ is None:
+            result_ = await self.result_one(statement, UserId)
+            if result_ is not None:
+                await cache.put(result_)
+        return result_
+
+    async def forget_user_(self, email: str) -> None:
+        """Drop a user from the user cache once its write is done."""
+        if self.user_cache is not None:
+            await self.after_write_(partial(self.user_cache.forget, email))
+
+    async def get_user_by_trans_id(self, trans_id: int) -> UserId:
+        """
+        Get the user record of the email of a transaction, in one
+        statement so that it can be recorded in the same batch as the
+        transaction itself.
+
+        Args:
+            trans_id (int): Transaction ID.
+
+        Returns:
+            UserId: Parsed user ID data object, or None if not found.
+        """
+        email = select(Transactions.email).where(Transactions.id == trans_id)
+        statement = select(Users).where(Users.email == email.scalar_subquery())
+        result_ = await self.result_one(statement, UserId)
         return result_
 
-    async def update_trans_complete(self, trans_id: int) -> None:
+    async def get_coupon_by_trans_id(self, trans_id: int) -> CouponsPd:
+        """
+        Get the coupon record used in a transaction, in one statement so
+        that it can be recorded in the same batch as the transaction.
+
+        Args:
+            trans_id (int): Transaction ID.
+
+        Returns:
+            CouponsPd: Parsed coupon data object, or None if the
+                transaction has no coupon.
+        """
+        coupon = select(Transactions.coupon).where(Transactions.id == trans_id)
+        statement = select(Coupons).where(Coupons.coupon == coupon.scalar_subquery())
+        result_ = await self.result_one(statement, CouponsPd)
+        return result_
+
+    async def update_trans_complete(
+        self, trans_id: int, pending_only: bool = False
+    ) -> None:
         """
         Mark a transaction as complete by setting its 'complete' field to 1.
 
         Args:
             trans_id (int): Transaction ID.
+            pending_only (bool): Only update the transaction if it is not
+                complete yet, so that the update affects no row for an
+                already finished one.
 
         Returns:
             None
         """
-        statement = (
-            update(Transactions).where(Transactions.id == trans_id).values(complete=1)
-        )
-        await self.result(statement)
+        statement = update(Transactions).where(Transactions.id == trans_id)
+        if pending_only:
+            statement = statement.where(Transactions.complete == 0)
+        await self.result(statement.values(complete=1))
 
     async def update_trans_expires(self, expires: int, trans_id: int) -> None:
         """
@@ -105,17 +243,18 @@ class DbQueryMixin:
         )
         await self.result(statement)
 
-    async def insert_email(self, user: User) -> None:
+    async def create_user(self, user: User) -> UserId:
         """
-        Insert a new user record into the database.
+        Insert a new user record and return it, built from the inserted
+        values and the id reported by the database service.
 
         Args:
             user (User): User data object.
 
         Returns:
-            None
+            UserId: Inserted user.
         """
-        statement = insert(Users).values(
+        values = dict(
             email=user.email,
             code=user.code,
             created=user.created,
@@ -130,20 +269,96 @@ class DbQueryMixin:
             plan=user.plan,
             trial=user.trial,
         )
-        await self.result_insert(statement)
+        statement = insert(Users).values(**values)
+        inserted = await self.result_insert(statement)
+        if not inserted.last_insert_id:
+            # database service that does not report insert ids
+            with self.primary():
+                return await self.get_user_by_email(user.email)
+        created = UserId(
+            **values,
+            id=inserted.last_insert_id,
+            cn=None,
+            coupon=None,
+            note=None,
+        )
+        if self.user_cache is not None:
+            await self.user_cache.put(created)
+        return created
+
+    async def insert_email(self, user: User) -> None:
+        """
+        Insert a new user record into the database.
+
+        Args:
+            user (User): User data object.
+
+        Returns:
+            None
+        """
+        await self.create_user(user)
+
+    @staticmethod
+    def coupon_values(data: CouponsPd) -> Dict[str, Any]:
+        """Column values of a new coupon."""
+        return dict(
+            coupon=data.coupon,
+            percent=data.percent,
+            created=data.created,
+            expiration=data.expiration,
+            plans=data.plans,
+        )
+
+    async def insert_coupon(self, data: CouponsPd) -> None:
+        """
+        Insert a new coupon record, added to the coupon filter first.
+
+        Args:
+            data (CouponsPd): Coupon data object.
+        """
+        if self.coupon_filter is not None:
+            await self.coupon_filter.add([data.coupon])
+        statement = insert(Coupons).values(**self.coupon_values(data))
+        await self.result(statement)
+
+    async def insert_coupons_many(self, coupons: List[CouponsPd]) -> int:
+        """
+        Insert many new coupons with multi-row inserts, in one round
+        trip to the database service, added to the coupon filter first.
+
+        Args:
+            coupons (List[CouponsPd]): Coupon data objects.
+
+        Returns:
+            int: Number of inserted coupons.
+        """
+        if self.coupon_filter is not None:
+            await self.coupon_filter.add(c.coupon for c in coupons)
+        rows = [self.coupon_values(c) for c in coupons]
+        return await self.insert_many(Coupons, rows)
+
+    async def delete_coupons(self, coupons: List[str]) -> None:
+        """
+        Delete coupon records by code, e.g. coupons that were never given.
+
+        Args:
+            coupons (List[str]): Coupon codes.
+        """
+        statement = delete(Coupons).where(Coupons.coupon.in_(coupons))
+        await self.result(statement)
 
     async def insert_transaction(self, data: TransactionFull) -> TransactionFull:
         """
-        Insert a new transaction record and return the most recent transaction
-        for the given email.
+        Insert a new transaction record and return it, built from the
+        inserted values and the id reported by the database service.
 
         Args:
             data (TransactionFull): Transaction data object.
 
         Returns:
-            TransactionFull: Most recent transaction for the email.
+            TransactionFull: Inserted transaction.
         """
-        statement = insert(Transactions).values(
+        values = dict(
             system=data.system,
             data=data.data,
             days=data.days,
@@ -160,9 +375,13 @@ class DbQueryMixin:
             check_order_id=data.check_order_id,
             refund=data.refund,
         )
-        await self.result_insert(statement)
-        result = await self.get_trans_by_email(data.email)
-        return result
+        statement = insert(Transactions).values(**values)
+        inserted = await self.result_insert(statement)
+        if not inserted.last_insert_id:
+            # database service that does not report insert ids
+            with self.primary():
+                return await self.get_trans_by_email(data.email)
+        return TransactionFull(**values, id=inserted.last_insert_id)
 
     async def delete_trans_by_id(self, id: int) -> None:
         """
@@ -189,6 +408,7 @@ class DbQueryMixin:
         """
         statement = delete(Users).where(Users.email == email)
         await self.result(statement)
+        await self.forget_user_(email)
 
 
 class DbQuery(DbMain, DbQueryMixin):
@@ -198,6 +418,11 @@ class DbQuery(DbMain, DbQueryMixin):
 dbq = DbQuery()
 
 
-async def db():
-    db = DbQuery()
-    return db
+async def db() -> DbQuery:
+    """
+    Database dependency. DbQuery instances keep no per-call state, so
+    one process-wide instance serves all concurrent requests; each
+    request gets its own scoped view of it, whose identity map saves
+    repeated lookups of the same user or coupon.
+    """
+    return dbq.scoped()
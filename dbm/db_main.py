@@ -1,50 +1,559 @@
 import json
-from typing import List, Optional
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from types import MethodType
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Type,
+)
 
-from grpclib.client import Channel
 from pydantic import BaseModel
+from sqlalchemy import Select, Table, Update, and_, func, insert, update
 from sqlalchemy.dialects import mysql
-from sqlalchemy.ext.asyncio import create_async_engine
-from sqlalchemy.sql import ClauseElement, Executable
+from sqlalchemy.sql import ClauseElement, ColumnElement, Executable, operators
+from sqlalchemy.sql.elements import BinaryExpression, BindParameter
 
 from config import settings
-from grpc_lib import TestStub
+from dbm.coalesce import singleflight
+from dbm.materialize import construct_rows
+from dbm.metrics import IDENTITY_MAP_LOOKUPS
+from dbm.resilience import call, stream_call
+from dbm.row_codec import decode_columns
+from dbm.schemas import InsertResult
+from dbm.sql_cache import sql_cache
+from dbm.statement_metrics import statement_metrics
+from grpc_lib import BatchResponse, Encoding, EndpointResponse, Param, TestStub
+from libs.logs import log
 
+Rows = str | List[Dict[str, Any]]
 
-async def request(data: str) -> str:
+# set by DbMain.primary(): send reads of the current task to the primary
+_primary_only: ContextVar[bool] = ContextVar("primary_only", default=False)
+
+
+def response_rows(response: EndpointResponse) -> Rows:
+    """
+    Returns the JSON text of a response, or its decoded rows if the
+    database service answered in the columnar encoding.
+    A service that does not support the columnar encoding answers with
+    JSON, so JSON stays the fallback whatever was asked.
+
+    Args:
+        response (EndpointResponse): Database service response.
+
+    Returns:
+        Rows: JSON-formatted string or list of row dicts.
+    """
+    if response.encoding == Encoding.COLUMNAR:
+        return decode_columns(response.columns)
+    return response.test_res
+
+
+async def request_response(
+    data: str,
+    encoding: Encoding = Encoding.JSON,
+    params: Optional[List[Param]] = None,
+    read: bool = False,
+    retry: bool = False,
+    timeout: Optional[float] = None,
+) -> EndpointResponse:
+    """
+    Sends a SQL query string via gRPC to the database service and
+    returns its response.
+    The call is multiplexed over a channel of the process-wide pool
+    of the primary or, for a read, of a read replica, with a deadline
+    and through the circuit breaker of the endpoint (see dbm.resilience).
+
+    Args:
+        data (str): SQL query string to execute, or SQL template with
+            %s placeholders if params is given.
+        encoding (Encoding): Result encoding to ask for.
+        params (Optional[List[Param]]): Parameters of the template.
+        read (bool): The query only reads and may go to a replica.
+        retry (bool): The query is idempotent and may be retried.
+        timeout (Optional[float]): Deadline in seconds, defaults to
+            settings.GRPC_TIMEOUT.
+
+    Returns:
+        EndpointResponse: Result rows, insert id and affected rows.
+    """
+
+    def send(stub: TestStub) -> Awaitable[EndpointResponse]:
+        return stub.test(
+            test=data,
+            encoding=encoding,
+            parameterized=params is not None,
+            params=params,
+        )
+
+    return await call(send, read, retry, timeout)
+
+
+async def request(
+    data: str,
+    encoding: Encoding = Encoding.JSON,
+    params: Optional[List[Param]] = None,
+    read: bool = False,
+    retry: bool = False,
+    timeout: Optional[float] = None,
+) -> Rows:
     """
     Sends a SQL query string via gRPC to the database service and
     returns the JSON-formatted response as a string.
 
     Args:
-        data (str): SQL query string to execute.
+        data (str): SQL query string to execute, or SQL template with
+            %s placeholders if params is given.
+        encoding (Encoding): Result encoding to ask for.
+        params (Optional[List[Param]]): Parameters of the template.
+        read (bool): The query only reads and may go to a replica.
+        retry (bool): The query is idempotent and may be retried.
+        timeout (Optional[float]): Deadline in seconds, defaults to
+            settings.GRPC_TIMEOUT.
 
     Returns:
-        str: JSON-formatted string with the results of the executed
-            SQL query.
+        Rows: JSON-formatted string with the results of the executed
+            SQL query, or the decoded rows of a columnar result.
     """
-    async with Channel(host=settings.GRPC_HOST, port=settings.GRPC_PORT) as channel:
-        stub = TestStub(channel)
-        response = await stub.test(test=data)
-        return response.test_res
+    response = await request_response(data, encoding, params, read, retry, timeout)
+    return response_rows(response)
 
 
-class DbMain:
+async def request_batch(
+    data: List[str],
+    atomic: bool = False,
+    expected_rows: Optional[List[int]] = None,
+    read: bool = False,
+    retry: bool = False,
+    timeout: Optional[float] = None,
+) -> BatchResponse:
     """
-    Convert SQL Alchemy statement to plain SQL query text ,
-    send it to database service, where the query will be executed,
-    receive result, wrap it to dataclass and return
+    Sends several SQL query strings in one gRPC call; the database
+    service executes them in order.
+
+    Args:
+        data (List[str]): SQL query strings to execute.
+        atomic (bool): Execute them in one database transaction.
+        expected_rows (Optional[List[int]]): Number of rows every query
+            must affect for an atomic batch to commit, -1 for any.
+        read (bool): All queries only read and may go to a replica.
+        retry (bool): All queries are idempotent, the batch may be retried.
+        timeout (Optional[float]): Deadline in seconds, defaults to
+            settings.GRPC_TIMEOUT.
+
+    Returns:
+        BatchResponse: JSON-formatted result, insert id and affected
+            rows of every query, in the same order, or the reason of
+            the rollback of an atomic batch.
     """
 
-    def __init__(self) -> None:
+    def send(stub: TestStub) -> Awaitable[BatchResponse]:
+        return stub.batch(tests=data, atomic=atomic, expected_rows=expected_rows)
+
+    return await call(send, read, retry, timeout)
+
+
+async def request_stream(
+    data: str,
+    chunk_size: int,
+    encoding: Encoding = Encoding.JSON,
+    params: Optional[List[Param]] = None,
+    read: bool = False,
+    retry: bool = False,
+    timeout: Optional[float] = None,
+) -> AsyncIterator[Rows]:
+    """
+    Sends a SQL query string and receives its result as a stream of
+    chunks of at most chunk_size rows.
+
+    Args:
+        data (str): SQL query string to execute, or SQL template with
+            %s placeholders if params is given.
+        chunk_size (int): Maximum number of rows per chunk.
+        encoding (Encoding): Result encoding to ask for.
+        params (Optional[List[Param]]): Parameters of the template.
+        read (bool): The query only reads and may go to a replica.
+        retry (bool): The query is idempotent and may be retried, as
+            long as no chunk was received.
+        timeout (Optional[float]): Seconds to wait for each chunk,
+            defaults to settings.GRPC_STREAM_IDLE_TIMEOUT.
+
+    Yields:
+        Rows: JSON-formatted chunk or decoded rows of a columnar chunk.
+    """
+
+    def send(stub: TestStub) -> AsyncIterator[EndpointResponse]:
+        return stub.stream(
+            test=data,
+            chunk_size=chunk_size,
+            encoding=encoding,
+            parameterized=params is not None,
+            params=params,
+        )
+
+    async for response in stream_call(send, read, retry, timeout):
+        yield response_rows(response)
+
+
+class TransactionRolledBack(Exception):
+    """
+    An atomic batch was rolled back by the database service: a statement
+    failed or did not affect the expected number of rows.
+    """
+
+    def __init__(self, index: int, statement: str, error: str) -> None:
+        super().__init__(f"statement {index} rolled back: {error}")
+        self.index = index
+        self.statement = statement
+        self.error = error
+
+
+def _nth(values: List[int], i: int) -> int:
+    """Value i of a per-statement list, 0 if the server did not send it."""
+    return values[i] if i < len(values) else 0
+
+
+class BatchItem:
+    """
+    Placeholder for the result of one statement of a batch.
+    The value is set when the batch has been executed.
+    """
+
+    def __init__(
+        self,
+        statement: ClauseElement | Executable,
+        data_class: Optional[Type[BaseModel]],
+        kind: str,
+        trusted: bool = False,
+        expected_rows: int = -1,
+    ) -> None:
+        self.statement = statement
+        self.data_class = data_class
+        self.kind = kind
+        self.trusted = trusted
+        self.expected_rows = expected_rows
+        self.value: Any = None
+
+
+class Batch:
+    """
+    Collects statements and sends them to the database service in one
+    round trip.
+
+    Query methods of the DbQuery classes can be called on a batch as on
+    the database object itself: instead of executing, every statement is
+    recorded and the call returns a BatchItem, whose value is filled in
+    after the batch is executed. Only methods issuing a single statement
+    whose parameters do not depend on results of the same batch can be
+    recorded this way.
+
+    An atomic batch runs in one database transaction: if a statement
+    fails or affects another number of rows than set by expect_rows(),
+    nothing is applied and execute() raises TransactionRolledBack.
+    """
+
+    def __init__(self, db: "DbMain", atomic: bool = False) -> None:
+        self._db = db
+        self.atomic = atomic
+        self.items: List[BatchItem] = []
+        self._expected_rows = -1
+        self._after_write: List[Callable[[], Awaitable[None]]] = []
+
+    def __getattr__(self, name: str) -> Any:
+        attr = getattr(self._db, name)
+        if isinstance(attr, MethodType):
+            return MethodType(attr.__func__, self)
+        return attr
+
+    def _add(
+        self,
+        statement: ClauseElement | Executable,
+        kind: str,
+        data_class: Optional[Type[BaseModel]] = None,
+        trusted: bool = False,
+    ) -> BatchItem:
+        item = BatchItem(statement, data_class, kind, trusted, self._expected_rows)
+        self.items.append(item)
+        return item
+
+    @contextmanager
+    def expect_rows(self, rows: int) -> Iterator[None]:
+        """
+        Require the statements recorded inside the block to affect
+        exactly rows rows, so that a guarded update whose guard no
+        longer holds rolls back the whole atomic batch.
+
+        Example:
+            async with db.transaction() as tx:
+                with tx.expect_rows(1):
+                    await tx.update_trans_complete(trans_id, pending_only=True)
+                await tx.update_trans_expires(expires, trans_id)
+
+        Args:
+            rows (int): Number of rows affected by every statement.
+        """
+        previous, self._expected_rows = self._expected_rows, rows
+        try:
+            yield
+        finally:
+            self._expected_rows = previous
+
+    async def result(
+        self,
+        statement: ClauseElement | Executable,
+        data_class: Optional[Type[BaseModel]] = None,
+        trusted: bool = False,
+    ) -> BatchItem:
+        """Record a statement whose value will be a list of data_class."""
+        return self._add(statement, "list", data_class, trusted)
+
+    async def result_one(
+        self,
+        statement: ClauseElement | Executable,
+        data_class: Optional[Type[BaseModel]] = None,
+        trusted: bool = False,
+    ) -> BatchItem:
+        """Record a statement whose value will be the first row or None."""
+        return self._add(statement, "one", data_class, trusted)
+
+    async def result_insert(
+        self,
+        statement: ClauseElement | Executable,
+    ) -> BatchItem:
+        """Record an insert statement whose value will be an InsertResult."""
+        return self._add(statement, "insert")
+
+    async def increment(
+        self,
+        column: Any,
+        where: ColumnElement,
+        by: int = 1,
+        guard: Optional[ColumnElement] = None,
+        timeout: Optional[float] = None,
+    ) -> BatchItem:
+        """
+        Record a counter update whose value will be the new value of the
+        counter, or None if no row matched. The batch has its own
+        deadline, timeout is ignored.
+        """
+        return self._add(self._db.counter_(column, where, by, guard), "counter")
+
+    def cacheable_(self, statement: ClauseElement | Executable) -> bool:
+        """Statements of a batch are recorded, never answered from a cache."""
+        return False
+
+    async def after_write_(self, fn: Callable[[], Awaitable[None]]) -> None:
+        """Defer fn until the batch has been executed."""
+        self._after_write.append(fn)
+
+    async def execute(self) -> None:
         """
-        Initializes the asynchronous database engine and sets
-        the data_class attribute for parsing query results.
+        Send all recorded statements and fill in the values of the items,
+        then run the calls deferred by after_write_(), even if the batch
+        failed (they only drop cached data).
         """
-        self.engine_ = create_async_engine(
-            "mysql+aiomysql://",
+        try:
+            await self._execute()
+        finally:
+            after_write, self._after_write = self._after_write, []
+            for fn in after_write:
+                await fn()
+
+    async def _execute(self) -> None:
+        if not self.items:
+            return
+        texts = [self._db.sql_text_(item.statement) for item in self.items]
+        for item in self.items:
+            if not self._db.is_read_(item.statement):
+                self._db.writing_(item.statement)
+        if self.atomic:
+            expected_rows = [item.expected_rows for item in self.items]
+            response = await request_batch(texts, True, expected_rows)
+        else:
+            statements = [item.statement for item in self.items]
+            retry = all(self._db.is_read_(st) for st in statements)
+            read = all(self._db.read_(st) for st in statements)
+            response = await request_batch(texts, read=read, retry=retry)
+        if response.rolled_back:
+            i = response.failed_index
+            raise TransactionRolledBack(i, texts[i], response.error)
+        for i, (item, res) in enumerate(zip(self.items, response.test_res)):
+            if item.kind == "insert":
+                item.value = InsertResult(
+                    last_insert_id=_nth(response.last_insert_ids, i),
+                    rows_affected=_nth(response.rows_affected, i),
+                )
+                continue
+            if item.kind == "counter":
+                if _nth(response.rows_affected, i):
+                    item.value = _nth(response.last_insert_ids, i)
+                continue
+            result_list = await self._db.result_list(res, item.data_class, item.trusted)
+            if item.kind == "one":
+                item.value = result_list[0] if len(result_list) > 0 else None
+            else:
+                item.value = result_list
+
+
+class IdentityMap:
+    """
+    Rows of the primary-key and unique-key lookups made during one API
+    request, so that looking up the same user or coupon again costs no
+    round trip. Writes to a table forget all rows of the table.
+
+    A lookup is a SELECT of all columns of one table whose only
+    criterion is col = value, col being its primary key, a column with
+    a single-column unique index or a column marked with
+    info={"unique_key": True}.
+    """
+
+    def __init__(self) -> None:
+        # (table, column, value) -> (rows, read from the primary)
+        self._rows: Dict[Tuple[str, str, Any], Tuple[List[Dict], bool]] = {}
+
+    @staticmethod
+    def unique_key(column: Any) -> bool:
+        """True if column identifies at most one row of its table."""
+        if column.primary_key or column.unique or column.info.get("unique_key"):
+            return True
+        return any(
+            index.unique and list(index.columns) == [column]
+            for index in column.table.indexes
         )
-        self.data_class = None
+
+    def key(self, statement: ClauseElement | Executable) -> Optional[Tuple]:
+        """
+        Identity of a lookup statement, None if it is not a lookup.
+
+        Args:
+            statement (ClauseElement | Executable): SQLAlchemy statement.
+
+        Returns:
+            Optional[Tuple]: (table name, column name, value).
+        """
+        if not isinstance(statement, Select) or not DbMain.is_read_(statement):
+            return None
+        froms = statement.get_final_froms()
+        if len(froms) != 1 or not isinstance(froms[0], Table):
+            return None
+        table = froms[0]
+        if (
+            statement._order_by_clauses
+            or statement._group_by_clauses
+            or statement._limit_clause is not None
+            or statement._offset_clause is not None
+            or statement._distinct
+            or list(statement.selected_columns) != list(table.columns)
+        ):
+            return None
+        where = statement.whereclause
+        if (
+            not isinstance(where, BinaryExpression)
+            or where.operator is not operators.eq
+            or not isinstance(where.right, BindParameter)
+            or getattr(where.left, "table", None) is not table
+            or not self.unique_key(where.left)
+        ):
+            return None
+        return table.name, where.left.name, where.right.effective_value
+
+    def get(self, key: Tuple, primary: bool) -> Optional[List[Dict]]:
+        """Rows of a lookup, None if unknown (or read from a replica)."""
+        entry = self._rows.get(key)
+        if entry is None or (primary and not entry[1]):
+            IDENTITY_MAP_LOOKUPS.labels("miss").inc()
+            return None
+        IDENTITY_MAP_LOOKUPS.labels("hit").inc()
+        return entry[0]
+
+    def put(self, key: Tuple, rows: List[Dict], primary: bool) -> None:
+        self._rows[key] = (rows, primary)
+
+    def forget(self, statement: ClauseElement | Executable) -> None:
+        """Forget the rows of the table written by a statement (all if unknown)."""
+        table = getattr(statement, "table", None)
+        if not isinstance(table, Table):
+            self._rows.clear()
+            return
+        for key in [k for k in self._rows if k[0] == table.name]:
+            del self._rows[key]
+
+
+class ScopedDb:
+    """
+    View of a DbQuery for one API request, with its own identity map.
+
+    Query methods of the DbQuery classes run on it as on the database
+    object itself; lookups by primary or unique key are answered from
+    the identity map after their first execution, and every write
+    issued through the view (directly, in a batch or in a transaction)
+    forgets the rows of its table. Each call gets fresh model
+    instances, so callers may modify them.
+    """
+
+    def __init__(self, db: "DbMain") -> None:
+        self._db = db
+        self.identity = IdentityMap()
+
+    def __getattr__(self, name: str) -> Any:
+        attr = getattr(self._db, name)
+        if isinstance(attr, MethodType):
+            return MethodType(attr.__func__, self)
+        return attr
+
+    def writing_(self, statement: ClauseElement | Executable) -> None:
+        self.identity.forget(statement)
+
+    async def result_one(
+        self,
+        statement: ClauseElement | Executable,
+        data_class: Optional[Type[BaseModel]] = None,
+        encoding: Optional[str] = None,
+        trusted: bool = False,
+        primary: bool = False,
+        timeout: Optional[float] = None,
+        coalesce: bool = False,
+    ) -> Optional[BaseModel]:
+        """DbMain.result_one() answered from the identity map for lookups."""
+        key = self.identity.key(statement)
+        if key is None:
+            return await DbMain.result_one(
+                self,
+                statement,
+                data_class,
+                encoding,
+                trusted,
+                primary,
+                timeout,
+                coalesce,
+            )
+        from_primary = not self.read_(statement, primary)
+        rows = self.identity.get(key, from_primary)
+        if rows is None:
+            res = await self.query(
+                statement, encoding, primary=primary, timeout=timeout, coalesce=coalesce
+            )
+            rows = await self.result_list(res)
+            self.identity.put(key, rows, from_primary)
+        result_list = await self.result_list(rows, data_class, trusted)
+        if len(result_list) > 0:
+            return result_list[0]
+
+
+class DbMain:
+    """
+    Convert SQL Alchemy statement to plain SQL query text ,
+    send it to database service, where the query will be executed,
+    receive result, wrap it to dataclass and return
+    """
 
     def sql_text_(
         self,
@@ -52,6 +561,9 @@ class DbMain:
     ) -> str:
         """
         Converts a SQLAlchemy statement into its SQL string form.
+        The statement is compiled once per shape and its values are
+        rendered into the cached template (see dbm.sql_cache); shapes
+        that can not be cached are compiled with literal binds.
 
         Args:
             statement (ClauseElement | Executable): SQLAlchemy
@@ -60,6 +572,9 @@ class DbMain:
         Returns:
             str: The SQL query as a string.
         """
+        text = sql_cache.render(statement)
+        if text is not None:
+            return text
         compiled = statement.compile(
             dialect=mysql.dialect(), compile_kwargs={"literal_binds": True}
         )
@@ -67,31 +582,208 @@ class DbMain:
             text = str(compiled) % compiled.params
             return text
         except Exception as ex:
-            print("ex", ex)
+            log.error(f"rendering the SQL text failed ex={ex}")
+
+    def sql_query_(
+        self,
+        statement: ClauseElement | Executable,
+        parameterized: Optional[bool] = None,
+    ) -> Tuple[str, Optional[List[Param]]]:
+        """
+        SQL to send for a statement: a template with %s placeholders
+        and its typed parameters for a parameterized query, or the SQL
+        text with inlined literals (and None) otherwise. Shapes that
+        can not be cached are always sent as SQL text.
+
+        Args:
+            statement (ClauseElement | Executable): SQLAlchemy statement.
+            parameterized (Optional[bool]): Send a parameterized query,
+                defaults to settings.GRPC_PARAMETERIZED.
+
+        Returns:
+            Tuple[str, Optional[List[Param]]]: SQL and its parameters.
+        """
+        if parameterized is None:
+            parameterized = settings.GRPC_PARAMETERIZED
+        if parameterized:
+            template, statement_key = sql_cache.template(statement)
+            if template is not None:
+                return template.query(statement_key)
+        return self.sql_text_(statement), None
+
+    @staticmethod
+    def encoding_(encoding: Optional[str] = None) -> Encoding:
+        """
+        Result encoding to ask from the database service.
+
+        Args:
+            encoding (Optional[str]): "json" or "columnar",
+                defaults to settings.GRPC_ENCODING.
+
+        Returns:
+            Encoding: Protocol encoding value.
+        """
+        return Encoding[(encoding or settings.GRPC_ENCODING).upper()]
+
+    @staticmethod
+    def is_read_(statement: ClauseElement | Executable) -> bool:
+        """
+        True if a statement only reads: a SELECT without FOR UPDATE,
+        which can be retried and served by a read replica.
+
+        Args:
+            statement (ClauseElement | Executable): SQLAlchemy statement.
+
+        Returns:
+            bool: The statement only reads.
+        """
+        if not getattr(statement, "is_select", False):
+            return False
+        return getattr(statement, "_for_update_arg", None) is None
+
+    def read_(
+        self, statement: ClauseElement | Executable, primary: bool = False
+    ) -> bool:
+        """
+        True if a statement may be sent to a read replica: a read,
+        outside of a primary() block and without the per-call primary
+        override.
+
+        Args:
+            statement (ClauseElement | Executable): SQLAlchemy statement.
+            primary (bool): Read from the primary anyway.
+
+        Returns:
+            bool: The statement can be served by a replica.
+        """
+        if primary or _primary_only.get():
+            return False
+        return self.is_read_(statement)
+
+    def writing_(self, statement: ClauseElement | Executable) -> None:
+        """
+        Called before a write statement is sent; the scoped view of
+        scoped() forgets the rows of the written table here.
+        """
+
+    def cacheable_(self, statement: ClauseElement | Executable) -> bool:
+        """
+        True if a read may be answered from a cache of the DbQuery
+        methods (see dbm.user_cache): when it could go to a replica, as
+        cached rows are as stale as a replica may be. Batches record
+        their statements and are never answered from a cache.
+
+        Args:
+            statement (ClauseElement | Executable): SQLAlchemy statement.
+
+        Returns:
+            bool: A cache may answer the statement.
+        """
+        return self.read_(statement)
+
+    async def after_write_(self, fn: Callable[[], Awaitable[None]]) -> None:
+        """
+        Run fn (e.g. dropping cached rows) once a write issued by a
+        DbQuery method is done: right away, or in a batch or transaction
+        once it has been executed.
+
+        Args:
+            fn (Callable[[], Awaitable[None]]): Call to make.
+        """
+        await fn()
+
+    def scoped(self) -> ScopedDb:
+        """
+        View of this DbQuery with an identity map living as long as the
+        view, e.g. one API request (see the db() dependency).
+
+        Returns:
+            ScopedDb: Request-scoped view.
+        """
+        return ScopedDb(self)
+
+    @contextmanager
+    def primary(self) -> Iterator[None]:
+        """
+        Send the reads of the current task to the primary inside the
+        block, for read-your-writes paths that must not see a lagging
+        replica.
+
+        Example:
+            with db.primary():
+                user = await db.get_user_by_email(email)
+        """
+        token = _primary_only.set(True)
+        try:
+            yield
+        finally:
+            _primary_only.reset(token)
 
     async def query(
         self,
         statement: ClauseElement | Executable,
-    ) -> str:
+        encoding: Optional[str] = None,
+        parameterized: Optional[bool] = None,
+        primary: bool = False,
+        timeout: Optional[float] = None,
+        coalesce: bool = False,
+    ) -> Rows:
         """
         Converts a SQLAlchemy statement to raw SQL text using the
         sql_text_() method, sends it to a function that requests an
         external database service which connects to the DB, executes
-        the query, and returns the result as JSON-formatted text.
+        the query, and returns the decoded result. Latency, rows and
+        response size of the call are recorded by statement fingerprint
+        and calling method (see dbm.statement_metrics).
 
         Args:
             statement (ClauseElement | Executable): SQL statement.
+            encoding (Optional[str]): Result encoding to ask for.
+            parameterized (Optional[bool]): Send a SQL template and typed
+                parameters, see sql_query_().
+            primary (bool): Send a read to the primary, see read_().
+            timeout (Optional[float]): Deadline in seconds, defaults to
+                settings.GRPC_TIMEOUT. Reads are retried on failure.
+            coalesce (bool): Share the call with identical reads in
+                flight (see dbm.coalesce); their callers then get the
+                same decoded rows, which must not be modified.
 
         Returns:
-            str: JSON-formatted string response from the external
-                database service.
+            Rows: Decoded rows of the JSON or columnar result.
         """
-        query_ = self.sql_text_(statement)
-        return await request(query_)
+        query_, params = self.sql_query_(statement, parameterized)
+        encoding_ = self.encoding_(encoding)
+        read = self.read_(statement, primary)
+        is_read = self.is_read_(statement)
+        series = statement_metrics.series(statement, query_, __file__)
+
+        async def send() -> Rows:
+            with series.measure(query_) as call_:
+                response = await request_response(
+                    query_, encoding_, params, read=read, retry=is_read, timeout=timeout
+                )
+            rows = response_rows(response)
+            if isinstance(rows, str):
+                rows = json.loads(rows) if len(rows) > 0 else []
+            call_.record(response, len(rows) if is_read else response.rows_affected)
+            return rows
+
+        if not is_read:
+            self.writing_(statement)
+        if coalesce and is_read and settings.GRPC_COALESCE:
+            params_ = None if params is None else tuple(bytes(p) for p in params)
+            return await singleflight.do((query_, params_, encoding_, read), send)
+        return await send()
 
     async def result(
         self,
         statement: ClauseElement | Executable,
+        data_class: Optional[Type[BaseModel]] = None,
+        encoding: Optional[str] = None,
+        trusted: bool = False,
+        primary: bool = False,
+        timeout: Optional[float] = None,
+        coalesce: bool = False,
     ) -> Optional[List[BaseModel]]:
         """
         Sends a SQLAlchemy statement to convert it to text and send
@@ -99,59 +791,209 @@ class DbMain:
 
         Args:
             statement (ClauseElement | Executable): SQL statement.
+            data_class (Optional[Type[BaseModel]]): Class of the rows.
+            encoding (Optional[str]): Result encoding to ask for.
+            trusted (bool): Build rows without validation, see result_list().
+            primary (bool): Send a read to the primary, see read_().
+            timeout (Optional[float]): Deadline in seconds, see query().
+            coalesce (bool): Share the call with identical reads in
+                flight, see query().
 
         Returns:
             Optional[List[BaseModel]]: List of parsed data_class
                 instances, or None if empty.
         """
-        res = await self.query(statement)
-        return await self.result_list(res)
+        res = await self.query(
+            statement, encoding, primary=primary, timeout=timeout, coalesce=coalesce
+        )
+        return await self.result_list(res, data_class, trusted)
 
     async def result_insert(
         self,
         statement: ClauseElement | Executable,
-    ) -> BaseModel | None:
+        timeout: Optional[float] = None,
+    ) -> InsertResult:
         """
         Converts an insert SQLAlchemy statement to raw SQL text, sends it
         to the external database service for execution, and returns the
-        result.
+        id of the inserted row and the number of affected rows.
 
         Args:
             statement (ClauseElement | Executable): SQL insert statement.
+            timeout (Optional[float]): Deadline in seconds, defaults to
+                settings.GRPC_TIMEOUT. Inserts are never retried.
 
         Returns:
-            BaseModel | None: Parsed result returned by the insert operation
-                if the statement includes RETURNING; otherwise None.
+            InsertResult: Insert id and affected rows, both 0 if the
+                database service does not report them.
 
         Raises:
             Exception: If the external service reports an error or
                 the insert operation fails.
         """
-        res = await self.query(statement)
-        return res
+        query_, params = self.sql_query_(statement)
+        self.writing_(statement)
+        series = statement_metrics.series(statement, query_, __file__)
+        with series.measure(query_) as call_:
+            response = await request_response(
+                query_, Encoding.JSON, params, timeout=timeout
+            )
+        call_.record(response, response.rows_affected)
+        return InsertResult(
+            last_insert_id=response.last_insert_id,
+            rows_affected=response.rows_affected,
+        )
+
+    async def insert_many(
+        self,
+        table: Any,
+        rows: List[Dict[str, Any]],
+        chunk_size: int = settings.INSERT_CHUNK_SIZE,
+    ) -> int:
+        """
+        Insert many rows with multi-row INSERT ... VALUES (...), (...)
+        statements of at most chunk_size rows each, all sent in one
+        round trip to the database service.
+
+        Args:
+            table (Any): Mapped model class or Table.
+            rows (List[Dict[str, Any]]): Column values of every row, all
+                with the same columns.
+            chunk_size (int): Maximum number of rows per statement.
+
+        Returns:
+            int: Number of inserted rows.
+        """
+        if not rows:
+            return 0
+        async with self.batch() as b:
+            items = [
+                await b.result_insert(insert(table).values(rows[i : i + chunk_size]))
+                for i in range(0, len(rows), chunk_size)
+            ]
+        return sum(item.value.rows_affected for item in items)
+
+    @staticmethod
+    def counter_(
+        column: Any,
+        where: ColumnElement,
+        by: int,
+        guard: Optional[ColumnElement] = None,
+    ) -> Update:
+        """
+        UPDATE statement adding by to an integer column. The new value is
+        passed through LAST_INSERT_ID(expr), so the database service
+        reports it as the insert id of the statement.
+        """
+        if guard is not None:
+            where = and_(where, guard)
+        value = func.LAST_INSERT_ID(func.coalesce(column, 0) + by)
+        return update(column.table).where(where).values({column: value})
+
+    async def increment(
+        self,
+        column: Any,
+        where: ColumnElement,
+        by: int = 1,
+        guard: Optional[ColumnElement] = None,
+        timeout: Optional[float] = None,
+    ) -> Optional[int]:
+        """
+        Atomically add by to an integer column of the row matching where,
+        on the database server, and return its new value in the same
+        round trip. Concurrent calls can not lose updates, and a guard
+        (e.g. the counter being below its limit) is checked by the same
+        statement.
+
+        Example:
+            used = await db.increment(
+                Coupons.times_used,
+                Coupons.coupon == code,
+                guard=Coupons.times_used < Coupons.max_use_limit,
+            )
+
+        Args:
+            column (Any): Mapped integer column, NULL counts as 0.
+            where (ColumnElement): Condition selecting one row.
+            by (int): Amount to add, negative to subtract.
+            guard (Optional[ColumnElement]): Extra condition the row must
+                meet to be updated.
+            timeout (Optional[float]): Deadline in seconds, defaults to
+                settings.GRPC_TIMEOUT. Counter updates are never retried.
+
+        Returns:
+            Optional[int]: New value, None if no row matched where and guard.
+        """
+        statement = self.counter_(column, where, by, guard)
+        query_, params = self.sql_query_(statement)
+        self.writing_(statement)
+        series = statement_metrics.series(statement, query_, __file__)
+        with series.measure(query_) as call_:
+            response = await request_response(
+                query_, Encoding.JSON, params, timeout=timeout
+            )
+        call_.record(response, response.rows_affected)
+        if not response.rows_affected:
+            return None
+        return response.last_insert_id
+
+    async def decrement(
+        self,
+        column: Any,
+        where: ColumnElement,
+        by: int = 1,
+        timeout: Optional[float] = None,
+    ) -> Optional[int]:
+        """
+        Atomically subtract by from an integer column, never below 0.
+        See increment().
+
+        Returns:
+            Optional[int]: New value, None if no row matched where or the
+                counter is below by.
+        """
+        guard = func.coalesce(column, 0) >= by
+        return await self.increment(column, where, -by, guard, timeout)
 
     async def result_list(
         self,
-        res: str,
+        res: Rows,
+        data_class: Optional[Type[BaseModel]] = None,
+        trusted: bool = False,
     ) -> Optional[List[BaseModel]]:
         """
-        Parses a JSON string into a list of data_class instances.
+        Parses a JSON string (or already decoded rows) into a list
+        of data_class instances.
 
         Args:
-            res (str): JSON string of records.
+            res (Rows): JSON string of records or list of row dicts.
+            data_class (Optional[Type[BaseModel]]): Class of the records,
+                None to return the row dicts as they are.
+            trusted (bool): Rows come from our own database service:
+                skip pydantic validation and build instances with
+                model_construct() and per-field type coercion.
 
         Returns:
             Optional[List[BaseModel]]: List of parsed data_class
                 instances, or an empty list.
         """
-        result_ = []
-        if len(res) > 0:
-            result_ = [self.data_class(**r) for r in json.loads(res)]
-        return result_
+        if isinstance(res, str):
+            res = json.loads(res) if len(res) > 0 else []
+        if data_class is None:
+            return res
+        if trusted:
+            return construct_rows(data_class, res)
+        return [data_class(**r) for r in res]
 
     async def result_one(
         self,
         statement: ClauseElement | Executable,
+        data_class: Optional[Type[BaseModel]] = None,
+        encoding: Optional[str] = None,
+        trusted: bool = False,
+        primary: bool = False,
+        timeout: Optional[float] = None,
+        coalesce: bool = False,
     ) -> Optional[BaseModel]:
         """
         Sends a query and returns the first parsed data_class instance
@@ -159,11 +1001,108 @@ class DbMain:
 
         Args:
             statement (ClauseElement | Executable): SQL statement.
+            data_class (Optional[Type[BaseModel]]): Class of the rows.
+            encoding (Optional[str]): Result encoding to ask for.
+            trusted (bool): Build rows without validation, see result_list().
+            primary (bool): Send a read to the primary, see read_().
+            timeout (Optional[float]): Deadline in seconds, see query().
+            coalesce (bool): Share the call with identical reads in
+                flight, see query().
 
         Returns:
             Optional[BaseModel]: First parsed data_class instance or None.
         """
-        res = await self.query(statement)
-        result_list = await self.result_list(res)
+        res = await self.query(
+            statement, encoding, primary=primary, timeout=timeout, coalesce=coalesce
+        )
+        result_list = await self.result_list(res, data_class, trusted)
         if len(result_list) > 0:
             return result_list[0]
+
+    async def stream(
+        self,
+        statement: ClauseElement | Executable,
+        data_class: Optional[Type[BaseModel]] = None,
+        chunk_size: int = settings.GRPC_STREAM_CHUNK_SIZE,
+        encoding: Optional[str] = None,
+        trusted: bool = False,
+        parameterized: Optional[bool] = None,
+        primary: bool = False,
+        timeout: Optional[float] = None,
+    ) -> AsyncIterator[BaseModel]:
+        """
+        Executes a statement and yields its rows as data_class instances
+        while they arrive from the database service, one chunk at a time,
+        so memory stays bounded by the chunk size.
+
+        Args:
+            statement (ClauseElement | Executable): SQL statement.
+            data_class (Optional[Type[BaseModel]]): Class of the rows.
+            chunk_size (int): Maximum number of rows per chunk.
+            encoding (Optional[str]): Result encoding to ask for.
+            trusted (bool): Build rows without validation, see result_list().
+            parameterized (Optional[bool]): Send a SQL template and typed
+                parameters, see sql_query_().
+            primary (bool): Send a read to the primary, see read_().
+            timeout (Optional[float]): Seconds to wait for each chunk,
+                defaults to settings.GRPC_STREAM_IDLE_TIMEOUT.
+
+        Yields:
+            BaseModel: Parsed data_class instance.
+        """
+        query_, params = self.sql_query_(statement, parameterized)
+        async for chunk in request_stream(
+            query_,
+            chunk_size,
+            self.encoding_(encoding),
+            params,
+            read=self.read_(statement, primary),
+            retry=self.is_read_(statement),
+            timeout=timeout,
+        ):
+            for row in await self.result_list(chunk, data_class, trusted):
+                yield row
+
+    @asynccontextmanager
+    async def batch(self) -> AsyncIterator[Batch]:
+        """
+        Collect statements issued inside the block and execute them
+        in one round trip to the database service when the block exits.
+
+        Example:
+            async with db.batch() as b:
+                trans = await b.get_trans_by_id(trans_id)
+                await b.update_trans_complete(trans_id)
+            trans.value
+
+        Yields:
+            Batch: Recorder of the statements.
+        """
+        batch_ = Batch(self)
+        yield batch_
+        await batch_.execute()
+
+    @asynccontextmanager
+    async def transaction(self) -> AsyncIterator[Batch]:
+        """
+        Collect statements issued inside the block and execute them as
+        one database transaction, in one round trip to the database
+        service, when the block exits. Nothing is sent if the block
+        raises.
+
+        Example:
+            async with db.transaction() as tx:
+                with tx.expect_rows(1):
+                    await tx.update_trans_complete(trans_id, pending_only=True)
+                user = await tx.get_user_by_email(email)
+            user.value
+
+        Yields:
+            Batch: Atomic recorder of the statements.
+
+        Raises:
+            TransactionRolledBack: The transaction was rolled back.
+        """
+        batch_ = Batch(self, atomic=True)
+        yield batch_
+        await batch_.execute()
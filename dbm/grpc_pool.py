@@ -0,0 +1,421 @@
+"""
+Process-wide pool of long-lived gRPC channels to the database service.
+
+Each channel keeps one HTTP/2 connection open, and concurrent queries
+are multiplexed over it as separate streams, so a query costs a stream
+instead of a TCP + HTTP/2 handshake. A background task probes the
+channels with a cheap query, so dead connections are found before a
+call hits them; broken channels are reconnected with exponential
+backoff and skipped while they are backing off.
+
+The router sends reads to a pool per read replica endpoint, as long as
+the replica does not lag behind the primary, and everything else to
+the primary pool.
+"""
+
+import asyncio
+import json
+import random
+import time
+from contextlib import asynccontextmanager, suppress
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+from grpclib.client import Channel
+from grpclib.exceptions import GRPCError, StreamTerminatedError
+
+from config import settings
+from dbm.metrics import (
+    POOL_CHANNELS,
+    POOL_IN_FLIGHT,
+    POOL_RECONNECTS,
+    POOL_REQUESTS,
+    REPLICA_LAG,
+    ROUTED_REQUESTS,
+)
+from grpc_lib import TestStub
+from libs.logs import log
+
+CONNECTION_ERRORS = (ConnectionError, OSError, StreamTerminatedError)
+PROBE_ERRORS = CONNECTION_ERRORS + (asyncio.TimeoutError,)
+PROBE_QUERY = "SELECT 1"
+
+
+class PooledChannel:
+    """
+    gRPC channel with its usage counter and reconnect backoff state.
+    """
+
+    def __init__(self, host: str, port: int) -> None:
+        self.channel = Channel(host=host, port=port)
+        self.in_flight = 0
+        self.failures = 0
+        self.retry_at = 0.0
+
+    @property
+    def healthy(self) -> bool:
+        """True if the channel is not backing off after a failure."""
+        return self.failures == 0 or self.retry_at <= time.monotonic()
+
+
+class ChannelPool:
+    """
+    Fixed-size pool of gRPC channels to one database service endpoint.
+
+    Channels are bound to the event loop they were created in, so the
+    pool rebuilds them lazily when it is used from a new loop (every
+    asyncio.run() of a cron script, every test case).
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        size: int = settings.GRPC_POOL_SIZE,
+        health_interval: float = settings.GRPC_POOL_HEALTH_INTERVAL,
+        backoff_min: float = settings.GRPC_RECONNECT_BACKOFF_MIN,
+        backoff_max: float = settings.GRPC_RECONNECT_BACKOFF_MAX,
+        probe_timeout: float = settings.GRPC_POOL_PROBE_TIMEOUT,
+    ) -> None:
+        self.host = host
+        self.port = port
+        self.size = max(1, size)
+        self.health_interval = health_interval
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        self.probe_timeout = probe_timeout
+        self.endpoint = f"{host}:{port}"
+        self._channels: List[PooledChannel] = []
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._health_task: Optional[asyncio.Task] = None
+        self._next = 0
+
+    def configure(self, host: str, port: int, size: Optional[int] = None) -> None:
+        """
+        Point the pool to another endpoint, dropping current channels.
+
+        Args:
+            host (str): Database service host.
+            port (int): Database service port.
+            size (Optional[int]): New number of channels.
+        """
+        self._drop()
+        self.host = host
+        self.port = port
+        self.endpoint = f"{host}:{port}"
+        if size is not None:
+            self.size = max(1, size)
+
+    def _ensure(self) -> None:
+        """Create channels for the running event loop if needed."""
+        loop = asyncio.get_running_loop()
+        if self._loop is loop and self._channels:
+            return
+        self._drop()
+        self._loop = loop
+        self._channels = [PooledChannel(self.host, self.port) for _ in range(self.size)]
+        if self.health_interval > 0:
+            self._health_task = loop.create_task(self._health_loop())
+        self._export_state()
+
+    def _drop(self) -> None:
+        """Close all channels and stop the health checker."""
+        if self._health_task is not None:
+            if not self._health_task.done() and not self._loop.is_closed():
+                self._health_task.cancel()
+            self._health_task = None
+        for pc in self._channels:
+            try:
+                pc.channel.close()
+            except Exception as ex:
+                log.debug(f"grpc pool: closing channel failed ex={ex}")
+        self._channels = []
+        self._loop = None
+
+    def _pick(self) -> PooledChannel:
+        """
+        Pick a channel round-robin, preferring healthy ones and
+        falling back to any channel when all of them are backing off.
+        """
+        healthy = [pc for pc in self._channels if pc.healthy]
+        candidates = healthy or self._channels
+        self._next = (self._next + 1) % len(candidates)
+        return min(
+            candidates[self._next :] + candidates[: self._next],
+            key=lambda pc: pc.in_flight,
+        )
+
+    def _mark_failed(self, pc: PooledChannel) -> None:
+        """Close a broken channel and schedule its reconnect with backoff."""
+        pc.failures += 1
+        delay = min(self.backoff_max, self.backoff_min * 2 ** (pc.failures - 1))
+        pc.retry_at = time.monotonic() + delay * random.uniform(0.5, 1.0)
+        pc.channel.close()
+        self._export_state()
+
+    def _mark_ok(self, pc: PooledChannel) -> None:
+        if pc.failures:
+            pc.failures = 0
+            pc.retry_at = 0.0
+            self._export_state()
+
+    @asynccontextmanager
+    async def channel(self) -> AsyncIterator[Channel]:
+        """
+        Borrow a channel for one call. The channel is not exclusive:
+        other coroutines keep sending their calls over it concurrently.
+
+        Yields:
+            Channel: Connected (or lazily connecting) gRPC channel.
+        """
+        self._ensure()
+        pc = self._pick()
+        pc.in_flight += 1
+        POOL_IN_FLIGHT.labels(self.endpoint).inc()
+        POOL_REQUESTS.labels(self.endpoint).inc()
+        try:
+            yield pc.channel
+        except CONNECTION_ERRORS:
+            self._mark_failed(pc)
+            raise
+        else:
+            self._mark_ok(pc)
+        finally:
+            pc.in_flight -= 1
+            POOL_IN_FLIGHT.labels(self.endpoint).dec()
+
+    async def _health_loop(self) -> None:
+        """
+        Probe the channels every health_interval seconds: idle healthy
+        channels, to find connections that died silently (half-open
+        TCP, server restart), and broken channels whose backoff has
+        expired, to bring them back.
+        """
+        while True:
+            await asyncio.sleep(self.health_interval)
+            await asyncio.gather(
+                *(self._probe(pc) for pc in list(self._channels) if pc.healthy)
+            )
+
+    async def _probe(self, pc: PooledChannel) -> None:
+        """
+        Send a cheap query over a channel. A closed channel reconnects
+        on the call, so this is also how broken channels reconnect.
+        """
+        reconnect = pc.failures > 0
+        stub = TestStub(pc.channel, timeout=self.probe_timeout)
+        try:
+            await stub.test(test=PROBE_QUERY)
+        except PROBE_ERRORS as ex:
+            if reconnect:
+                POOL_RECONNECTS.labels(self.endpoint, "fail").inc()
+            log.error(f"grpc pool {self.endpoint} probe failed ex={ex!r}")
+            self._mark_failed(pc)
+            return
+        except GRPCError as ex:
+            # the service answered: the connection itself is fine
+            log.debug(f"grpc pool {self.endpoint} probe query failed ex={ex}")
+        if reconnect:
+            POOL_RECONNECTS.labels(self.endpoint, "ok").inc()
+        self._mark_ok(pc)
+
+    def _export_state(self) -> None:
+        healthy = sum(1 for pc in self._channels if pc.failures == 0)
+        POOL_CHANNELS.labels(self.endpoint, "healthy").set(healthy)
+        POOL_CHANNELS.labels(self.endpoint, "failed").set(len(self._channels) - healthy)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns:
+            Dict[str, int]: Channel count, healthy channel count and
+                number of calls in flight.
+        """
+        return {
+            "channels": len(self._channels),
+            "healthy": sum(1 for pc in self._channels if pc.failures == 0),
+            "in_flight": sum(pc.in_flight for pc in self._channels),
+        }
+
+    async def close(self) -> None:
+        """Close all channels of the pool."""
+        self._drop()
+        self._export_state()
+
+
+class Replica:
+    """
+    Channel pool to one read replica with its last measured lag.
+    """
+
+    def __init__(self, pool_: ChannelPool, lag: Optional[float] = None) -> None:
+        self.pool = pool_
+        self.lag = lag
+
+
+def parse_hosts(hosts: str) -> List[Tuple[str, int]]:
+    """
+    Parse a "host[:port],host[:port]" list of endpoints, the port
+    defaults to settings.GRPC_PORT.
+    """
+    endpoints = []
+    for item in hosts.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        host, _, port = item.partition(":")
+        endpoints.append((host, int(port) if port else settings.GRPC_PORT))
+    return endpoints
+
+
+class ReplicaRouter:
+    """
+    Picks the channel pool of a call: reads go round-robin to the read
+    replicas whose lag is known and at most max_lag seconds, everything
+    else (and reads when no replica is in sync) to the primary pool.
+
+    Lag is measured every lag_interval seconds by sending lag_query
+    (MySQL SHOW REPLICA STATUS) to each replica, on a task started
+    lazily in the event loop using the router like the pool health
+    checker. With lag_interval 0 the replicas are never checked and
+    always considered in sync.
+    """
+
+    def __init__(
+        self,
+        primary: ChannelPool,
+        hosts: str = settings.GRPC_REPLICA_HOSTS,
+        max_lag: float = settings.GRPC_REPLICA_MAX_LAG,
+        lag_interval: float = settings.GRPC_REPLICA_LAG_INTERVAL,
+        lag_query: str = settings.GRPC_REPLICA_LAG_QUERY,
+    ) -> None:
+        self.primary = primary
+        self.max_lag = max_lag
+        self.lag_interval = lag_interval
+        self.lag_query = lag_query
+        self.replicas: List[Replica] = []
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._lag_task: Optional[asyncio.Task] = None
+        self._next = 0
+        self.configure(hosts)
+
+    def configure(self, hosts: str, size: Optional[int] = None) -> None:
+        """
+        Replace the read replicas, dropping their current channels.
+
+        Args:
+            hosts (str): "host[:port],host[:port]" list, "" for none.
+            size (Optional[int]): Number of channels per replica,
+                defaults to the size of the primary pool.
+        """
+        for replica in self.replicas:
+            replica.pool._drop()
+        self._stop()
+        lag = 0.0 if self.lag_interval <= 0 else None
+        self.replicas = [
+            Replica(ChannelPool(host, port, size or self.primary.size), lag)
+            for host, port in parse_hosts(hosts)
+        ]
+
+    def in_sync(self, replica: Replica) -> bool:
+        """True if the replica is known to lag at most max_lag seconds."""
+        return replica.lag is not None and replica.lag <= self.max_lag
+
+    def pool(self, read: bool = False) -> ChannelPool:
+        """
+        Channel pool for a call.
+
+        Args:
+            read (bool): The call only reads and may be served by a
+                replica.
+
+        Returns:
+            ChannelPool: Pool of a replica in sync or the primary pool.
+        """
+        if read and self.replicas:
+            self._ensure()
+            replicas = [r for r in self.replicas if self.in_sync(r)]
+            if replicas:
+                self._next = (self._next + 1) % len(replicas)
+                ROUTED_REQUESTS.labels("replica").inc()
+                return replicas[self._next].pool
+        ROUTED_REQUESTS.labels("primary").inc()
+        return self.primary
+
+    def _ensure(self) -> None:
+        """Start the lag checker in the running event loop if needed."""
+        if self.lag_interval <= 0:
+            return
+        loop = asyncio.get_running_loop()
+        if self._loop is loop and self._lag_task is not None:
+            return
+        self._stop()
+        self._loop = loop
+        self._lag_task = loop.create_task(self._lag_loop())
+
+    def _stop(self) -> None:
+        if self._lag_task is not None:
+            if not self._lag_task.done() and not self._loop.is_closed():
+                self._lag_task.cancel()
+            self._lag_task = None
+        self._loop = None
+
+    async def _lag_loop(self) -> None:
+        while True:
+            await self.check_lag()
+            await asyncio.sleep(self.lag_interval)
+
+    async def check_lag(self) -> None:
+        """
+        Measure the lag of every replica. A replica whose lag can not
+        be read (failed call, replication stopped) gets an unknown lag
+        and receives no reads until the next successful check.
+        """
+        for replica in self.replicas:
+            replica.lag = await self._measure(replica)
+            lag = -1 if replica.lag is None else replica.lag
+            REPLICA_LAG.labels(replica.pool.endpoint).set(lag)
+
+    async def _measure(self, replica: Replica) -> Optional[float]:
+        try:
+            async with replica.pool.channel() as channel:
+                stub = TestStub(channel, timeout=settings.GRPC_TIMEOUT or None)
+                response = await stub.test(test=self.lag_query)
+            rows = json.loads(response.test_res or "[]")
+        except Exception as ex:
+            log.error(f"replica {replica.pool.endpoint} lag check failed ex={ex}")
+            return None
+        if not rows:
+            return None
+        row = rows[0]
+        lag = row.get("Seconds_Behind_Source", row.get("Seconds_Behind_Master"))
+        return None if lag is None else float(lag)
+
+    def stats(self) -> Dict[str, Optional[float]]:
+        """
+        Returns:
+            Dict[str, Optional[float]]: Lag of every replica endpoint,
+                None if unknown.
+        """
+        return {r.pool.endpoint: r.lag for r in self.replicas}
+
+    async def close(self) -> None:
+        """Stop the lag checker and close the replica pools."""
+        task = self._lag_task
+        self._stop()
+        if task is not None and task.get_loop() is asyncio.get_running_loop():
+            with suppress(asyncio.CancelledError):
+                await task
+        for replica in self.replicas:
+            await replica.pool.close()
+
+
+pool = ChannelPool(settings.GRPC_HOST, settings.GRPC_PORT)
+router = ReplicaRouter(pool)
+
+
+async def close_pool() -> None:
+    """
+    Close the process-wide channel pools, primary and replicas
+    (on app shutdown or cron exit).
+    """
+    await router.close()
+    await pool.close()
@@ -0,0 +1,486 @@
+"""
+Local stand-in for the gRPC database service, backed by SQLite.
+
+It implements the Test service (test, batch and stream RPCs, JSON and
+columnar encodings, parameterized queries, insert ids) over an SQLite
+database holding the tables of dbm.models and be/db/models.py, so the
+backend, the crons and the benchmarks can run without the MySQL
+service. Network round trips and query times are simulated with
+configurable delays, the number of concurrently executing statements
+can be limited like a connection pool, and every request is logged.
+
+Run from the repository root:
+    python -m dbm.local_server --port 9091 --latency 0.002 --concurrency 8
+
+MySQL specifics of the SQL text are translated where the queries of
+this repo need it: index hints are dropped, %s placeholders become ?,
+and NOW() / LAST_INSERT_ID([expr]) are provided as functions.
+"""
+
+import argparse
+import asyncio
+import json
+import re
+import sqlite3
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Any, AsyncIterator, Deque, Dict, List, Optional, Tuple
+
+import grpclib
+from grpclib.server import Server
+from sqlalchemy import BigInteger, MetaData, String
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.schema import CreateIndex, CreateTable
+
+import grpc_lib
+from config import settings
+from dbm.models import Base
+from dbm.row_codec import encode_columns
+from dbm.sql_params import from_param
+from grpc_lib import BatchResponse, Encoding, EndpointResponse, Param
+from libs.logs import log
+
+try:
+    from be.db.models import Base as BeBase
+except ImportError:  # crontabs image, without the backend sources
+    BeBase = None
+
+INDEX_HINT = re.compile(r"\s+(?:USE|FORCE|IGNORE)\s+INDEX\s*\([^)]*\)", re.IGNORECASE)
+PLACEHOLDER = re.compile(r"%%|%s")
+REPLICA_STATUS = re.compile(r"\s*SHOW\s+(?:REPLICA|SLAVE)\s+STATUS", re.IGNORECASE)
+
+
+@compiles(BigInteger, "sqlite")
+def _bigint_sqlite(type_, compiler, **kw) -> str:
+    # INTEGER PRIMARY KEY is the autoincrementing rowid in SQLite
+    return "INTEGER"
+
+
+def _sqlite_value(value: Any) -> Any:
+    """Value of a parameter as stored by SQLite (MySQL text formats)."""
+    if isinstance(value, datetime):
+        return value.isoformat(" ", "seconds" if not value.microsecond else "auto")
+    if isinstance(value, date):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    return value
+
+
+class StatementResult:
+    """Rows, insert id and affected rows of one executed statement."""
+
+    def __init__(
+        self,
+        rows: List[Dict[str, Any]],
+        last_insert_id: int = 0,
+        rows_affected: int = 0,
+    ) -> None:
+        self.rows = rows
+        self.last_insert_id = last_insert_id
+        self.rows_affected = rows_affected
+
+
+class LocalDatabase:
+    """
+    SQLite database with the tables of the service models.
+
+    Statements are translated from MySQL SQL once per text (or template
+    of a parameterized query) and kept in an LRU cache; SQLite itself
+    keeps the prepared statements of the same texts.
+    """
+
+    def __init__(self, path: str = ":memory:", cache_size: int = 256) -> None:
+        self.path = path
+        self.cache_size = cache_size
+        self.conn = sqlite3.connect(
+            path,
+            isolation_level=None,
+            check_same_thread=False,
+            cached_statements=cache_size,
+        )
+        self.conn.row_factory = sqlite3.Row
+        self.conn.create_function("NOW", 0, lambda: _sqlite_value(datetime.now()))
+        self.conn.create_function("LAST_INSERT_ID", -1, self._last_insert_id)
+        self._insert_id_expr: Optional[int] = None
+        self._prepared: OrderedDict = OrderedDict()
+        self.prepared_hits = 0
+        self.prepared_misses = 0
+        self._create_tables()
+
+    def _create_tables(self) -> None:
+        """
+        Create the model tables. Text columns compare case-insensitively,
+        as with the default MySQL collation. Index names are global in
+        SQLite, so an index whose name is taken by another table is skipped.
+        """
+        dialect = sqlite.dialect()
+        metadatas = [Base.metadata] + ([BeBase.metadata] if BeBase else [])
+        for metadata in metadatas:
+            for table in metadata.sorted_tables:
+                table = table.to_metadata(MetaData())
+                for column in table.columns:
+                    if isinstance(column.type, String):
+                        column.type = column.type.copy()
+                        column.type.collation = "NOCASE"
+                ddl = CreateTable(table, if_not_exists=True)
+                self.conn.execute(str(ddl.compile(dialect=dialect)))
+                for index in table.indexes:
+                    ddl = CreateIndex(index, if_not_exists=True)
+                    try:
+                        self.conn.execute(str(ddl.compile(dialect=dialect)))
+                    except sqlite3.OperationalError:
+                        pass
+
+    def _last_insert_id(self, *args: Any) -> Any:
+        """
+        MySQL LAST_INSERT_ID(): with an argument it returns the argument
+        and makes it the insert id reported for the statement.
+        """
+        if args:
+            self._insert_id_expr = args[0]
+            return args[0]
+        return self.conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+
+    def translate(self, sql: str, parameterized: bool) -> str:
+        """
+        SQLite text of a MySQL statement, cached by statement text.
+
+        Args:
+            sql (str): MySQL SQL text or template.
+            parameterized (bool): sql is a template with %s placeholders.
+
+        Returns:
+            str: SQLite SQL text.
+        """
+        key = (sql, parameterized)
+        if key in self._prepared:
+            self._prepared.move_to_end(key)
+            self.prepared_hits += 1
+            return self._prepared[key]
+        self.prepared_misses += 1
+        text = INDEX_HINT.sub("", sql)
+        if parameterized:
+            text = PLACEHOLDER.sub(lambda m: "%" if m.group() == "%%" else "?", text)
+        self._prepared[key] = text
+        if len(self._prepared) > self.cache_size:
+            self._prepared.popitem(last=False)
+        return text
+
+    def cursor(
+        self,
+        sql: str,
+        parameterized: bool = False,
+        params: Optional[List[Param]] = None,
+    ) -> sqlite3.Cursor:
+        """
+        Execute a statement and return its cursor.
+
+        Args:
+            sql (str): MySQL SQL text or template.
+            parameterized (bool): sql is a template bound to params.
+            params (Optional[List[Param]]): Parameters of the template.
+
+        Returns:
+            sqlite3.Cursor: Cursor of the executed statement.
+        """
+        text = self.translate(sql, parameterized)
+        values = [_sqlite_value(from_param(p)) for p in params or []]
+        self._insert_id_expr = None
+        return self.conn.execute(text, values)
+
+    def execute(
+        self,
+        sql: str,
+        parameterized: bool = False,
+        params: Optional[List[Param]] = None,
+    ) -> StatementResult:
+        """
+        Execute a statement and fetch its result.
+
+        Args:
+            sql (str): MySQL SQL text or template.
+            parameterized (bool): sql is a template bound to params.
+            params (Optional[List[Param]]): Parameters of the template.
+
+        Returns:
+            StatementResult: Rows, insert id and affected rows.
+        """
+        cursor = self.cursor(sql, parameterized, params)
+        if cursor.description is not None:
+            return StatementResult([dict(r) for r in cursor.fetchall()])
+        last_insert_id = self._insert_id_expr
+        if last_insert_id is None:
+            is_insert = sql.lstrip()[:6].upper() == "INSERT"
+            last_insert_id = cursor.lastrowid if is_insert else 0
+        return StatementResult([], last_insert_id or 0, max(cursor.rowcount, 0))
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns:
+            Dict[str, int]: Number of cached statements, cache hits and misses.
+        """
+        return {
+            "prepared": len(self._prepared),
+            "hits": self.prepared_hits,
+            "misses": self.prepared_misses,
+        }
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+def _dumps(rows: List[Dict[str, Any]]) -> str:
+    return json.dumps(rows, default=str)
+
+
+def _response(rows: List[Dict[str, Any]], encoding: Encoding) -> EndpointResponse:
+    if encoding == Encoding.COLUMNAR:
+        return EndpointResponse(encoding=encoding, columns=encode_columns(rows))
+    return EndpointResponse(test_res=_dumps(rows))
+
+
+class LocalDbService(grpc_lib.TestBase):
+    """
+    Test service implementation over a LocalDatabase.
+
+    Args:
+        db (LocalDatabase): Database executing the statements.
+        latency (float): Simulated network round trip per RPC, seconds.
+        query_time (float): Simulated execution time per statement,
+            spent while holding a concurrency slot, seconds.
+        concurrency (int): Maximum number of RPCs executing statements
+            at the same time (like a connection pool), 0 for no limit.
+        log_path (Optional[str]): File to append the request log to,
+            one JSON object per line.
+        log_size (int): Number of requests kept in memory (self.requests).
+        replica_lag (Optional[float]): Act as a read replica reporting
+            this lag to SHOW REPLICA STATUS, None for a primary.
+    """
+
+    def __init__(
+        self,
+        db: LocalDatabase,
+        latency: float = 0.0,
+        query_time: float = 0.0,
+        concurrency: int = 0,
+        log_path: Optional[str] = None,
+        log_size: int = 1000,
+        replica_lag: Optional[float] = None,
+    ) -> None:
+        self.db = db
+        self.replica_lag = replica_lag
+        self.latency = latency
+        self.query_time = query_time
+        self.concurrency = concurrency
+        self._slots = asyncio.Semaphore(concurrency) if concurrency > 0 else None
+        self.log_path = log_path
+        self.requests: Deque[Dict[str, Any]] = deque(maxlen=log_size)
+
+    def _log(self, rpc: str, sqls: List[str], started: float, **info: Any) -> None:
+        entry = {
+            "time": datetime.now().isoformat(" ", "milliseconds"),
+            "rpc": rpc,
+            "sql": sqls,
+            "ms": round((time.perf_counter() - started) * 1000, 3),
+            **info,
+        }
+        self.requests.append(entry)
+        if self.log_path:
+            with open(self.log_path, "a") as f:
+                f.write(json.dumps(entry, default=str) + "\n")
+
+    @asynccontextmanager
+    async def _slot(self, statements: int = 1) -> AsyncIterator[None]:
+        """Simulate the round trip and hold a concurrency slot."""
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self._slots is None:
+            await self._execute_time(statements)
+            yield
+        else:
+            async with self._slots:
+                await self._execute_time(statements)
+                yield
+
+    async def _execute_time(self, statements: int) -> None:
+        if self.query_time:
+            await asyncio.sleep(self.query_time * statements)
+
+    def _run(
+        self,
+        sql: str,
+        parameterized: bool = False,
+        params: Optional[List[Param]] = None,
+    ) -> StatementResult:
+        try:
+            return self.db.execute(sql, parameterized, params)
+        except sqlite3.Error as ex:
+            log.error(f"local db service: {ex} sql={sql}")
+            raise grpclib.GRPCError(grpclib.const.Status.INTERNAL, str(ex))
+
+    async def test(
+        self,
+        test: str,
+        encoding: Encoding,
+        parameterized: bool,
+        params: Optional[List[Param]],
+    ) -> EndpointResponse:
+        started = time.perf_counter()
+        if REPLICA_STATUS.match(test):
+            rows = []
+            if self.replica_lag is not None:
+                rows = [{"Seconds_Behind_Source": self.replica_lag}]
+            return EndpointResponse(test_res=_dumps(rows))
+        async with self._slot():
+            result = self._run(test, parameterized, params)
+        response = _response(result.rows, encoding)
+        response.last_insert_id = result.last_insert_id
+        response.rows_affected = result.rows_affected
+        self._log("test", [test], started, rows=len(result.rows), params=len(params))
+        return response
+
+    async def batch(
+        self,
+        tests: Optional[List[str]],
+        atomic: bool,
+        expected_rows: Optional[List[int]],
+    ) -> BatchResponse:
+        started = time.perf_counter()
+        async with self._slot(len(tests)):
+            if atomic:
+                response = self._run_atomic(tests, expected_rows or [])
+            else:
+                response = BatchResponse()
+                for sql in tests:
+                    self._append(response, self._run(sql))
+        self._log("batch", tests, started, atomic=atomic)
+        return response
+
+    @staticmethod
+    def _append(response: BatchResponse, result: StatementResult) -> None:
+        response.test_res.append(_dumps(result.rows))
+        response.last_insert_ids.append(result.last_insert_id)
+        response.rows_affected.append(result.rows_affected)
+
+    def _run_atomic(self, tests: List[str], expected_rows: List[int]) -> BatchResponse:
+        """
+        Run the statements in one transaction, rolled back on the first
+        failing statement or unexpected number of affected rows.
+        """
+        response = BatchResponse()
+        self.db.conn.execute("BEGIN")
+        for i, sql in enumerate(tests):
+            try:
+                result = self.db.execute(sql)
+            except sqlite3.Error as ex:
+                error = str(ex)
+            else:
+                expected = expected_rows[i] if i < len(expected_rows) else -1
+                if expected < 0 or result.rows_affected == expected:
+                    self._append(response, result)
+                    continue
+                error = f"{result.rows_affected} rows affected, expected {expected}"
+            self.db.conn.execute("ROLLBACK")
+            log.warning(f"local db service: rollback at {i}: {error} sql={sql}")
+            return BatchResponse(rolled_back=True, failed_index=i, error=error)
+        self.db.conn.execute("COMMIT")
+        return response
+
+    async def stream(
+        self,
+        test: str,
+        chunk_size: int,
+        encoding: Encoding,
+        parameterized: bool,
+        params: Optional[List[Param]],
+    ) -> AsyncIterator[EndpointResponse]:
+        started = time.perf_counter()
+        rows = 0
+        async with self._slot():
+            try:
+                cursor = self.db.cursor(test, parameterized, params)
+            except sqlite3.Error as ex:
+                raise grpclib.GRPCError(grpclib.const.Status.INTERNAL, str(ex))
+        while True:
+            chunk = [dict(r) for r in cursor.fetchmany(chunk_size or 1000)]
+            if not chunk:
+                break
+            rows += len(chunk)
+            yield _response(chunk, encoding)
+        self._log("stream", [test], started, rows=rows, params=len(params))
+
+
+async def serve(
+    host: str = "127.0.0.1",
+    port: int = settings.GRPC_PORT,
+    db_path: str = ":memory:",
+    **service_kwargs: Any,
+) -> Tuple[Server, LocalDbService]:
+    """
+    Start the local database service.
+
+    Args:
+        host (str): Address to listen on.
+        port (int): Port to listen on, 0 for any free port.
+        db_path (str): SQLite database file, in memory by default.
+        **service_kwargs: LocalDbService options (latency, query_time,
+            concurrency, log_path, log_size, replica_lag).
+
+    Returns:
+        Tuple[Server, LocalDbService]: Started server (its port is
+            server_port(server)) and the service.
+    """
+    service = LocalDbService(LocalDatabase(db_path), **service_kwargs)
+    server = Server([service])
+    await server.start(host, port)
+    return server, service
+
+
+def server_port(server: Server) -> int:
+    """Port the server listens on."""
+    return server._server.sockets[0].getsockname()[1]
+
+
+def get_args() -> argparse.Namespace:
+    """Get cli arguments"""
+    parser = argparse.ArgumentParser(description="Local SQLite DB service")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=settings.GRPC_PORT)
+    parser.add_argument("--db", default=":memory:", help="SQLite database file")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds per RPC")
+    parser.add_argument(
+        "--query-time", type=float, default=0.0, help="seconds per statement"
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=0, help="concurrent statements, 0 no limit"
+    )
+    parser.add_argument("--log", default=None, help="request log file (JSON lines)")
+    return parser.parse_args()
+
+
+async def main() -> None:
+    args = get_args()
+    server, service = await serve(
+        args.host,
+        args.port,
+        args.db,
+        latency=args.latency,
+        query_time=args.query_time,
+        concurrency=args.concurrency,
+        log_path=args.log,
+    )
+    log.info(f"local db service listening on {args.host}:{server_port(server)}")
+    try:
+        await server.wait_closed()
+    finally:
+        server.close()
+        service.db.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,190 @@
+"""
+Fast construction of pydantic models from trusted database rows.
+
+Rows coming from our own database service already have the right
+shape, so instead of running the full pydantic validation (with its
+field validators) every row is built with model_construct() after
+converting its values with simple per-field coercers. Coercers are
+computed once per schema from the field annotations.
+"""
+
+import types
+from datetime import date, datetime
+from decimal import Decimal
+from functools import lru_cache
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Type,
+    Union,
+    get_args,
+    get_origin,
+)
+
+from pydantic import BaseModel
+
+ZERO_DATETIME = "0000-00-00 00:00:00"
+END_OF_TIMES = datetime(2038, 1, 1)
+
+Coercer = Callable[[Any], Any]
+
+
+def _identity(value: Any) -> Any:
+    return value
+
+
+def _to_int(value: Any) -> Any:
+    return value if type(value) is int else int(value)
+
+
+def _to_float(value: Any) -> Any:
+    return value if type(value) is float else float(value)
+
+
+def _to_bool(value: Any) -> Any:
+    if type(value) is bool:
+        return value
+    if isinstance(value, str):
+        return value.lower() in ("1", "true", "yes", "on")
+    return bool(value)
+
+
+def _to_str(value: Any) -> Any:
+    return value if type(value) is str else str(value)
+
+
+def _to_datetime(value: Any) -> Any:
+    """
+    Parse a datetime the way the DB service sends it. MySQL zero dates
+    become the "end of times" date, as in the schemas validators.
+    """
+    if isinstance(value, datetime):
+        return value
+    if isinstance(value, str):
+        if value == ZERO_DATETIME:
+            return END_OF_TIMES
+        return datetime.fromisoformat(value)
+    if isinstance(value, date):
+        return datetime(value.year, value.month, value.day)
+    return datetime.fromtimestamp(value)
+
+
+_SCALAR_COERCERS: Dict[Any, Coercer] = {
+    int: _to_int,
+    float: _to_float,
+    bool: _to_bool,
+    str: _to_str,
+    datetime: _to_datetime,
+    Decimal: Decimal,
+}
+
+
+def _union_coercer(members: tuple, validated: bool) -> Coercer:
+    """
+    Keep the value if it already has one of the member types (as the
+    pydantic smart union does), otherwise coerce to the first member.
+    Datetime unions (`datetime | str`) with a "before" validator parse
+    datetime strings, as these validators (fix_zeros) do.
+    """
+    if validated and datetime in members:
+
+        def coerce_datetime(value: Any) -> Any:
+            try:
+                return _to_datetime(value)
+            except (ValueError, TypeError):
+                if isinstance(value, members):
+                    return value
+                raise
+
+        return coerce_datetime
+
+    first = _coercer(members[0])
+
+    def coerce(value: Any) -> Any:
+        if isinstance(value, members):
+            return value
+        return first(value)
+
+    return coerce
+
+
+def _coercer(annotation: Any, validated: bool = False) -> Coercer:
+    """
+    Build the coercer of a field annotation.
+
+    Args:
+        annotation (Any): Field type annotation.
+        validated (bool): The field has a "before" field validator.
+
+    Returns:
+        Coercer: Value conversion function.
+    """
+    origin = get_origin(annotation)
+    if origin is Union or origin is types.UnionType:
+        members = tuple(a for a in get_args(annotation) if a is not type(None))
+        if len(members) == 1:
+            return _coercer(members[0], validated)
+        if all(isinstance(m, type) for m in members):
+            return _union_coercer(members, validated)
+        return _identity
+    if isinstance(annotation, type) and annotation in _SCALAR_COERCERS:
+        return _SCALAR_COERCERS[annotation]
+    # EmailStr and other str subclasses / annotated str types
+    if isinstance(annotation, type) and issubclass(annotation, str):
+        return _to_str
+    return _identity
+
+
+@lru_cache(maxsize=None)
+def field_coercers(data_class: Type[BaseModel]) -> Dict[str, Coercer]:
+    """
+    Per-field coercers of a schema, computed once.
+
+    Args:
+        data_class (Type[BaseModel]): Pydantic model class.
+
+    Returns:
+        Dict[str, Coercer]: Coercer by field name.
+    """
+    validated = {
+        name
+        for decorator in data_class.__pydantic_decorators__.field_validators.values()
+        if decorator.info.mode == "before"
+        for name in decorator.info.fields
+    }
+    return {
+        name: _coercer(field.annotation, name in validated)
+        for name, field in data_class.model_fields.items()
+    }
+
+
+def construct_rows(
+    data_class: Type[BaseModel],
+    rows: Iterable[Dict[str, Any]],
+) -> List[BaseModel]:
+    """
+    Build data_class instances from trusted rows without validation.
+    Keys that are not fields of data_class are dropped, None values are
+    kept as is, missing fields get their defaults.
+
+    Args:
+        data_class (Type[BaseModel]): Pydantic model class.
+        rows (Iterable[Dict[str, Any]]): Rows from the database service.
+
+    Returns:
+        List[BaseModel]: Constructed instances.
+    """
+    coercers = field_coercers(data_class).items()
+    construct = data_class.model_construct
+    result = []
+    for row in rows:
+        values = {}
+        for name, coerce in coercers:
+            if name in row:
+                value = row[name]
+                values[name] = value if value is None else coerce(value)
+        result.append(construct(_fields_set=set(values), **values))
+    return result
@@ -0,0 +1,141 @@
+"""
+Prometheus metrics of the database layer.
+
+Metrics are registered in the default prometheus_client registry,
+so the backend exposes them through the instrumentator /metrics
+endpoint together with the HTTP metrics. Short-lived cron processes
+write them to a node_exporter textfile on exit instead.
+"""
+
+import os
+
+from prometheus_client import REGISTRY, Counter, Gauge, Histogram, write_to_textfile
+
+from config import settings
+
+POOL_CHANNELS = Gauge(
+    "db_grpc_pool_channels",
+    "Number of gRPC channels in the DB service pool by state",
+    ["endpoint", "state"],
+)
+POOL_IN_FLIGHT = Gauge(
+    "db_grpc_pool_in_flight",
+    "Number of DB service calls currently multiplexed over the pool",
+    ["endpoint"],
+)
+POOL_REQUESTS = Counter(
+    "db_grpc_pool_requests_total",
+    "Number of DB service calls sent through the pool",
+    ["endpoint"],
+)
+POOL_RECONNECTS = Counter(
+    "db_grpc_pool_reconnects_total",
+    "Number of channel reconnect attempts by result",
+    ["endpoint", "result"],
+)
+SQL_CACHE_REQUESTS = Counter(
+    "db_sql_template_cache_requests_total",
+    "Number of SQL text renders by template cache result (hit, miss, bypass)",
+    ["result"],
+)
+REPLICA_LAG = Gauge(
+    "db_replica_lag_seconds",
+    "Replication lag of a DB service read replica, -1 if unknown",
+    ["endpoint"],
+)
+ROUTED_REQUESTS = Counter(
+    "db_routed_requests_total",
+    "Number of DB service calls by routing target (primary, replica)",
+    ["target"],
+)
+BREAKER_STATE = Gauge(
+    "db_breaker_state",
+    "Circuit breaker state of a DB service endpoint (0 closed, 1 half-open, 2 open)",
+    ["endpoint"],
+)
+BREAKER_REJECTIONS = Counter(
+    "db_breaker_rejections_total",
+    "Number of DB service calls failed fast by an open circuit breaker",
+    ["endpoint"],
+)
+RETRIES = Counter(
+    "db_retries_total",
+    "Number of failed DB service reads by outcome (retried, budget, exhausted)",
+    ["result"],
+)
+COALESCED_CALLS = Counter(
+    "db_coalesced_calls_total",
+    "Number of coalesced reads sent to the DB service or shared with an "
+    "identical read in flight (calls saved)",
+    ["result"],
+)
+USER_CACHE_REQUESTS = Counter(
+    "db_user_cache_requests_total",
+    "Number of user cache reads by result (hit, miss) and of Redis errors (error)",
+    ["result"],
+)
+COUPON_FILTER_CHECKS = Counter(
+    "db_coupon_filter_checks_total",
+    "Coupon lookups by Bloom filter outcome: absent, negative_cached (no DB "
+    "call), present, false_positive (DB call), error (Redis failed)",
+    ["result"],
+)
+COUPON_FILTER_EXPECTED_FPR = Gauge(
+    "db_coupon_filter_expected_fpr",
+    "False positive rate of the coupon Bloom filter expected from its fill "
+    "ratio at the last rebuild",
+)
+COUPON_POOL_TAKES = Counter(
+    "coupon_pool_takes_total",
+    "Coupons taken from the pool of a profile by result: hit, empty (a "
+    "coupon is inserted instead), stale (dropped, too old), error (Redis failed)",
+    ["profile", "result"],
+)
+COUPON_POOL_COUPONS = Counter(
+    "coupon_pool_coupons_total",
+    "Coupons of the pool of a profile by event: inserted by a refill, "
+    "dropped as too old (or given back without a pool), returned after a "
+    "rolled back transaction",
+    ["profile", "event"],
+)
+COUPON_POOL_LENGTH = Gauge(
+    "coupon_pool_length",
+    "Ready coupons in the pool of a profile, after the last refill check",
+    ["profile"],
+)
+IDENTITY_MAP_LOOKUPS = Counter(
+    "db_identity_map_lookups_total",
+    "Number of key lookups of request-scoped DbQuery views by result (hit, miss)",
+    ["result"],
+)
+STATEMENT_LATENCY = Histogram(
+    "db_statement_duration_seconds",
+    "Latency of DB service calls by statement fingerprint and calling method",
+    ["fingerprint", "caller"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+STATEMENT_ROWS = Histogram(
+    "db_statement_rows",
+    "Rows returned (reads) or affected (writes) by a statement",
+    ["fingerprint", "caller"],
+    buckets=(0, 1, 10, 100, 1000, 10000),
+)
+STATEMENT_RESPONSE_BYTES = Counter(
+    "db_statement_response_bytes_total",
+    "Size of the DB service responses of a statement (JSON text or columnar data)",
+    ["fingerprint", "caller"],
+)
+
+
+def write_textfile(job: str) -> None:
+    """
+    Write all metrics of the process to <job>.prom in
+    settings.METRICS_TEXTFILE_DIR for the node_exporter textfile
+    collector, if the directory is set.
+
+    Args:
+        job (str): Name of the cron job, one file per job.
+    """
+    if settings.METRICS_TEXTFILE_DIR:
+        path = os.path.join(settings.METRICS_TEXTFILE_DIR, f"{job}.prom")
+        write_to_textfile(path, REGISTRY)
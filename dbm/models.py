@@ -105,7 +105,8 @@ class Users(Base):
     __tablename__ = "users"
 
     id = Column(BigInteger, primary_key=True)
-    email = Column(VARCHAR(150), default="", nullable=False)
+    # unique in practice (users are looked up and updated by email)
+    email = Column(VARCHAR(150), default="", nullable=False, info={"unique_key": True})
     created = Column(TIMESTAMP, default=datetime.now(), nullable=False)
     cn = Column(String(100), default=None, nullable=True)
     trial = Column(Boolean, default=False, nullable=True)
@@ -0,0 +1,307 @@
+"""
+Deadlines, read retries and circuit breakers of DB service calls.
+
+Every call gets a gRPC deadline, so a stalled database service fails
+the call instead of holding the caller forever. Failed reads are
+retried on a fresh channel (of another replica, if any) as long as the
+process-wide retry budget allows it, so retries can not multiply the
+load of a struggling service. Each endpoint has a circuit breaker:
+after GRPC_BREAKER_FAILURES consecutive failures calls fail fast with
+a 503 MyCustomException until a probe call succeeds again.
+"""
+
+import asyncio
+import time
+from typing import AsyncIterator, Awaitable, Callable, Dict, Optional, Tuple, TypeVar
+
+import grpclib
+from grpclib.const import Status
+
+from config import settings
+from dbm.grpc_pool import CONNECTION_ERRORS, ChannelPool, router
+from dbm.metrics import BREAKER_REJECTIONS, BREAKER_STATE, RETRIES
+from grpc_lib import TestStub
+from libs.exceptions import service_unavailable
+from libs.logs import log
+
+T = TypeVar("T")
+
+# gRPC statuses telling the service (not the query) failed
+UNHEALTHY = (Status.UNAVAILABLE, Status.DEADLINE_EXCEEDED, Status.RESOURCE_EXHAUSTED)
+
+
+class RetryBudget:
+    """
+    Token bucket limiting retries to a share of the calls: every call
+    deposits ratio tokens, every retry takes one token, and min_per_sec
+    tokens are added per second so that rare calls can still retry.
+
+    Args:
+        ratio (float): Tokens deposited per call.
+        min_per_sec (float): Tokens added per second.
+    """
+
+    def __init__(
+        self,
+        ratio: float = settings.GRPC_RETRY_BUDGET_RATIO,
+        min_per_sec: float = settings.GRPC_RETRY_MIN_PER_SEC,
+    ) -> None:
+        self.ratio = ratio
+        self.min_per_sec = min_per_sec
+        # ten seconds of reserve
+        self.capacity = max(1.0, min_per_sec * 10)
+        self.tokens = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self, amount: float = 0.0) -> None:
+        now = time.monotonic()
+        amount += (now - self._updated) * self.min_per_sec
+        self._updated = now
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+    def deposit(self) -> None:
+        """Account one call."""
+        self._refill(self.ratio)
+
+    def withdraw(self) -> bool:
+        """Take the token of one retry, False if the budget is spent."""
+        self._refill()
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker of one endpoint. Closed: calls pass. Open (after
+    failures consecutive failures): calls are rejected for reset_timeout
+    seconds. Half-open: one probe call passes, its success closes the
+    breaker and its failure opens it again.
+
+    Args:
+        endpoint (str): Endpoint "host:port", used as metric label.
+        failures (int): Consecutive failures opening the breaker.
+        reset_timeout (float): Seconds before a probe call is let through.
+    """
+
+    CLOSED, HALF_OPEN, OPEN = 0, 1, 2
+
+    def __init__(
+        self,
+        endpoint: str,
+        failures: int = settings.GRPC_BREAKER_FAILURES,
+        reset_timeout: float = settings.GRPC_BREAKER_RESET,
+    ) -> None:
+        self.endpoint = endpoint
+        self.threshold = max(1, failures)
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self._opened_at = 0.0
+        self._probe_at: Optional[float] = None
+        BREAKER_STATE.labels(endpoint).set(self.CLOSED)
+
+    @property
+    def state(self) -> int:
+        if self.failures < self.threshold:
+            return self.CLOSED
+        if time.monotonic() - self._opened_at < self.reset_timeout:
+            return self.OPEN
+        return self.HALF_OPEN
+
+    def allow(self) -> bool:
+        """
+        True if a call may be sent. In the half-open state only one probe
+        is let through at a time (another one if the probe never ended).
+        """
+        state = self.state
+        BREAKER_STATE.labels(self.endpoint).set(state)
+        if state == self.CLOSED:
+            return True
+        if state == self.HALF_OPEN:
+            now = time.monotonic()
+            if self._probe_at is None or now - self._probe_at >= self.reset_timeout:
+                self._probe_at = now
+                return True
+        BREAKER_REJECTIONS.labels(self.endpoint).inc()
+        return False
+
+    def record_success(self) -> None:
+        if self.failures:
+            self.failures = 0
+            self._probe_at = None
+            BREAKER_STATE.labels(self.endpoint).set(self.CLOSED)
+            log.info(f"db breaker {self.endpoint} closed")
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.failures >= self.threshold:
+            if self._probe_at is not None or self.failures == self.threshold:
+                log.error(f"db breaker {self.endpoint} open")
+            self._opened_at = time.monotonic()
+            self._probe_at = None
+            BREAKER_STATE.labels(self.endpoint).set(self.OPEN)
+
+
+retry_budget = RetryBudget()
+breakers: Dict[str, CircuitBreaker] = {}
+
+
+def breaker(pool_: ChannelPool) -> CircuitBreaker:
+    """Circuit breaker of the endpoint of a pool."""
+    if pool_.endpoint not in breakers:
+        breakers[pool_.endpoint] = CircuitBreaker(pool_.endpoint)
+    return breakers[pool_.endpoint]
+
+
+def unhealthy(ex: BaseException) -> bool:
+    """True if an exception of a call tells the service is failing."""
+    if isinstance(ex, grpclib.GRPCError):
+        return ex.status in UNHEALTHY
+    return isinstance(ex, (asyncio.TimeoutError, *CONNECTION_ERRORS))
+
+
+def timeout_(timeout: Optional[float], default: float) -> Optional[float]:
+    """gRPC timeout of a call, None for no deadline."""
+    timeout = default if timeout is None else timeout
+    return timeout if timeout > 0 else None
+
+
+def _admit(read: bool) -> Tuple[ChannelPool, CircuitBreaker]:
+    """Pool of the next attempt of a call, if its breaker lets it through."""
+    pool_ = router.pool(read)
+    breaker_ = breaker(pool_)
+    if not breaker_.allow():
+        raise service_unavailable(error="db.unavailable")
+    return pool_, breaker_
+
+
+async def _retry(
+    ex: Exception,
+    pool_: ChannelPool,
+    retry: bool,
+    attempt: int,
+) -> bool:
+    """
+    Account a failed attempt in the breaker of its endpoint and decide
+    whether to retry it, after a backoff.
+    """
+    breaker_ = breaker(pool_)
+    if not unhealthy(ex):
+        # the service answered, the query itself failed
+        breaker_.record_success()
+        return False
+    breaker_.record_failure()
+    if not retry:
+        return False
+    if attempt >= settings.GRPC_READ_RETRIES:
+        RETRIES.labels("exhausted").inc()
+        return False
+    if not retry_budget.withdraw():
+        RETRIES.labels("budget").inc()
+        return False
+    RETRIES.labels("retried").inc()
+    log.warning(f"db call to {pool_.endpoint} failed, retry {attempt + 1} {ex!r}")
+    await asyncio.sleep(settings.GRPC_RETRY_BACKOFF * 2**attempt)
+    return True
+
+
+async def call(
+    send: Callable[[TestStub], Awaitable[T]],
+    read: bool = False,
+    retry: bool = False,
+    timeout: Optional[float] = None,
+) -> T:
+    """
+    Send one call to the database service with a deadline, through the
+    circuit breaker of the endpoint, retrying it if it is idempotent.
+
+    Args:
+        send (Callable[[TestStub], Awaitable[T]]): Sends the call with
+            the given stub and returns its response.
+        read (bool): The call may go to a read replica.
+        retry (bool): The call is idempotent and may be retried.
+        timeout (Optional[float]): Deadline in seconds, defaults to
+            settings.GRPC_TIMEOUT, 0 for none.
+
+    Returns:
+        T: Response of the call.
+
+    Raises:
+        MyCustomException: 503, the breaker of the endpoint is open.
+        grpclib.GRPCError: The call failed (and could not be retried).
+    """
+    timeout = timeout_(timeout, settings.GRPC_TIMEOUT)
+    retry_budget.deposit()
+    attempt = 0
+    while True:
+        pool_, breaker_ = _admit(read)
+        try:
+            async with pool_.channel() as channel:
+                response = await send(TestStub(channel, timeout=timeout))
+        except Exception as ex:
+            if not await _retry(ex, pool_, retry, attempt):
+                raise
+            attempt += 1
+        else:
+            breaker_.record_success()
+            return response
+
+
+async def stream_call(
+    send: Callable[[TestStub], AsyncIterator[T]],
+    read: bool = False,
+    retry: bool = False,
+    timeout: Optional[float] = None,
+) -> AsyncIterator[T]:
+    """
+    Streaming variant of call(): the deadline applies to the wait for
+    each message, not to the whole stream, so that a consumer may take
+    as long as it needs between messages; a stream is only retried if
+    it failed before its first message.
+
+    Args:
+        send (Callable[[TestStub], AsyncIterator[T]]): Opens the stream
+            with the given stub.
+        read (bool): The call may go to a read replica.
+        retry (bool): The call is idempotent and may be retried.
+        timeout (Optional[float]): Seconds to wait for each message,
+            defaults to settings.GRPC_STREAM_IDLE_TIMEOUT, 0 for none.
+
+    Yields:
+        T: Messages of the stream.
+    """
+    timeout = timeout_(timeout, settings.GRPC_STREAM_IDLE_TIMEOUT)
+    retry_budget.deposit()
+    attempt = 0
+    while True:
+        pool_, breaker_ = _admit(read)
+        started = False
+        try:
+            async with pool_.channel() as channel:
+                messages = send(TestStub(channel)).__aiter__()
+                try:
+                    while True:
+                        try:
+                            message = await asyncio.wait_for(
+                                messages.__anext__(), timeout
+                            )
+                        except StopAsyncIteration:
+                            break
+                        except asyncio.TimeoutError:
+                            raise grpclib.GRPCError(
+                                Status.DEADLINE_EXCEEDED,
+                                f"no stream message for {timeout}s",
+                            )
+                        started = True
+                        yield message
+                finally:
+                    # ends the call when the consumer stops early
+                    await messages.aclose()
+        except Exception as ex:
+            if not await _retry(ex, pool_, retry and not started, attempt):
+                raise
+            attempt += 1
+        else:
+            breaker_.record_success()
+            return
@@ -0,0 +1,201 @@
+"""
+Columnar binary encoding of query results.
+
+Instead of a JSON list of dicts, with the column names repeated on every
+row and datetimes and decimals sent as text, a result is sent as a
+header of column names and types plus one typed array per column.
+Arrays are decoded in one call per column (array.frombytes), and
+timestamps and decimals arrive as integers.
+
+encode_columns() is used by database service implementations,
+decode_columns() by DbMain.
+"""
+
+import sys
+from array import array
+from datetime import date, datetime, timedelta, timezone
+from decimal import Decimal
+from typing import Any, Dict, List
+
+from grpc_lib import Column, ColumnarResult, ColumnType
+
+EPOCH = datetime(1970, 1, 1)
+LITTLE_ENDIAN = sys.byteorder == "little"
+
+_ARRAY_TYPECODES = {
+    ColumnType.INT: "q",
+    ColumnType.FLOAT: "d",
+    ColumnType.DATETIME: "q",
+    ColumnType.DECIMAL: "q",
+    ColumnType.BOOL: "B",
+}
+
+
+def _to_bytes(values: array) -> bytes:
+    if not LITTLE_ENDIAN and values.itemsize > 1:
+        values.byteswap()
+    return values.tobytes()
+
+
+def _from_bytes(typecode: str, data: bytes) -> array:
+    values = array(typecode)
+    values.frombytes(data)
+    if not LITTLE_ENDIAN and values.itemsize > 1:
+        values.byteswap()
+    return values
+
+
+def _column_type(values: List[Any]) -> ColumnType:
+    """Infer the column type from its non-null values."""
+    types = {type(v) for v in values if v is not None}
+    if not types:
+        return ColumnType.NULL
+    if types == {bool}:
+        return ColumnType.BOOL
+    if types <= {bool, int}:
+        return ColumnType.INT
+    if types <= {bool, int, float}:
+        return ColumnType.FLOAT
+    if types <= {int, Decimal}:
+        return ColumnType.DECIMAL
+    if types <= {datetime, date}:
+        return ColumnType.DATETIME
+    if types <= {bytes, bytearray}:
+        return ColumnType.BYTES
+    return ColumnType.STRING
+
+
+def to_micros(value: date) -> int:
+    """Microseconds since the epoch, aware datetimes being converted to UTC."""
+    if not isinstance(value, datetime):
+        value = datetime(value.year, value.month, value.day)
+    elif value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    delta = value - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1_000_000 + delta.microseconds
+
+
+def encode_column(name: str, values: List[Any]) -> Column:
+    """
+    Encode values of one column.
+
+    Args:
+        name (str): Column name.
+        values (List[Any]): Column values, None for NULL.
+
+    Returns:
+        Column: Encoded column.
+    """
+    type_ = _column_type(values)
+    column = Column(name=name, type=type_)
+    if any(v is None for v in values):
+        column.nulls = bytes(v is None for v in values)
+
+    if type_ in (ColumnType.STRING, ColumnType.BYTES):
+        ends = array("I")
+        blob = bytearray()
+        for v in values:
+            if isinstance(v, (bytes, bytearray)):
+                blob += v
+            elif v is not None:
+                blob += str(v).encode("utf-8")
+            ends.append(len(blob))
+        column.data = _to_bytes(ends) + bytes(blob)
+    elif type_ == ColumnType.DATETIME:
+        column.data = _to_bytes(
+            array("q", (0 if v is None else to_micros(v) for v in values))
+        )
+    elif type_ == ColumnType.DECIMAL:
+        scale = max(
+            (-Decimal(v).as_tuple().exponent for v in values if v is not None),
+            default=0,
+        )
+        column.scale = max(scale, 0)
+        column.data = _to_bytes(
+            array(
+                "q",
+                (
+                    0 if v is None else int(Decimal(v).scaleb(column.scale))
+                    for v in values
+                ),
+            )
+        )
+    elif type_ != ColumnType.NULL:
+        typecode = _ARRAY_TYPECODES[type_]
+        column.data = _to_bytes(array(typecode, (v or 0 for v in values)))
+    return column
+
+
+def encode_columns(rows: List[Dict[str, Any]]) -> ColumnarResult:
+    """
+    Encode rows (dicts with the same keys) into a columnar result.
+
+    Args:
+        rows (List[Dict[str, Any]]): Result rows.
+
+    Returns:
+        ColumnarResult: Column header and typed arrays.
+    """
+    names = list(rows[0].keys()) if rows else []
+    return ColumnarResult(
+        row_count=len(rows),
+        columns=[encode_column(name, [r[name] for r in rows]) for name in names],
+    )
+
+
+def decode_column(column: Column, row_count: int) -> List[Any]:
+    """
+    Decode values of one column.
+
+    Args:
+        column (Column): Encoded column.
+        row_count (int): Number of rows of the result.
+
+    Returns:
+        List[Any]: Column values, None for NULL.
+    """
+    type_ = column.type
+    if type_ == ColumnType.NULL:
+        return [None] * row_count
+
+    if type_ in (ColumnType.STRING, ColumnType.BYTES):
+        ends = _from_bytes("I", column.data[: 4 * row_count])
+        blob = column.data[4 * row_count :]
+        starts = [0, *ends[:-1]]
+        if type_ == ColumnType.BYTES:
+            values = [blob[s:e] for s, e in zip(starts, ends)]
+        else:
+            text = blob.decode("utf-8")
+            if len(text) == len(blob):
+                # ascii only: byte offsets are char offsets, slice the str
+                values = [text[s:e] for s, e in zip(starts, ends)]
+            else:
+                values = [blob[s:e].decode("utf-8") for s, e in zip(starts, ends)]
+    else:
+        values = _from_bytes(_ARRAY_TYPECODES[type_], column.data).tolist()
+        if type_ == ColumnType.DATETIME:
+            values = [EPOCH + timedelta(microseconds=v) for v in values]
+        elif type_ == ColumnType.DECIMAL:
+            scale = column.scale
+            values = [Decimal(v).scaleb(-scale) for v in values]
+        elif type_ == ColumnType.BOOL:
+            values = [v != 0 for v in values]
+
+    if column.nulls:
+        values = [None if n else v for v, n in zip(values, column.nulls)]
+    return values
+
+
+def decode_columns(result: ColumnarResult) -> List[Dict[str, Any]]:
+    """
+    Decode a columnar result into rows.
+
+    Args:
+        result (ColumnarResult): Column header and typed arrays.
+
+    Returns:
+        List[Dict[str, Any]]: Result rows as dicts.
+    """
+    names = [c.name for c in result.columns]
+    columns = [decode_column(c, result.row_count) for c in result.columns]
+    return [dict(zip(names, row)) for row in zip(*columns)]
@@ -135,3 +135,39 @@ class MailData(BaseModel):
     email: str
     subject: str
     body: str
+
+
+class InsertResult(BaseModel):
+    """Id of the inserted row and number of rows affected by a statement"""
+
+    last_insert_id: int = 0
+    rows_affected: int = 0
+
+
+class SlowQuery(BaseModel):
+    """A DB service call recorded by the slow-query journal"""
+
+    fingerprint: str
+    sql: str
+    caller: str
+    location: str
+    seconds: float
+    response_bytes: int
+    rows: int
+    # False for a call sampled as baseline
+    slow: bool
+    at: datetime
+
+
+class SlowShape(BaseModel):
+    """Slow calls of one statement fingerprint, with their baseline"""
+
+    fingerprint: str
+    sql: str
+    callers: list[str]
+    slow_calls: int
+    max_seconds: float
+    mean_seconds: float
+    # mean of the calls sampled as baseline, None if none was sampled
+    baseline_seconds: Optional[float] = None
+    last_at: datetime
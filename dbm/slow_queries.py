@@ -0,0 +1,122 @@
+"""
+Journal of slow DB service calls.
+
+Calls slower than settings.SLOW_QUERY_SECONDS are recorded with their
+statement fingerprint, SQL with literals redacted, duration, response
+size and calling method, in a ring buffer of the process holding the
+last settings.SLOW_QUERY_JOURNAL_SIZE records. A small share of the
+other calls (settings.SLOW_QUERY_SAMPLE_RATE) is recorded as well, as
+the baseline the slow calls of a shape are compared to. Slow calls are
+also logged, so that the cron processes leave a trace of them.
+"""
+
+import random
+from collections import deque
+from typing import Deque, Dict, List, Optional
+
+from config import settings
+from dbm.schemas import SlowQuery, SlowShape
+from libs.logs import log
+
+
+class SlowQueryJournal:
+    """
+    Ring buffer of slow and sampled calls.
+
+    Args:
+        size (int): Number of records kept.
+        threshold (Optional[float]): Seconds from which a call is slow,
+            defaults to settings.SLOW_QUERY_SECONDS.
+        sample_rate (Optional[float]): Share of the other calls recorded,
+            defaults to settings.SLOW_QUERY_SAMPLE_RATE.
+    """
+
+    def __init__(
+        self,
+        size: int = settings.SLOW_QUERY_JOURNAL_SIZE,
+        threshold: Optional[float] = None,
+        sample_rate: Optional[float] = None,
+    ) -> None:
+        self.records: Deque[SlowQuery] = deque(maxlen=size)
+        self._threshold = threshold
+        self._sample_rate = sample_rate
+
+    @property
+    def threshold(self) -> float:
+        if self._threshold is None:
+            return settings.SLOW_QUERY_SECONDS
+        return self._threshold
+
+    @property
+    def sample_rate(self) -> float:
+        if self._sample_rate is None:
+            return settings.SLOW_QUERY_SAMPLE_RATE
+        return self._sample_rate
+
+    def wants(self, seconds: float) -> Optional[bool]:
+        """
+        Whether a call of the given duration is recorded.
+
+        Returns:
+            Optional[bool]: True if it is slow, False if it is sampled as
+                baseline, None if it is not recorded.
+        """
+        if seconds >= self.threshold:
+            return True
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            return False
+        return None
+
+    def add(self, record: SlowQuery) -> None:
+        """Append a record, dropping the oldest one if the journal is full."""
+        self.records.append(record)
+        if record.slow:
+            log.warning(
+                f"slow query {record.fingerprint} {record.seconds:.3f}s "
+                f"{record.rows} rows {record.response_bytes} bytes "
+                f"from {record.caller} ({record.location}): {record.sql}"
+            )
+
+    def top(self, limit: int = 20) -> List[SlowShape]:
+        """
+        Statement shapes of the journal with the slowest calls.
+
+        Args:
+            limit (int): Number of shapes returned.
+
+        Returns:
+            List[SlowShape]: Shapes by decreasing maximum duration.
+        """
+        slow: Dict[str, List[SlowQuery]] = {}
+        sampled: Dict[str, List[float]] = {}
+        for record in self.records:
+            if record.slow:
+                slow.setdefault(record.fingerprint, []).append(record)
+            else:
+                sampled.setdefault(record.fingerprint, []).append(record.seconds)
+        shapes = []
+        for fingerprint, records in slow.items():
+            seconds = [r.seconds for r in records]
+            baseline = sampled.get(fingerprint)
+            shapes.append(
+                SlowShape(
+                    fingerprint=fingerprint,
+                    sql=records[-1].sql,
+                    callers=sorted({r.caller for r in records}),
+                    slow_calls=len(records),
+                    max_seconds=max(seconds),
+                    mean_seconds=sum(seconds) / len(seconds),
+                    baseline_seconds=(
+                        sum(baseline) / len(baseline) if baseline else None
+                    ),
+                    last_at=records[-1].at,
+                )
+            )
+        shapes.sort(key=lambda s: s.max_seconds, reverse=True)
+        return shapes[:limit]
+
+    def clear(self) -> None:
+        self.records.clear()
+
+
+slow_queries = SlowQueryJournal()
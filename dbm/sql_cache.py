@@ -0,0 +1,223 @@
+"""
+Cache of compiled SQL templates by statement shape.
+
+Compiling a SQLAlchemy statement is pure CPU work repeated on every
+query, while the DbQuery classes only issue a few dozen query shapes.
+A statement is compiled once per shape (its SQLAlchemy cache key) into
+a template with named placeholders, and each call only renders its
+bound values as escaped SQL literals into the template.
+"""
+
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy.dialects import mysql
+from sqlalchemy.sql import ClauseElement, Executable
+from sqlalchemy.sql.compiler import SQLCompiler
+
+from config import settings
+from dbm.metrics import SQL_CACHE_REQUESTS
+from dbm.sql_params import to_params
+from grpc_lib import Param
+
+POSITIONAL_DIALECT = mysql.dialect(paramstyle="format")
+
+
+class SqlTemplate:
+    """
+    Statement compiled once, rendered per call with new bound values.
+    """
+
+    def __init__(
+        self,
+        compiled: SQLCompiler,
+        statement: ClauseElement | Executable,
+    ) -> None:
+        self.compiled = compiled
+        self.string = compiled.string
+        self.double_percents = compiled.preparer._double_percents
+        # the first statement of the shape, compiled again with %s
+        # placeholders on the first parameterized use
+        self._statement = statement
+        self._positional: Optional[SQLCompiler] = None
+
+    @property
+    def positional(self) -> SQLCompiler:
+        """The statement compiled with positional %s placeholders."""
+        if self._positional is None:
+            self._positional = POSITIONAL_DIALECT.statement_compiler(
+                POSITIONAL_DIALECT, self._statement, cache_key=self.compiled.cache_key
+            )
+            self._statement = None
+        return self._positional
+
+    def params(self, statement_key: Any) -> Dict[str, Any]:
+        """
+        Bound values of a statement of this shape.
+
+        Args:
+            statement_key (CacheKey): Cache key of the statement, carrying
+                its bound parameters.
+
+        Returns:
+            Dict[str, Any]: Value by placeholder name.
+        """
+        return self.compiled.construct_params(
+            extracted_parameters=statement_key.bindparams
+        )
+
+    def literal(self, name: str, value: Any) -> str:
+        """Render one bound value as an escaped SQL literal."""
+        if value is None:
+            return "NULL"
+        text = self.compiled.render_literal_value(value, self.compiled.binds[name].type)
+        if self.double_percents:
+            # the literal is substituted into the template, not parsed
+            # by the % operator again: undo the %% escaping
+            text = text.replace("%%", "%")
+        return text
+
+    def render(self, statement_key: Any) -> str:
+        """
+        SQL text of a statement of this shape with inlined values.
+
+        Args:
+            statement_key (CacheKey): Cache key of the statement.
+
+        Returns:
+            str: SQL query text.
+        """
+        params = self.params(statement_key)
+        return self.string % {
+            name: self.literal(name, value) for name, value in params.items()
+        }
+
+    def query(self, statement_key: Any) -> Tuple[str, List[Param]]:
+        """
+        SQL template with %s placeholders and the typed parameters of a
+        statement of this shape, for a parameterized query.
+
+        Args:
+            statement_key (CacheKey): Cache key of the statement.
+
+        Returns:
+            Tuple[str, List[Param]]: Template and parameters in order.
+        """
+        compiled = self.positional
+        params = compiled.construct_params(
+            extracted_parameters=statement_key.bindparams
+        )
+        processors = compiled._bind_processors
+        values = []
+        for name in compiled.positiontup:
+            value = params[name]
+            processor = processors.get(name)
+            if processor is not None and value is not None:
+                value = processor(value)
+            values.append(value)
+        return compiled.string, to_params(values)
+
+
+class SqlTemplateCache:
+    """
+    LRU cache of SqlTemplate by statement shape, with hit/miss counters.
+
+    Statements that have no cache key, or whose parameters are expanded
+    at execution time (`in_()` with a list of values), are not cached:
+    render() returns None for them and the caller compiles them with
+    literal binds as before.
+    """
+
+    def __init__(self, size: int = settings.SQL_CACHE_SIZE) -> None:
+        self.size = size
+        self.dialect = mysql.dialect(paramstyle="pyformat")
+        self._templates: OrderedDict = OrderedDict()
+        self.counts = {"hit": 0, "miss": 0, "bypass": 0}
+
+    def _compile(
+        self,
+        statement: ClauseElement | Executable,
+        statement_key: Any,
+    ) -> Optional[SqlTemplate]:
+        compiled = self.dialect.statement_compiler(
+            self.dialect, statement, cache_key=statement_key
+        )
+        for bind in compiled.binds.values():
+            if bind.expanding or bind.literal_execute or bind.type._has_bind_expression:
+                return None
+        return SqlTemplate(compiled, statement)
+
+    def template(
+        self,
+        statement: ClauseElement | Executable,
+    ) -> tuple[Optional[SqlTemplate], Any]:
+        """
+        Cached template of a statement.
+
+        Args:
+            statement (ClauseElement | Executable): SQLAlchemy statement.
+
+        Returns:
+            tuple[Optional[SqlTemplate], Any]: Template (None if the
+                statement can not be cached) and the statement cache key.
+        """
+        if self.size <= 0:
+            return None, None
+        statement_key = statement._generate_cache_key()
+        if statement_key is None:
+            self._count("bypass")
+            return None, None
+        key = statement_key.key
+        if key in self._templates:
+            self._templates.move_to_end(key)
+            template = self._templates[key]
+            result = "hit"
+        else:
+            template = self._compile(statement, statement_key)
+            self._templates[key] = template
+            if len(self._templates) > self.size:
+                self._templates.popitem(last=False)
+            result = "miss"
+        self._count("bypass" if template is None else result)
+        return template, statement_key
+
+    def _count(self, result: str) -> None:
+        self.counts[result] += 1
+        SQL_CACHE_REQUESTS.labels(result).inc()
+
+    def render(self, statement: ClauseElement | Executable) -> Optional[str]:
+        """
+        SQL text of a statement rendered from its cached template.
+
+        Args:
+            statement (ClauseElement | Executable): SQLAlchemy statement.
+
+        Returns:
+            Optional[str]: SQL query text, None if the statement can not
+                be cached.
+        """
+        template, statement_key = self.template(statement)
+        if template is None:
+            return None
+        return template.render(statement_key)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns:
+            Dict[str, int]: Number of cached shapes, hits, misses and
+                bypasses (statements that can not be cached).
+        """
+        return {
+            "size": len(self._templates),
+            "hits": self.counts["hit"],
+            "misses": self.counts["miss"],
+            "bypasses": self.counts["bypass"],
+        }
+
+    def clear(self) -> None:
+        """Drop all templates and reset the counters."""
+        self._templates.clear()
+        self.counts = dict.fromkeys(self.counts, 0)
+
+
+sql_cache = SqlTemplateCache()
@@ -0,0 +1,70 @@
+"""
+Typed query parameters of the database service protocol.
+
+With parameterized queries the client sends a SQL template with %s
+placeholders plus one Param per placeholder instead of SQL text with
+inlined literals, so the server can prepare each template once.
+to_param() is used by DbMain, from_param() by database service
+implementations.
+"""
+
+from datetime import date, timedelta
+from decimal import Decimal
+from typing import Any, List
+
+import betterproto
+
+from dbm.row_codec import EPOCH, to_micros
+from grpc_lib import Param
+
+
+def to_param(value: Any) -> Param:
+    """
+    Wrap a bound value into a typed protocol parameter.
+
+    Args:
+        value (Any): Bound value, after the column type bind processor.
+
+    Returns:
+        Param: Typed parameter.
+    """
+    if value is None:
+        return Param(null_value=True)
+    if isinstance(value, bool):
+        return Param(bool_value=value)
+    if isinstance(value, int):
+        return Param(int_value=value)
+    if isinstance(value, float):
+        return Param(double_value=value)
+    if isinstance(value, Decimal):
+        return Param(decimal_value=str(value))
+    if isinstance(value, date):
+        return Param(datetime_value=to_micros(value))
+    if isinstance(value, (bytes, bytearray)):
+        return Param(bytes_value=bytes(value))
+    return Param(string_value=str(value))
+
+
+def to_params(values: List[Any]) -> List[Param]:
+    """Wrap bound values into typed protocol parameters, in order."""
+    return [to_param(v) for v in values]
+
+
+def from_param(param: Param) -> Any:
+    """
+    Python value of a typed protocol parameter.
+
+    Args:
+        param (Param): Typed parameter.
+
+    Returns:
+        Any: Value to bind to the prepared statement.
+    """
+    field, value = betterproto.which_one_of(param, "value")
+    if field == "" or field == "null_value":
+        return None
+    if field == "datetime_value":
+        return EPOCH + timedelta(microseconds=value)
+    if field == "decimal_value":
+        return Decimal(value)
+    return value
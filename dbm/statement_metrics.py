@@ -0,0 +1,224 @@
+"""
+Per-statement metrics of DB service calls.
+
+The HTTP metrics only show the latency of whole requests; these show
+which of the queries of a request are slow, large or return many rows.
+Every call is labelled by the fingerprint of its statement (operation,
+tables and a hash of the SQL with its literals masked, e.g.
+"select:users:3f2a9c1e") and by the DbQuery method that issued it
+(e.g. "DbQueryMixin.get_user_by_email"). The number of label pairs is
+bounded by settings.DB_STATEMENT_METRICS_MAX_SERIES, the calls of any
+further pair are counted as "other". Slow calls and a sample of the
+others also go to the slow-query journal (see dbm.slow_queries).
+"""
+
+import re
+import sys
+import time
+import zlib
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, Iterator, Optional, Tuple, Union
+
+from sqlalchemy.sql import ClauseElement, Executable
+from sqlalchemy.sql.util import find_tables
+
+from config import settings
+from dbm.metrics import STATEMENT_LATENCY, STATEMENT_RESPONSE_BYTES, STATEMENT_ROWS
+from dbm.schemas import SlowQuery
+from dbm.slow_queries import slow_queries
+from grpc_lib import Encoding, EndpointResponse
+
+OTHER = "other"
+
+# string and number literals, and %s placeholders of SQL templates
+_LITERALS = re.compile(r"'(?:[^'\\]|\\.|'')*'|\b\d+(?:\.\d+)?\b|%s")
+# IN lists of any length have the same shape
+_LISTS = re.compile(r"\(\?(?:, \?)*\)")
+
+
+def redact(sql: str) -> str:
+    """SQL text or template with its literals masked by "?"."""
+    return _LISTS.sub("(?)", _LITERALS.sub("?", sql))
+
+
+def shape_hash(sql: str) -> int:
+    """Hash of a SQL text or template with its literals masked."""
+    return zlib.crc32(redact(sql).encode())
+
+
+def fingerprint(statement: ClauseElement | Executable, shape: int) -> str:
+    """
+    Fingerprint label of a statement: operation, tables and shape hash.
+
+    Args:
+        statement (ClauseElement | Executable): SQLAlchemy statement.
+        shape (int): Hash of its SQL, see shape_hash().
+
+    Returns:
+        str: Fingerprint, e.g. "update:coupons:0c1d2e3f".
+    """
+    operation = statement.__visit_name__
+    if operation == "textclause":
+        operation, tables = "text", "-"
+    else:
+        names = {t.name for t in find_tables(statement, include_crud=True)}
+        tables = "+".join(sorted(names)) or "-"
+    return f"{operation}:{tables}:{shape:08x}"
+
+
+def caller(internal: str) -> Tuple[str, str]:
+    """
+    Qualified name and location of the function that called into the
+    DB layer.
+
+    Args:
+        internal (str): File name of the DB layer module whose frames
+            are skipped.
+
+    Returns:
+        Tuple[str, str]: E.g. ("DbQuery.get_coupon", "db/database.py:42"),
+            OTHER for both if there is none.
+    """
+    skipped = (internal, __file__)
+    frame = sys._getframe(1)
+    while frame is not None and frame.f_code.co_filename in skipped:
+        frame = frame.f_back
+    if frame is None:
+        return OTHER, OTHER
+    code = frame.f_code
+    location = f"{code.co_filename}:{code.co_firstlineno}"
+    return getattr(code, "co_qualname", code.co_name), location
+
+
+def response_size(response: EndpointResponse) -> int:
+    """Size of the result of a response: JSON text or columnar data."""
+    if response.encoding == Encoding.COLUMNAR:
+        return sum(len(c.data) + len(c.nulls) for c in response.columns.columns)
+    return len(response.test_res)
+
+
+class Call:
+    """One measured call of a series."""
+
+    __slots__ = ("series", "sql", "seconds")
+
+    def __init__(self, series: "Series", sql: str) -> None:
+        self.series = series
+        self.sql = sql
+        self.seconds = 0.0
+
+    def record(self, response: EndpointResponse, rows: int) -> None:
+        """Account the response of the call and its number of rows."""
+        series = self.series
+        size = response_size(response)
+        series.rows.observe(rows)
+        series.bytes.inc(size)
+        slow = slow_queries.wants(self.seconds)
+        if slow is not None:
+            slow_queries.add(
+                SlowQuery(
+                    fingerprint=series.fingerprint,
+                    sql=redact(self.sql),
+                    caller=series.caller,
+                    location=series.location,
+                    seconds=self.seconds,
+                    response_bytes=size,
+                    rows=rows,
+                    slow=slow,
+                    at=datetime.now(),
+                )
+            )
+
+
+class Series:
+    """Metric children of one fingerprint and caller."""
+
+    __slots__ = ("fingerprint", "caller", "location", "latency", "rows", "bytes")
+
+    def __init__(self, fingerprint_: str, caller_: str, location: str) -> None:
+        self.fingerprint = fingerprint_
+        self.caller = caller_
+        self.location = location
+        self.latency = STATEMENT_LATENCY.labels(fingerprint_, caller_)
+        self.rows = STATEMENT_ROWS.labels(fingerprint_, caller_)
+        self.bytes = STATEMENT_RESPONSE_BYTES.labels(fingerprint_, caller_)
+
+    @contextmanager
+    def measure(self, sql: str) -> Iterator[Call]:
+        """
+        Observe the latency of the call made in the block, failed or not.
+        The call yielded records its response once it arrived.
+        """
+        call = Call(self, sql)
+        started = time.perf_counter()
+        try:
+            yield call
+        finally:
+            call.seconds = time.perf_counter() - started
+            self.latency.observe(call.seconds)
+
+
+class NoCall:
+    """Call of disabled statement metrics, recording nothing."""
+
+    def record(self, response: EndpointResponse, rows: int) -> None:
+        pass
+
+
+class NoSeries:
+    """Series of disabled statement metrics, recording nothing."""
+
+    @contextmanager
+    def measure(self, sql: str) -> Iterator[NoCall]:
+        yield NoCall()
+
+
+class StatementMetrics:
+    """
+    Series of the statements sent by the process, by shape and caller.
+    Fingerprints are computed once per statement shape.
+    """
+
+    def __init__(self, max_series: int = settings.DB_STATEMENT_METRICS_MAX_SERIES):
+        self.max_series = max_series
+        self._fingerprints: Dict[int, str] = {}
+        self._series: Dict[Tuple[int, str], Series] = {}
+        self._other: Optional[Series] = None
+        self._none = NoSeries()
+
+    def series(
+        self, statement: ClauseElement | Executable, sql: str, internal: str
+    ) -> Union[Series, NoSeries]:
+        """
+        Series of a call sending statement as sql.
+
+        Args:
+            statement (ClauseElement | Executable): SQLAlchemy statement.
+            sql (str): SQL text or template sent for it.
+            internal (str): File name of the calling DB layer module,
+                see caller().
+
+        Returns:
+            Union[Series, NoSeries]: Metric children of the call.
+        """
+        if not settings.DB_STATEMENT_METRICS:
+            return self._none
+        shape = shape_hash(sql)
+        caller_, location = caller(internal)
+        key = (shape, caller_)
+        series = self._series.get(key)
+        if series is not None:
+            return series
+        if len(self._series) >= self.max_series:
+            if self._other is None:
+                self._other = Series(OTHER, OTHER, OTHER)
+            return self._other
+        if shape not in self._fingerprints:
+            self._fingerprints[shape] = fingerprint(statement, shape)
+        series = Series(self._fingerprints[shape], caller_, location)
+        self._series[key] = series
+        return series
+
+
+statement_metrics = StatementMetrics()
@@ -0,0 +1,127 @@
+"""
+Redis cache of user records by email.
+
+get_user_by_email() is the most frequent query of the backend (the
+payment success page alone looks the user up on every refresh). Users
+are cached by normalized email for settings.USER_CACHE_TTL seconds in
+a compact form: a JSON array of the UserId field values, without the
+field names. The cache is read through by get_user_by_email() and kept
+coherent by the DbQuery methods writing users: creating a user stores
+it, updating or deleting one drops its entry once the write is done
+(once the batch is executed, for writes recorded in a batch). The TTL
+bounds the staleness left by writes made outside of these methods.
+
+Redis errors never fail a query: the cache is skipped for
+settings.REDIS_CACHE_RETRY_AFTER seconds and the database answers.
+"""
+
+import json
+import time
+from datetime import datetime
+from typing import Any, List, Optional
+
+from redis.asyncio.client import Redis
+
+from config import settings
+from dbm.materialize import construct_rows
+from dbm.metrics import USER_CACHE_REQUESTS
+from dbm.schemas import UserId
+from libs.logs import log
+
+# bumped when the serialized form changes, older entries are misses
+FORMAT = 1
+FIELDS = tuple(UserId.model_fields)
+
+
+def _default(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"can not serialize {type(value)}")
+
+
+class UserCache:
+    """
+    Cache of UserId records in Redis, keyed by normalized email.
+
+    Args:
+        redis (Redis): Redis client.
+        prefix (str): Prefix of the keys.
+    """
+
+    def __init__(self, redis: Redis, prefix: str = "user:") -> None:
+        self.redis = redis
+        self.prefix = prefix
+        self._skip_until = 0.0
+
+    @staticmethod
+    def normalize(email: str) -> str:
+        return email.strip().lower()
+
+    def key(self, email: str) -> str:
+        return self.prefix + self.normalize(email)
+
+    @staticmethod
+    def dumps(user: UserId) -> str:
+        """Compact form of a user: format and field values, in field order."""
+        values: List[Any] = [FORMAT]
+        values.extend(getattr(user, name) for name in FIELDS)
+        return json.dumps(values, separators=(",", ":"), default=_default)
+
+    @staticmethod
+    def loads(data: str) -> Optional[UserId]:
+        """User of a compact form, None if it has another format."""
+        values = json.loads(data)
+        if values[0] != FORMAT or len(values) != len(FIELDS) + 1:
+            return None
+        return construct_rows(UserId, [dict(zip(FIELDS, values[1:]))])[0]
+
+    @property
+    def enabled(self) -> bool:
+        return settings.USER_CACHE_TTL > 0 and time.monotonic() >= self._skip_until
+
+    def _failed(self, ex: Exception) -> None:
+        USER_CACHE_REQUESTS.labels("error").inc()
+        self._skip_until = time.monotonic() + settings.REDIS_CACHE_RETRY_AFTER
+        log.warning(f"user cache unavailable {ex!r}")
+
+    async def get(self, email: str) -> Optional[UserId]:
+        """
+        Cached user of an email.
+
+        Args:
+            email (str): Email address, in any case.
+
+        Returns:
+            Optional[UserId]: The user, None on a miss.
+        """
+        if not self.enabled:
+            return None
+        try:
+            data = await self.redis.get(self.key(email))
+        except Exception as ex:
+            self._failed(ex)
+            return None
+        user = self.loads(data) if data is not None else None
+        USER_CACHE_REQUESTS.labels("miss" if user is None else "hit").inc()
+        return user
+
+    async def put(self, user: UserId) -> None:
+        """Store a user read from (or just written to) the database."""
+        if not self.enabled or not user.email:
+            return
+        try:
+            await self.redis.set(
+                self.key(user.email), self.dumps(user), ex=settings.USER_CACHE_TTL
+            )
+        except Exception as ex:
+            self._failed(ex)
+
+    async def forget(self, email: str) -> None:
+        """Drop the entry of an email after a write of the user."""
+        if settings.USER_CACHE_TTL <= 0:
+            return
+        try:
+            await self.redis.delete(self.key(email))
+        except Exception as ex:
+            # the entry expires after USER_CACHE_TTL at the latest
+            self._failed(ex)
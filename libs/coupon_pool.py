@@ -0,0 +1,344 @@
+"""
+Pool of ready-made coupons.
+
+Payments, access letters and mail campaigns hand out fresh coupons of a
+few kinds (profiles: discount percent, days of validity, plans).
+Instead of generating and inserting each coupon on the spot, a
+background task of the backend inserts them by batches, for each
+profile of settings.COUPON_POOL_PROFILES, and keeps their codes in a
+Redis list per profile; handing out a coupon is then a single LPOP.
+
+A pool is sized by demand: the takes of a profile are counted in Redis
+by windows of settings.COUPON_POOL_DEMAND_WINDOW seconds, and its list
+is refilled, once down to half of it, up to the takes of the last (or
+current) window, at most settings.COUPON_POOL_SIZE. A profile taken
+rarely thus keeps a few coupons, or none. Coupons waiting longer than
+settings.COUPON_POOL_MAX_AGE_SHARE of their validity are dropped and
+deleted, by the refill or the taker finding them, so that a coupon
+handed out loses at most that share of its validity.
+
+Profiles without a pool, an empty pool and Redis errors fall back to
+inserting the coupon synchronously, as before. A coupon taken but not
+handed out (its transaction rolled back) is given back.
+"""
+
+import asyncio
+import secrets
+import time
+from datetime import datetime, timedelta
+from typing import List, NamedTuple, Optional
+
+from redis.asyncio.client import Redis
+
+from config import settings
+from dbm.metrics import COUPON_POOL_COUPONS, COUPON_POOL_LENGTH, COUPON_POOL_TAKES
+from dbm.redis_db import redis_stright
+from dbm.schemas import CouponsPd
+from libs.logs import log
+from libs.utils import generate_coupon_db, generate_coupons_db
+
+# entries popped by one take() before giving up on a pool of stale coupons
+MAX_STALE_POPS = 10
+# seconds a refill lock is held at most
+REFILL_LOCK_TTL = 60
+# deletes a lock only if it still holds the token of its owner
+RELEASE_LOCK = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+class CouponProfile(NamedTuple):
+    """Kind of coupon: discount percent, days of validity, plans."""
+
+    percent: int
+    days: int
+    plans: Optional[str] = None
+
+    @classmethod
+    def parse(cls, text: str) -> "CouponProfile":
+        """Profile of a "percent:days[:plans]" setting, e.g. "35:1:180,360"."""
+        percent, days, *plans = text.split(":", 2)
+        return cls(int(percent), int(days), plans[0] if plans else None)
+
+    def __str__(self) -> str:
+        return f"{self.percent}:{self.days}:{self.plans or ''}"
+
+
+class CouponPool:
+    """
+    Redis lists of ready coupon codes by profile, and their refill task.
+
+    Args:
+        redis (Redis): Redis client.
+        prefix (str): Prefix of the keys.
+    """
+
+    def __init__(self, redis: Redis, prefix: str = "coupon:pool:") -> None:
+        self.redis = redis
+        self.prefix = prefix
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def profiles(self) -> List[CouponProfile]:
+        if settings.COUPON_POOL_SIZE <= 0:
+            return []
+        return [CouponProfile.parse(p) for p in settings.COUPON_POOL_PROFILES]
+
+    def key(self, profile: CouponProfile) -> str:
+        return f"{self.prefix}{profile}"
+
+    @staticmethod
+    def entry(coupon: CouponsPd) -> str:
+        return f"{coupon.coupon}:{int(coupon.created.timestamp())}"
+
+    @staticmethod
+    def coupon(profile: CouponProfile, entry: str) -> CouponsPd:
+        """Coupon of a pool entry, built without a database read."""
+        code, created = entry.rsplit(":", 1)
+        created_at = datetime.fromtimestamp(int(created))
+        return CouponsPd(
+            coupon=code,
+            percent=profile.percent,
+            created=created_at,
+            expiration=created_at + timedelta(days=profile.days),
+            plans=profile.plans,
+        )
+
+    def demand_key(self, profile: CouponProfile, window: int) -> str:
+        return f"{self.key(profile)}:taken:{window}"
+
+    @staticmethod
+    def window() -> int:
+        """Index of the current demand window."""
+        return int(time.time() // settings.COUPON_POOL_DEMAND_WINDOW)
+
+    def count_takes(self, pipe, profile: CouponProfile, count: int) -> None:
+        """Queue the counting of takes in the demand window of a profile."""
+        key = self.demand_key(profile, self.window())
+        pipe.incrby(key, count)
+        pipe.expire(key, 2 * settings.COUPON_POOL_DEMAND_WINDOW)
+
+    @staticmethod
+    def stale(profile: CouponProfile, entry: str) -> bool:
+        created = int(entry.rsplit(":", 1)[1])
+        max_age = profile.days * 86400 * settings.COUPON_POOL_MAX_AGE_SHARE
+        return time.time() - created > max_age
+
+    async def take(
+        self, db, percent: int, days: int, plans: Optional[str] = None
+    ) -> CouponsPd:
+        """
+        Hand out a new coupon: pop one from the pool of its profile, or
+        generate and insert one if the profile has no pool or it is empty.
+
+        Args:
+            db: Database handler, for the fallback insert.
+            percent (int): Discount percent.
+            days (int): Days of validity.
+            plans (Optional[str]): Comma-separated plans, None for all.
+
+        Returns:
+            CouponsPd: The coupon.
+        """
+        profile = CouponProfile(percent, days, plans)
+        if profile in self.profiles:
+            coupon = await self._pop(db, profile)
+            if coupon is not None:
+                return coupon
+        return await generate_coupon_db(db, percent, days, plans)
+
+    async def _pop(self, db, profile: CouponProfile) -> Optional[CouponsPd]:
+        label = str(profile)
+        key = self.key(profile)
+        stale = []
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                self.count_takes(pipe, profile, 1)
+                pipe.lpop(key)
+                *_, entry = await pipe.execute()
+            while entry is not None:
+                if not self.stale(profile, entry):
+                    COUPON_POOL_TAKES.labels(label, "hit").inc()
+                    return self.coupon(profile, entry)
+                COUPON_POOL_TAKES.labels(label, "stale").inc()
+                stale.append(entry)
+                if len(stale) >= MAX_STALE_POPS:
+                    break
+                entry = await self.redis.lpop(key)
+        except Exception as ex:
+            COUPON_POOL_TAKES.labels(label, "error").inc()
+            log.warning(f"coupon pool {label} unavailable {ex!r}")
+            return None
+        finally:
+            await self._delete(db, profile, stale)
+        COUPON_POOL_TAKES.labels(label, "empty").inc()
+        return None
+
+    async def take_many(
+        self, db, profile: CouponProfile, count: int
+    ) -> List[CouponsPd]:
+        """
+        Take up to count coupons from the pool of a profile in one round
+        trip, e.g. for a mail campaign generating the others in bulk.
+
+        Args:
+            db: Database handler, to delete the stale coupons popped.
+            profile (CouponProfile): Profile of the pool.
+            count (int): Number of coupons wanted.
+
+        Returns:
+            List[CouponsPd]: The coupons, fewer or none if the pool ran
+                short or the profile has no pool.
+        """
+        if count <= 0 or profile not in self.profiles:
+            return []
+        label = str(profile)
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                self.count_takes(pipe, profile, count)
+                pipe.lpop(self.key(profile), count)
+                *_, entries = await pipe.execute()
+        except Exception as ex:
+            COUPON_POOL_TAKES.labels(label, "error").inc()
+            log.warning(f"coupon pool {label} unavailable {ex!r}")
+            return []
+        entries = entries or []
+        fresh = [e for e in entries if not self.stale(profile, e)]
+        await self._delete(db, profile, [e for e in entries if e not in fresh])
+        COUPON_POOL_TAKES.labels(label, "hit").inc(len(fresh))
+        COUPON_POOL_TAKES.labels(label, "stale").inc(len(entries) - len(fresh))
+        return [self.coupon(profile, e) for e in fresh]
+
+    async def give_back(self, db, profile: CouponProfile, coupon: CouponsPd) -> None:
+        """
+        Return a coupon taken but not handed out to the head of its pool,
+        or delete it if its profile has no pool, it is stale or Redis
+        failed.
+
+        Args:
+            db: Database handler.
+            profile (CouponProfile): Profile the coupon was taken with.
+            coupon (CouponsPd): The coupon.
+        """
+        entry = self.entry(coupon)
+        if profile in self.profiles and not self.stale(profile, entry):
+            try:
+                await self.redis.lpush(self.key(profile), entry)
+                COUPON_POOL_COUPONS.labels(str(profile), "returned").inc()
+                return
+            except Exception as ex:
+                log.warning(f"coupon pool {profile} unavailable {ex!r}")
+        await self._delete(db, profile, [entry])
+
+    async def _delete(self, db, profile: CouponProfile, entries: List[str]) -> None:
+        """Delete the coupons of entries popped from a pool."""
+        if not entries:
+            return
+        try:
+            await db.delete_coupons([e.rsplit(":", 1)[0] for e in entries])
+        except Exception as ex:
+            # an unused coupon is left in the table, nobody knows its code
+            log.warning(f"coupon pool {profile} delete failed {ex!r}")
+            return
+        COUPON_POOL_COUPONS.labels(str(profile), "dropped").inc(len(entries))
+
+    async def _drop_stale(self, db, profile: CouponProfile) -> None:
+        """Pop the stale coupons at the head of a pool and delete them."""
+        key = self.key(profile)
+        stale = []
+        while True:
+            entry = await self.redis.lpop(key)
+            if entry is None:
+                break
+            if not self.stale(profile, entry):
+                await self.redis.lpush(key, entry)
+                break
+            stale.append(entry)
+        await self._delete(db, profile, stale)
+
+    async def target(self, profile: CouponProfile) -> int:
+        """
+        Length a pool is refilled to: the takes of the last demand window,
+        or of the current one if more, at most settings.COUPON_POOL_SIZE.
+        """
+        window = self.window()
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.get(self.demand_key(profile, window - 1))
+            pipe.get(self.demand_key(profile, window))
+            taken = await pipe.execute()
+        demand = max(int(t or 0) for t in taken)
+        return min(demand, settings.COUPON_POOL_SIZE)
+
+    async def refill(self, db, profile: CouponProfile) -> int:
+        """
+        Drop the stale coupons of a pool and, if it is down to half of its
+        target length (see target()), insert a batch of coupons and push
+        them. One process at a time refills a pool.
+
+        Args:
+            db: Database handler.
+            profile (CouponProfile): Profile of the pool.
+
+        Returns:
+            int: Number of coupons inserted.
+        """
+        key = self.key(profile)
+        lock = f"{key}:refill"
+        token = secrets.token_hex(8)
+        if not await self.redis.set(lock, token, nx=True, ex=REFILL_LOCK_TTL):
+            return 0
+        try:
+            await self._drop_stale(db, profile)
+            length = await self.redis.llen(key)
+            target = await self.target(profile)
+            added = 0
+            if length < target and length <= target // 2:
+                coupons = await generate_coupons_db(
+                    db,
+                    target - length,
+                    profile.percent,
+                    profile.days,
+                    profile.plans,
+                )
+                await self.redis.rpush(key, *[self.entry(c) for c in coupons])
+                added = len(coupons)
+                COUPON_POOL_COUPONS.labels(str(profile), "inserted").inc(added)
+            COUPON_POOL_LENGTH.labels(str(profile)).set(length + added)
+            return added
+        finally:
+            # a refill outlasting the lock must not release the lock
+            # another process took since
+            await self.redis.eval(RELEASE_LOCK, 1, lock, token)
+
+    async def _run(self, db) -> None:
+        while True:
+            for profile in self.profiles:
+                try:
+                    await self.refill(db, profile)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as ex:
+                    # takers fall back to inserting their coupons
+                    log.warning(f"coupon pool {profile} refill failed {ex!r}")
+            await asyncio.sleep(settings.COUPON_POOL_REFILL_INTERVAL)
+
+    def start(self, db) -> None:
+        """Start the background refill task."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run(db))
+
+    async def stop(self) -> None:
+        """Stop the background refill task."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+coupon_pool = CouponPool(redis_stright)
@@ -48,3 +48,8 @@ def internal_error(
 ) -> MyCustomException:
     """Return custom error with developer defined parameters and status."""
     return typed_error(lang, "vpn.order.error.internal-error", error, status_code)
+
+
+def service_unavailable(lang: str = "en", error: str = "") -> MyCustomException:
+    """Return 503 error for a backend service failing or not responding."""
+    return typed_error(lang, "vpn.order.error.internal-error", error, 503)
@@ -1,5 +1,4 @@
 from abc import ABC, abstractmethod
-from datetime import datetime, timedelta
 from typing import Annotated
 
 from fastapi import Depends
@@ -8,15 +7,12 @@ from jinja2 import Environment, FileSystemLoader
 
 from config import email_config, settings
 from dbm.database import DbQuery, db
-from dbm.schemas import Coupons, CouponsPd, MailData, UserId
+from dbm.schemas import CouponsPd, MailData, UserId
 from langs.lang import langs
+from libs.coupon_pool import coupon_pool
 from libs.exceptions import internal_error
 from libs.logs import log
-from libs.utils import (
-    generate_coupon_or_code,
-    get_tariffs_monthes,
-    get_unsubscribe_token,
-)
+from libs.utils import get_tariffs_monthes, get_unsubscribe_token
 
 env = Environment(loader=FileSystemLoader("templates"))
 
@@ -124,13 +120,12 @@ class SendCode:
 
     async def coupon_add(self) -> CouponsPd:
         """
-        Create a new coupon and insert it into the database.
+        Take a new coupon from the coupon pool, or insert one into the
+        database if the pool is empty.
         Returns:
             Coupon instance added to the database.
         """
-        coupon = self.coupon_data()
-        await self.db.insert_coupon(coupon)
-        return coupon
+        return await coupon_pool.take(self.db, 10, 30)
 
     async def coupon_to_user(self, coupon: str) -> None:
         """
@@ -227,22 +222,6 @@ class SendCode:
         )
         return result
 
-    @staticmethod
-    def generate_coupon():
-        """Generate a new coupon."""
-        return generate_coupon_or_code("COUPON")
-
-    def coupon_data(self):
-        """
-        Create Coupons data class instance with preset discount and expiration
-        """
-        return Coupons(
-            coupon=self.generate_coupon(),
-            percent=10,
-            created=datetime.now(),
-            expiration=datetime.now() + timedelta(days=30),
-        )
-
 
 class EmailSenderFactory:
     @staticmethod
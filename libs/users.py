@@ -34,8 +34,7 @@ async def insert_user(
         lang=lang,
     )
 
-    await db.create_user(data_insert)
-    user = await db.get_user_by_email(data.email)
+    user = await db.create_user(data_insert)
 
     if user is None:
         log.error(f"ERROR inserting email user {user}")
@@ -102,11 +101,14 @@ async def insert_mail(
     amount: int = 0,
 ) -> UserInsertEmail:
     has_user = True
-    user = await db.get_user_by_email(data.email)
-
-    if not user:
-        has_user = False
-        user = await create_user(data, db, ip, lang, subject, amount)
+    # the existence check decides on the insert: a lagging replica
+    # would create a duplicate user, so read from the primary
+    with db.primary():
+        user = await db.get_user_by_email(data.email)
+
+        if not user:
+            has_user = False
+            user = await create_user(data, db, ip, lang, subject, amount)
 
     user_response = await get_user_response(db, user)
 
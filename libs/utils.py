@@ -52,6 +52,30 @@ async def generate_coupon_db(db, cents, expiration, plans=None):
     return data
 
 
+async def generate_coupons_db(db, count, cents, expiration, plans=None):
+    """
+    Generate count distinct coupons and insert them in DB with
+    multi-row inserts, in one round trip
+    """
+    codes = set()
+    while len(codes) < count:
+        codes.add(generate_coupon_or_code())
+    # the columns store whole seconds
+    now = datetime.now().replace(microsecond=0)
+    coupons = [
+        CouponsPd(
+            coupon=code,
+            percent=cents,
+            created=now,
+            expiration=now + timedelta(days=expiration),
+            plans=plans,
+        )
+        for code in codes
+    ]
+    await db.insert_coupons_many(coupons)
+    return coupons
+
+
 def get_tariffs_monthes(tariff, lang="en"):
     """Just set the dict with numbers of months and names of related tariff"""
     tariffs_monthes = {